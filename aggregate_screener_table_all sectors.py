@@ -1,3 +1,5 @@
+import io
+import json
 import requests
 import pandas as pd
 import time
@@ -5,8 +7,16 @@ import logging
 import concurrent.futures
 import threading
 import psycopg2
-import psycopg2.extras
 import numpy as np
+import os
+import hashlib
+from datetime import date, datetime, timedelta
+
+try:  # Parquet staging is optional; everything else works without pyarrow.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
 
 # --- Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -23,13 +33,47 @@ DB_PARAMS = {
 SCHEMA_NAME = "public"
 WIDE_TABLE_NAME = "aggregate_screener_table"
 VERTICAL_TABLE_NAME = "agg_screener_table_vertical"
-MATERIALIZED_VIEW_NAME = "screener_analytics_summary"
+MATERIALIZED_VIEW_NAME = "screener_analytics_summary"  # Now a view over the summary cube table
+SUMMARY_CUBE_TABLE_NAME = "screener_analytics_cube"
+SUMMARY_CUBE_STATE_TABLE_NAME = "screener_analytics_cube_state"
+SUMMARY_DIMENSIONS_STATE_KEY = "__dimensions__"  # State row tracking the symbol universe and dimension columns
+
+# --- Snapshot History Configuration ---
+# When True, every run is stored as one snapshot_date partition of the history tables below, and the wide and
+# vertical table names above become views of the latest snapshot. When False, both tables are dropped and
+# rebuilt on every run (the original behaviour).
+SNAPSHOT_MODE = True
+WIDE_HISTORY_TABLE_NAME = "aggregate_screener_history"
+VERTICAL_HISTORY_TABLE_NAME = "agg_screener_vertical_fact_history"
+
+# --- Vertical Table Configuration ---
+# The vertical data is stored as a compact fact table of (symbol_id, metric_id, metric_value) keyed by the two
+# id dimensions below; identifier attributes stay in the wide table only, and VERTICAL_TABLE_NAME is a view that
+# joins them back into the original vertical layout. The symbol dimension is the company dimension shared with
+# the price, financial statement and ratio pipelines; this script keeps its attributes current.
+SYMBOL_DIM_TABLE_NAME = "dim_company"
+LEGACY_SYMBOL_DIM_TABLE_NAME = "screener_symbol_dim"  # Migrated into SYMBOL_DIM_TABLE_NAME on first use
+COMPANY_DIMENSION_COLUMNS = ['company_name', 'sector', 'industry', 'market_cap_group', 'country', 'analyst_rating', 'ma50_vs_200d']
+METRIC_DIM_TABLE_NAME = "screener_metric_dim"
+VERTICAL_FACT_TABLE_NAME = "agg_screener_vertical_fact"
 
 # --- Fetching Configuration ---
-METRICS_PER_BATCH = 24
+METRICS_PER_BATCH = 24  # Starting batch size; the planner probes larger batches from here
+MAX_METRICS_PER_BATCH = 256  # Upper bound for the batch-size probe
+SCREENER_BATCH_SIZE_CACHE = "screener_batch_size.json"  # Remembers the accepted batch size between runs
+BATCH_RETRY_ROUNDS = 3  # Extra rounds for metrics missing from their batch's response
+TOO_LARGE_STATUS_CODES = (413, 414)  # Responses meaning the batch URL was too long; the batch size is halved
 REQUESTS_PER_MINUTE = 12
+REQUEST_BURST = REQUESTS_PER_MINUTE  # Unused slots that may be spent back-to-back, e.g. at start-up
 MAX_WORKERS = 10
 
+# --- Parquet Staging Configuration ---
+# When set, every run's wide screener table is also written to a Parquet dataset partitioned by snapshot date (requires pyarrow).
+PARQUET_STAGING_DIR = None  # e.g. "parquet_staging"
+# When True, no screener calls are made: the tables are rebuilt from the latest staged snapshot instead.
+RELOAD_FROM_PARQUET = False
+SCREENER_DICTIONARY_COLUMNS = ['sector', 'industry', 'market_cap_group', 'country', 'exchange', 'analyst_rating', 'payout_frequency']
+
 # --- Data Configuration ---
 METRIC_ABBREVIATIONS = [
     'name', 'sector', 'industry', 'peRatio', 'marketCapCategory', 'enterpriseValue', 'marketCap', 'close', 'change', 
@@ -140,27 +184,55 @@ METRIC_MAP = {
     'premarketChangePercent':'premarket_change_percent','premarketPrice':'premarket_price','premarketVolume':'premarket_volume','tags':'tags'
 }
 
+# --- Typed Screener Schema ---
+# Storage type of every METRIC_MAP column; metrics not listed below are DOUBLE PRECISION. Each ENUM column gets a
+# Postgres enum type named screener_<column>, extended with new values as they appear. Columns the API returns
+# that are not in METRIC_MAP fall back to DOUBLE PRECISION if numeric, TEXT otherwise.
+SCREENER_TEXT_COLUMNS = [
+    'symbol', 'company_name', 'industry', 'country', 'sic_code', 'cik_code', 'isin', 'cusip', 'website', 'in_index',
+    'ma50_vs_200d', 'payout_frequency', 'earnings_time', 'fiscal_year_end', 'last_split_type', 'tags'
+]
+SCREENER_DATE_COLUMNS = [
+    'ipo_date', 'ath_date', 'atl_date', 'earnings_date', 'last_earnings_date', 'next_earnings_date',
+    'last_report_date', 'last_10k_filing_date', 'last_split_date'
+]
+SCREENER_INTEGER_COLUMNS = [
+    'founded', 'employees', 'employees_change', 'volume', 'premarket_volume', 'analyst_count', 'div_growth_years',
+    'revenue_growth_years_cons', 'revenue_growth_qtrs_cons', 'net_income_growth_years_cons',
+    'net_income_growth_qtrs_cons', 'eps_growth_years_cons', 'eps_growth_qtrs_cons', 'piotroski_f_score'
+]
+SCREENER_ENUM_COLUMNS = ['sector', 'market_cap_group', 'analyst_rating', 'exchange']
+SCREENER_COLUMN_TYPES = {
+    **{col.strip(): 'DOUBLE PRECISION' for col in METRIC_MAP.values()},
+    **{col: 'TEXT' for col in SCREENER_TEXT_COLUMNS},
+    **{col: 'DATE' for col in SCREENER_DATE_COLUMNS},
+    **{col: 'BIGINT' for col in SCREENER_INTEGER_COLUMNS},
+    **{col: 'ENUM' for col in SCREENER_ENUM_COLUMNS},
+}
+
 
 class RateLimiter:
-    def __init__(self, requests_per_minute: int):
+    """
+    A thread-safe limiter that hands out request slots on one shared schedule.
+    Each caller reserves the next slot under the lock and waits for it outside the lock, so waiting threads
+    don't queue on the lock. Up to `burst` unused slots may be spent back-to-back.
+    """
+    def __init__(self, requests_per_minute: int, burst: int = 1):
         self._lock = threading.Lock()
-        self.rate = requests_per_minute / 60.0
-        self.capacity = float(requests_per_minute)
-        self.tokens = self.capacity
-        self.last_refill_time = time.monotonic()
+        self.interval = 60.0 / requests_per_minute
+        self.burst = max(1, int(burst))
+        self._next_slot = time.monotonic()
+
     def consume(self):
         with self._lock:
             now = time.monotonic()
-            elapsed = now - self.last_refill_time
-            self.tokens = min(self.capacity, self.tokens + elapsed * self.rate)
-            self.last_refill_time = now
-            if self.tokens < 1:
-                wait_time = (1 - self.tokens) / self.rate
-                logging.info(f"Rate limit reached. Waiting for {wait_time:.2f} seconds.")
-                time.sleep(wait_time)
-                self.tokens += ((time.monotonic() - self.last_refill_time) * self.rate)
-                self.last_refill_time = time.monotonic()
-            self.tokens -= 1
+            scheduled = max(self._next_slot, now)
+            slot = max(now, scheduled - (self.burst - 1) * self.interval)
+            self._next_slot = scheduled + self.interval
+        wait_time = slot - time.monotonic()
+        if wait_time > 0:
+            logging.info(f"Rate limit reached. Waiting for {wait_time:.2f} seconds.")
+            time.sleep(wait_time)
 
 
 def get_browser_headers() -> dict:
@@ -176,219 +248,857 @@ def get_browser_headers() -> dict:
     }
 
 
-def fetch_screener_batch(metric_batch: list[str], rate_limiter: RateLimiter) -> pd.DataFrame | None:
-    if not metric_batch: return None
+def fetch_screener_batch(metric_batch: list[str], rate_limiter: RateLimiter) -> tuple[pd.DataFrame | None, int | None]:
+    """Returns the batch's frame (or None) and the HTTP status code (None if no response was received)."""
+    if not metric_batch: return None, None
     batch_string = "+".join(metric_batch)
     url = f"https://stockanalysis.com/api/screener/s/bd/{batch_string}.json"
+    status_code = None
     try:
         rate_limiter.consume()
         logging.info(f"Requesting batch of {len(metric_batch)} metrics starting with '{metric_batch[0]}'...")
         response = requests.get(url, headers=get_browser_headers(), timeout=90)
+        status_code = response.status_code
         response.raise_for_status()
         data = response.json().get('data', {}).get('data', {})
         if not data:
             logging.warning(f"No data returned for batch starting with '{metric_batch[0]}'.")
-            return None
+            return None, status_code
         df = pd.DataFrame.from_dict(data, orient='index')
         df.index.name = 'symbol'
-        return df
+        return df, status_code
     except Exception as e:
         logging.error(f"An unexpected error occurred processing batch '{metric_batch[0]}': {e}")
+        return None, status_code
+
+
+def load_learned_batch_size() -> int | None:
+    """Returns the batch size accepted by the endpoint on a previous run, if one was recorded."""
+    try:
+        with open(SCREENER_BATCH_SIZE_CACHE, encoding="utf-8") as f:
+            return int(json.load(f)['batch_size'])
+    except (OSError, ValueError, KeyError, TypeError):
         return None
 
 
-def create_and_load_vertical_table(df_wide: pd.DataFrame, conn):
+def save_learned_batch_size(batch_size: int):
+    with open(SCREENER_BATCH_SIZE_CACHE, 'w', encoding="utf-8") as f:
+        json.dump({'batch_size': batch_size, 'updated': datetime.now().isoformat(timespec='seconds')}, f)
+
+
+def plan_screener_batches(metrics: list[str], batch_size: int) -> list[list[str]]:
+    """Packs metrics into the fewest batches of at most batch_size, with sizes evened out across them."""
+    if not metrics:
+        return []
+    n_batches = -(-len(metrics) // batch_size)
+    base, extra = divmod(len(metrics), n_batches)
+    batches, start = [], 0
+    for i in range(n_batches):
+        end = start + base + (1 if i < extra else 0)
+        batches.append(metrics[start:end])
+        start = end
+    return batches
+
+
+def fetch_screener_metrics(metrics: list[str], rate_limiter: RateLimiter) -> list[pd.DataFrame]:
     """
-    Melts the wide-format DataFrame into a long-format vertical table and loads it to the database.
-    Identifier columns (id_vars) are explicitly defined to ensure stability.
+    Fetches every metric in as few requests as the endpoint allows.
+
+    Probe phase: batches are sent one at a time, starting at the last accepted batch size and doubling after
+    every fully answered request up to MAX_METRICS_PER_BATCH. A batch rejected as too large is halved and
+    sent again until one is accepted, which ends the probe; so does a response missing some of its metrics
+    or any other failure. Probe responses are kept, so probing costs no extra requests.
+    Fetch phase: the remaining metrics are packed into the fewest batches of the probed size and fetched
+    concurrently on the limiter's schedule; only metrics missing from a response are retried, repacked,
+    for up to BATCH_RETRY_ROUNDS further rounds, with the batch size halved again after a too-large rejection.
+    Only a batch size the endpoint actually accepted is remembered for the next run.
     """
-    if df_wide.empty:
-        logging.warning("Wide DataFrame is empty. Skipping vertical table creation.")
+    started = time.monotonic()
+    batch_size = min(load_learned_batch_size() or METRICS_PER_BATCH, MAX_METRICS_PER_BATCH)
+    accepted_size = None  # Largest batch the endpoint answered on this run
+    size_rejected = False
+    pending = list(metrics)
+    frames = []
+    request_count = 0
+
+    def receive(batch, df):
+        nonlocal pending
+        returned = set() if df is None else set(batch).intersection(df.columns)
+        if df is not None and not df.empty:
+            frames.append(df)
+        pending = [metric for metric in pending if metric not in returned]
+        return len(returned)
+
+    while pending:
+        probe = pending[:batch_size]
+        df, status_code = fetch_screener_batch(probe, rate_limiter)
+        request_count += 1
+        if status_code in TOO_LARGE_STATUS_CODES and len(probe) > 1:
+            batch_size = max(1, len(probe) // 2)
+            logging.info(f"Batch of {len(probe)} metrics was rejected as too large; retrying with {batch_size}.")
+            size_rejected = True
+            continue
+        if status_code != 200:
+            break
+        accepted_size = max(accepted_size or 0, len(probe))
+        returned = receive(probe, df)
+        if returned < len(probe):
+            # A few missing metrics are retried later; an answer missing most of them looks like a column cap.
+            if 0 < returned < len(probe) // 2:
+                batch_size = returned
+            break
+        if size_rejected or len(probe) < batch_size or batch_size >= MAX_METRICS_PER_BATCH:
+            break
+        batch_size = min(batch_size * 2, MAX_METRICS_PER_BATCH)
+    logging.info(f"Batch size probe settled on {batch_size} metrics per request.")
+
+    for retry_round in range(BATCH_RETRY_ROUNDS + 1):
+        if not pending:
+            break
+        metric_batches = plan_screener_batches(pending, batch_size)
+        logging.info(f"Round {retry_round}: fetching {len(pending)} metrics in {len(metric_batches)} batches.")
+        rejected_sizes = []
+        with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+            future_to_batch = {executor.submit(fetch_screener_batch, batch, rate_limiter): batch for batch in metric_batches}
+            for future in concurrent.futures.as_completed(future_to_batch):
+                batch = future_to_batch[future]
+                df, status_code = future.result()
+                if status_code == 200:
+                    accepted_size = max(accepted_size or 0, len(batch))
+                elif status_code in TOO_LARGE_STATUS_CODES:
+                    rejected_sizes.append(len(batch))
+                receive(batch, df)
+        request_count += len(metric_batches)
+        if rejected_sizes and min(rejected_sizes) > 1:
+            batch_size = max(1, min(rejected_sizes) // 2)
+            logging.info(f"{len(rejected_sizes)} batches were rejected as too large; using batches of {batch_size}.")
+
+    if accepted_size is not None:
+        save_learned_batch_size(min(batch_size, accepted_size))
+
+    if pending:
+        logging.warning(f"{len(pending)} metrics could not be fetched: {pending}")
+    logging.info(f"Screener refresh fetched {len(metrics) - len(pending)} of {len(metrics)} metrics in {request_count} requests "
+                 f"(batch size {batch_size}) in {time.monotonic() - started:.1f}s.")
+    return frames
+
+
+def screener_column_type(col: str, series: pd.Series) -> str:
+    """Returns the registered storage type of a column, or the inferred fallback for unregistered ones."""
+    if col in SCREENER_COLUMN_TYPES:
+        return SCREENER_COLUMN_TYPES[col]
+    return 'DOUBLE PRECISION' if pd.api.types.is_numeric_dtype(series.dtype) else 'TEXT'
+
+
+def to_screener_text(series: pd.Series) -> pd.Series:
+    """Text form of a column; list values (e.g. tags) are written as Postgres array literals, as before."""
+    def as_text(value):
+        if isinstance(value, (list, tuple)):
+            return '{' + ','.join(map(str, value)) + '}'
+        return str(value)
+    return series.astype(object).where(series.notna(), None).map(lambda v: v if v is None else as_text(v))
+
+
+def apply_screener_schema(df: pd.DataFrame, type_overrides: dict[str, str] | None = None) -> tuple[pd.DataFrame, list[tuple[str, str]]]:
+    """
+    Converts every column to its registered storage type (or the type given in type_overrides, e.g. the
+    type a history table already has), one vectorized conversion per column.
+    Returns the typed frame and its [(column, pg_type)] schema in column order.
+    """
+    typed_columns = {}
+    table_columns = []
+    for col in df.columns:
+        series = df[col]
+        pg_type = (type_overrides or {}).get(col) or screener_column_type(col, series)
+        if pg_type in ('DOUBLE PRECISION', 'BIGINT'):
+            try:
+                numeric = pd.to_numeric(series, errors='coerce')
+            except TypeError:  # Lists or dicts where a number was expected
+                numeric = pd.to_numeric(series.map(lambda v: v if isinstance(v, (int, float, str)) else None), errors='coerce')
+            numeric = numeric.astype('float64')
+            typed_columns[col] = numeric.round().astype('Int64') if pg_type == 'BIGINT' else numeric
+        elif pg_type == 'DATE':
+            typed_columns[col] = pd.to_datetime(series, errors='coerce', format='ISO8601')
+        elif pg_type == 'ENUM':
+            typed_columns[col] = to_screener_text(series).astype('category')
+        else:
+            typed_columns[col] = to_screener_text(series)
+        table_columns.append((col, pg_type))
+    return pd.DataFrame(typed_columns, index=df.index), table_columns
+
+
+def enum_type_name(col: str) -> str:
+    return f'"{SCHEMA_NAME}"."screener_{col}"'
+
+
+def build_column_definitions(table_columns: list[tuple[str, str]]) -> str:
+    return ', '.join(f'"{col}" {enum_type_name(col) if pg_type == "ENUM" else pg_type}' for col, pg_type in table_columns)
+
+
+def ensure_screener_enum_types(df_typed: pd.DataFrame, conn):
+    """Creates the enum type of every ENUM column if needed and adds any values not seen before."""
+    with conn.cursor() as cursor:
+        for col in SCREENER_ENUM_COLUMNS:
+            if col not in df_typed.columns:
+                continue
+            cursor.execute("""
+                SELECT 1 FROM pg_type t JOIN pg_namespace n ON n.oid = t.typnamespace
+                WHERE n.nspname = %s AND t.typname = %s;
+            """, (SCHEMA_NAME, f"screener_{col}"))
+            if cursor.fetchone() is None:
+                cursor.execute(f"CREATE TYPE {enum_type_name(col)} AS ENUM ();")
+            for value in sorted(df_typed[col].cat.categories):
+                cursor.execute(f"ALTER TYPE {enum_type_name(col)} ADD VALUE IF NOT EXISTS %s;", (value,))
+    # New enum values only become usable once committed.
+    conn.commit()
+
+
+def serialize_for_copy(df: pd.DataFrame, table_columns: list[tuple[str, str]]) -> io.StringIO:
+    """
+    Converts a typed DataFrame into a tab-delimited COPY buffer one column at a time; rows are only
+    touched once at the end, when the pre-formatted fields are joined into lines.
+    """
+    buffer = io.StringIO()
+    if df.empty:
+        return buffer
+
+    encoded_columns = []
+    for col, pg_type in table_columns:
+        series = df[col]
+        if pg_type in ('DOUBLE PRECISION', 'BIGINT', 'INTEGER', 'SMALLINT'):
+            numeric = series.to_numpy(dtype='float64', na_value=np.nan)
+            null_mask = ~np.isfinite(numeric)
+            if pg_type == 'DOUBLE PRECISION':
+                values = np.where(null_mask, 0.0, numeric).tolist()
+            else:
+                values = np.where(null_mask, 0, numeric).astype('int64').tolist()
+            text = np.array(list(map(str, values)), dtype=object)
+        elif pg_type == 'DATE':
+            null_mask = series.isna().to_numpy()
+            text = series.dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+        else:
+            series = series.astype(object)
+            null_mask = series.isna().to_numpy()
+            text = (series.astype(str)
+                    .str.replace('\\', '\\\\', regex=False)
+                    .str.replace('\t', '\\t', regex=False)
+                    .str.replace('\n', '\\n', regex=False)
+                    .str.replace('\r', '\\r', regex=False)
+                    .to_numpy(dtype=object))
+        text[null_mask] = '\\N'
+        encoded_columns.append(text)
+
+    buffer.write('\n'.join(map('\t'.join, zip(*encoded_columns))))
+    buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_dataframe(cursor, df: pd.DataFrame, full_table_name: str, table_columns: list[tuple[str, str]]):
+    """Bulk-loads a typed DataFrame with COPY, using the schema for column order."""
+    columns = ', '.join(f'"{col}"' for col, _ in table_columns)
+    cursor.copy_expert(f"COPY {full_table_name} ({columns}) FROM STDIN;", serialize_for_copy(df, table_columns))
+
+
+PG_TYPE_NAMES = {'double precision': 'DOUBLE PRECISION', 'bigint': 'BIGINT', 'date': 'DATE', 'text': 'TEXT'}
+
+
+def fetch_table_column_types(cursor, table_name: str) -> dict[str, str]:
+    """Returns {column: pg_type} of an existing table in schema order, in the registry's type names; {} if it doesn't exist."""
+    cursor.execute("""
+        SELECT a.attname, pg_catalog.format_type(a.atttypid, a.atttypmod), t.typtype
+        FROM pg_catalog.pg_attribute a
+        JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
+        JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
+        JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
+        ORDER BY a.attnum;
+    """, (SCHEMA_NAME, table_name))
+    return {name: 'ENUM' if typtype == 'e' else PG_TYPE_NAMES.get(type_name, type_name.upper())
+            for name, type_name, typtype in cursor.fetchall()}
+
+
+def drop_table_or_view(cursor, relation_name: str):
+    """Drops a relation whether it is currently a table or a view, since the name switches with SNAPSHOT_MODE."""
+    cursor.execute("""
+        SELECT c.relkind FROM pg_catalog.pg_class c JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s;
+    """, (SCHEMA_NAME, relation_name))
+    row = cursor.fetchone()
+    if row is None:
         return
+    kind = {'v': 'VIEW', 'm': 'MATERIALIZED VIEW'}.get(row[0], 'TABLE')
+    cursor.execute(f'DROP {kind} "{SCHEMA_NAME}"."{relation_name}" CASCADE;')
 
-    full_vertical_table_name = f'"{SCHEMA_NAME}"."{VERTICAL_TABLE_NAME}"'
-    logging.info(f"Starting creation of vertical table: {full_vertical_table_name}")
 
-    id_vars = [
-        'symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 'analyst_rating', 'ma50_vs_200d',
-        'country', 'exchange', 'sic_code', 'cik_code', 'isin', 'cusip', 'website', 'founded', 'ipo_date',
-        'in_index', 'ath_date', 'atl_date', 'payout_frequency', 'earnings_date', 'last_earnings_date',
-        'next_earnings_date', 'earnings_time', 'last_split_date', 'last_split_type', 'tags'
-    ]
-    id_vars = [col for col in id_vars if col in df_wide.columns]
-    
-    logging.info(f"Using {len(id_vars)} explicitly defined columns as identifiers for the melt operation.")
+def replace_snapshot_partition(conn, history_table: str, df: pd.DataFrame, table_columns: list[tuple[str, str]],
+                               snapshot_date: str, key_columns: list[str] | None = None):
+    """
+    Stores one snapshot as the snapshot_date partition of a history table partitioned by day, creating the
+    history table on first use and adding any new columns to it. The partition is built and filled as a
+    standalone table and only then attached, so readers are never blocked by the load; re-running a day
+    replaces that day's partition.
+    """
+    full_history_name = f'"{SCHEMA_NAME}"."{history_table}"'
+    partition_name = f"{history_table}_{snapshot_date.replace('-', '')}"
+    full_partition_name = f'"{SCHEMA_NAME}"."{partition_name}"'
+    full_staging_name = f'"{SCHEMA_NAME}"."{partition_name}_new"'
+    day = date.fromisoformat(snapshot_date)
+    next_day = day + timedelta(days=1)
+    snapshot_columns = [('snapshot_date', 'DATE')] + table_columns
 
-    df_long = pd.melt(df_wide, id_vars=id_vars, var_name='screener_metric', value_name='metric_value')
-    
-    df_long.dropna(subset=['metric_value'], inplace=True)
-    df_long['metric_value'] = pd.to_numeric(df_long['metric_value'], errors='coerce')
-    df_long.dropna(subset=['metric_value'], inplace=True)
+    with conn.cursor() as cursor:
+        primary_key = ''
+        if key_columns:
+            primary_key = ', PRIMARY KEY (' + ', '.join(f'"{col}"' for col in ['snapshot_date'] + key_columns) + ')'
+        cursor.execute(f'CREATE TABLE IF NOT EXISTS {full_history_name} ({build_column_definitions(snapshot_columns)}'
+                       f'{primary_key}) PARTITION BY RANGE ("snapshot_date");')
+        existing_columns = fetch_table_column_types(cursor, history_table)
+        for col, pg_type in table_columns:
+            if col not in existing_columns:
+                cursor.execute(f'ALTER TABLE {full_history_name} ADD COLUMN {build_column_definitions([(col, pg_type)])};')
 
-    final_column_order = [
-        'analyst_rating','symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 
-        'screener_metric', 'metric_value','ma50_vs_200d', 'country', 'founded', 'ipo_date', 
-        'ath_date', 'atl_date', 'exchange', 'in_index', 'payout_frequency', 
-        'earnings_date', 'last_earnings_date', 'next_earnings_date', 'earnings_time', 
-        'last_split_date', 'last_split_type', 'tags', 'sic_code', 'cik_code', 'isin', 
-        'cusip', 'website'
+        cursor.execute(f"DROP TABLE IF EXISTS {full_staging_name};")
+        cursor.execute(f"CREATE TABLE {full_staging_name} (LIKE {full_history_name} INCLUDING DEFAULTS);")
+        # Matches the partition bound, so ATTACH can skip scanning the rows it was just given.
+        cursor.execute(f'ALTER TABLE {full_staging_name} ADD CONSTRAINT "{partition_name}_bound" '
+                       f'CHECK ("snapshot_date" IS NOT NULL AND "snapshot_date" >= %s AND "snapshot_date" < %s);', (day, next_day))
+        snapshot_df = df.assign(snapshot_date=pd.Timestamp(day))
+        copy_dataframe(cursor, snapshot_df, full_staging_name, snapshot_columns)
+
+        cursor.execute(f"DROP TABLE IF EXISTS {full_partition_name};")
+        cursor.execute(f'ALTER TABLE {full_staging_name} RENAME TO "{partition_name}";')
+        cursor.execute(f"ALTER TABLE {full_history_name} ATTACH PARTITION {full_partition_name} FOR VALUES FROM (%s) TO (%s);",
+                       (day, next_day))
+    conn.commit()
+    logging.info(f"Stored {len(df)} rows as snapshot {snapshot_date} of {full_history_name}.")
+
+
+def create_latest_snapshot_view(conn, view_name: str, history_table: str):
+    """Points view_name at the latest snapshot of a history table, with the columns of the original table."""
+    full_view_name = f'"{SCHEMA_NAME}"."{view_name}"'
+    full_history_name = f'"{SCHEMA_NAME}"."{history_table}"'
+    with conn.cursor() as cursor:
+        columns = [col for col in fetch_table_column_types(cursor, history_table) if col != 'snapshot_date']
+        # Recreated rather than replaced: the column list can change, and the summary view built on it is rebuilt anyway.
+        drop_table_or_view(cursor, view_name)
+        cursor.execute(f"""
+            CREATE VIEW {full_view_name} AS
+            SELECT {', '.join(f'"{col}"' for col in columns)}
+            FROM {full_history_name}
+            WHERE "snapshot_date" = (SELECT max("snapshot_date") FROM {full_history_name});
+        """)
+    conn.commit()
+    logging.info(f"{full_view_name} now shows the latest snapshot of {full_history_name}.")
+
+
+VERTICAL_ID_COLUMNS = [
+    'symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 'analyst_rating', 'ma50_vs_200d',
+    'country', 'exchange', 'sic_code', 'cik_code', 'isin', 'cusip', 'website', 'founded', 'ipo_date',
+    'in_index', 'ath_date', 'atl_date', 'payout_frequency', 'earnings_date', 'last_earnings_date',
+    'next_earnings_date', 'earnings_time', 'last_split_date', 'last_split_type', 'tags'
+]
+
+VERTICAL_COLUMN_ORDER = [
+    'analyst_rating','symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 
+    'screener_metric', 'metric_value','ma50_vs_200d', 'country', 'founded', 'ipo_date', 
+    'ath_date', 'atl_date', 'exchange', 'in_index', 'payout_frequency', 
+    'earnings_date', 'last_earnings_date', 'next_earnings_date', 'earnings_time', 
+    'last_split_date', 'last_split_type', 'tags', 'sic_code', 'cik_code', 'isin', 
+    'cusip', 'website'
+]
+
+
+def ensure_dimension_ids(cursor, dim_table: str, key_column: str, id_column: str, id_type: str, keys: list[str]) -> dict[str, int]:
+    """
+    Returns {key: id} from a persistent id dimension, creating the table and adding unseen keys first.
+    Ids are never reassigned, so fact rows from different snapshots stay comparable.
+    """
+    full_dim_name = f'"{SCHEMA_NAME}"."{dim_table}"'
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {full_dim_name} (
+            "{id_column}" {id_type} GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            "{key_column}" TEXT NOT NULL UNIQUE
+        );
+    """)
+    # Only missing keys are inserted, so the identity sequence is not consumed by keys that already have an id.
+    cursor.execute(f"""
+        INSERT INTO {full_dim_name} ("{key_column}")
+        SELECT k FROM unnest(%s::text[]) AS k
+        WHERE NOT EXISTS (SELECT 1 FROM {full_dim_name} d WHERE d."{key_column}" = k)
+        ON CONFLICT ("{key_column}") DO NOTHING;
+    """, (keys,))
+    cursor.execute(f'SELECT "{key_column}", "{id_column}" FROM {full_dim_name} WHERE "{key_column}" = ANY(%s);', (keys,))
+    return dict(cursor.fetchall())
+
+
+def ensure_company_dimension(cursor):
+    """
+    Creates the shared company dimension if needed. If it is still empty and the screener's earlier
+    symbol-only dimension exists, its ids are carried over so stored fact rows keep resolving.
+    """
+    full_dim_name = f'"{SCHEMA_NAME}"."{SYMBOL_DIM_TABLE_NAME}"'
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {full_dim_name} (
+            "symbol_id" INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            "symbol" TEXT NOT NULL UNIQUE CHECK ("symbol" = lower("symbol")),
+            {', '.join(f'"{col}" TEXT' for col in COMPANY_DIMENSION_COLUMNS)},
+            "updated_at" TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """)
+    cursor.execute("SELECT to_regclass(%s) IS NOT NULL;", (f'"{SCHEMA_NAME}"."{LEGACY_SYMBOL_DIM_TABLE_NAME}"',))
+    if not cursor.fetchone()[0]:
+        return
+    cursor.execute(f"SELECT NOT EXISTS (SELECT 1 FROM {full_dim_name});")
+    if cursor.fetchone()[0]:
+        cursor.execute(f"""
+            INSERT INTO {full_dim_name} ("symbol_id", "symbol")
+            SELECT "symbol_id", lower("symbol") FROM "{SCHEMA_NAME}"."{LEGACY_SYMBOL_DIM_TABLE_NAME}";
+        """)
+        cursor.execute(f"""SELECT setval(pg_get_serial_sequence('{full_dim_name}', 'symbol_id'),
+                                         (SELECT COALESCE(max("symbol_id"), 0) + 1 FROM {full_dim_name}), false);""")
+        cursor.execute(f'DROP TABLE "{SCHEMA_NAME}"."{LEGACY_SYMBOL_DIM_TABLE_NAME}";')
+        logging.info(f"Carried the ids of {LEGACY_SYMBOL_DIM_TABLE_NAME} over to {full_dim_name}.")
+    else:
+        logging.warning(f"{LEGACY_SYMBOL_DIM_TABLE_NAME} still exists but {full_dim_name} is already populated; "
+                        f"fact rows stored before the switch may not resolve to the right symbol.")
+
+
+def upsert_companies(cursor, df: pd.DataFrame) -> dict[str, int]:
+    """
+    Adds new symbols to the company dimension and refreshes the attributes of known ones from the screener
+    (a missing attribute never overwrites a known one). Returns {symbol: symbol_id} for every symbol in df.
+    """
+    ensure_company_dimension(cursor)
+    companies = df.assign(symbol=df['symbol'].astype(str).str.lower()).drop_duplicates(subset=['symbol']).sort_values('symbol')
+    attribute_columns = [col for col in COMPANY_DIMENSION_COLUMNS if col in companies.columns]
+    arrays = [companies['symbol'].tolist()] + [
+        [None if pd.isna(value) else str(value) for value in companies[col]] for col in attribute_columns
     ]
-    ordered_cols = [col for col in final_column_order if col in df_long.columns]
-    df_long = df_long[ordered_cols]
+    full_dim_name = f'"{SCHEMA_NAME}"."{SYMBOL_DIM_TABLE_NAME}"'
+    insert_columns = ', '.join(f'"{col}"' for col in ['symbol'] + attribute_columns)
+    merged_values = [f'COALESCE(EXCLUDED."{col}", d."{col}")' for col in attribute_columns]
+    update_clause = ', '.join(f'"{col}" = {merged}' for col, merged in zip(attribute_columns, merged_values))
+    if attribute_columns:
+        conflict_action = f"""DO UPDATE SET {update_clause}, "updated_at" = now()
+            WHERE ({', '.join(f'd."{col}"' for col in attribute_columns)}) IS DISTINCT FROM ({', '.join(merged_values)})"""
+    else:
+        conflict_action = "DO NOTHING"
+    cursor.execute(f"""
+        INSERT INTO {full_dim_name} AS d ({insert_columns})
+        SELECT * FROM unnest({', '.join(['%s::text[]'] * len(arrays))})
+        ON CONFLICT ("symbol") {conflict_action};
+    """, arrays)
+    cursor.execute(f'SELECT "symbol", "symbol_id" FROM {full_dim_name} WHERE "symbol" = ANY(%s);', (arrays[0],))
+    return dict(cursor.fetchall())
+
+
+def build_vertical_fact(df_wide: pd.DataFrame, value_vars: list[str], symbol_ids: dict[str, int], metric_ids: dict[str, int]) -> pd.DataFrame:
+    """
+    Builds the long (symbol_id, metric_id, metric_value) rows straight from the wide value matrix: one
+    float64 block, symbol ids repeated per row and metric ids tiled per column, keeping only finite values.
+    """
+    values = df_wide[value_vars].to_numpy(dtype='float64', na_value=np.nan).ravel()
+    row_symbol_ids = df_wide['symbol'].astype(str).str.lower().map(symbol_ids).to_numpy(dtype='int32')
+    column_metric_ids = np.array([metric_ids[col] for col in value_vars], dtype='int16')
+
+    keep = np.isfinite(values)
+    return pd.DataFrame({
+        'symbol_id': np.repeat(row_symbol_ids, len(value_vars))[keep],
+        'metric_id': np.tile(column_metric_ids, len(df_wide))[keep],
+        'metric_value': values[keep],
+    })
+
+
+def create_vertical_compatibility_view(conn, wide_source: str, fact_source: str, snapshot_history: bool):
+    """
+    (Re)creates VERTICAL_TABLE_NAME as a view joining the fact rows back to metric names and to the
+    identifier columns of the wide table, in the original vertical table's column order. With
+    snapshot_history, both sources are history tables and the view shows the latest snapshot.
+    """
+    full_view_name = f'"{SCHEMA_NAME}"."{VERTICAL_TABLE_NAME}"'
+    with conn.cursor() as cursor:
+        wide_columns = fetch_table_column_types(cursor, wide_source)
+        select_columns = []
+        for col in VERTICAL_COLUMN_ORDER:
+            if col == 'screener_metric':
+                select_columns.append('m."screener_metric"')
+            elif col == 'metric_value':
+                select_columns.append('f."metric_value"')
+            elif col in wide_columns:
+                select_columns.append(f'w."{col}"')
+
+        wide_join = 'w."symbol" = s."symbol"'
+        latest_filter = ''
+        if snapshot_history:
+            wide_join = 'w."snapshot_date" = f."snapshot_date" AND ' + wide_join
+            latest_filter = f'WHERE f."snapshot_date" = (SELECT max("snapshot_date") FROM "{SCHEMA_NAME}"."{fact_source}")'
+
+        drop_table_or_view(cursor, VERTICAL_TABLE_NAME)
+        cursor.execute(f"""
+            CREATE VIEW {full_view_name} AS
+            SELECT {', '.join(select_columns)}
+            FROM "{SCHEMA_NAME}"."{fact_source}" f
+            JOIN "{SCHEMA_NAME}"."{METRIC_DIM_TABLE_NAME}" m ON m."metric_id" = f."metric_id"
+            JOIN "{SCHEMA_NAME}"."{SYMBOL_DIM_TABLE_NAME}" s ON s."symbol_id" = f."symbol_id"
+            JOIN "{SCHEMA_NAME}"."{wide_source}" w ON {wide_join}
+            {latest_filter};
+        """)
+    conn.commit()
+    logging.info(f"{full_view_name} now joins {fact_source} back to the wide table.")
+
 
-    logging.info(f"Melted DataFrame to long format with {len(df_long)} rows and reordered columns.")
+def create_and_load_vertical_table(df_wide: pd.DataFrame, conn, column_types: dict[str, str], snapshot_date: str | None = None):
+    """
+    Loads the numeric metrics of the typed wide-format DataFrame as a long-format fact table of
+    (symbol_id, metric_id, metric_value), resolving ids through the metric dimension and the shared company
+    dimension (whose attributes are refreshed from this snapshot), then exposes it as the vertical table view. Identifier columns (id_vars) are not repeated per metric row;
+    the view reads them from the wide table. With a snapshot_date (SNAPSHOT_MODE), the rows become that
+    day's partition of the fact history table instead.
+    """
+    if df_wide.empty:
+        logging.warning("Wide DataFrame is empty. Skipping vertical table creation.")
+        return
+
+    full_fact_table_name = f'"{SCHEMA_NAME}"."{VERTICAL_FACT_TABLE_NAME}"'
+    logging.info(f"Starting creation of vertical fact table: {full_fact_table_name}")
+
+    id_vars = [col for col in VERTICAL_ID_COLUMNS if col in df_wide.columns]
+    value_vars = [col for col in df_wide.columns
+                  if col not in id_vars and column_types[col] in ('DOUBLE PRECISION', 'BIGINT')]
+    df_wide = df_wide[df_wide['symbol'].notna()]
+
+    logging.info(f"Using {len(id_vars)} explicitly defined columns as identifiers and {len(value_vars)} metrics as facts.")
+
+    fact_columns = [('symbol_id', 'INTEGER'), ('metric_id', 'SMALLINT'), ('metric_value', 'DOUBLE PRECISION')]
 
     try:
         with conn.cursor() as cursor:
-            logging.info(f"Dropping and recreating vertical table: {full_vertical_table_name}")
-            cursor.execute(f"DROP TABLE IF EXISTS {full_vertical_table_name} CASCADE;")
-            
-            final_pg_cols = []
-            for col in df_long.columns:
-                if col == 'metric_value':
-                    final_pg_cols.append(f'"{col}" NUMERIC')
-                else:
-                    final_pg_cols.append(f'"{col}" TEXT')
-
-            create_sql = f"CREATE TABLE {full_vertical_table_name} ({', '.join(final_pg_cols)});"
-            cursor.execute(create_sql)
-
-            insert_cols = [f'"{c}"' for c in df_long.columns]
-            insert_sql = f"INSERT INTO {full_vertical_table_name} ({', '.join(insert_cols)}) VALUES %s"
-            
-            psycopg2.extras.execute_values(cursor, insert_sql, list(df_long.itertuples(index=False, name=None)), page_size=500)
-            conn.commit()
-            logging.info(f"Successfully inserted {len(df_long)} rows into {full_vertical_table_name}.")
+            symbol_ids = upsert_companies(cursor, df_wide)
+            metric_ids = ensure_dimension_ids(cursor, METRIC_DIM_TABLE_NAME, 'screener_metric', 'metric_id', 'SMALLINT', value_vars)
+        conn.commit()
+
+        df_fact = build_vertical_fact(df_wide, value_vars, symbol_ids, metric_ids)
+        logging.info(f"Built {len(df_fact)} fact rows from {len(df_wide)} symbols x {len(value_vars)} metrics.")
+
+        if snapshot_date:
+            replace_snapshot_partition(conn, VERTICAL_HISTORY_TABLE_NAME, df_fact, fact_columns, snapshot_date,
+                                       key_columns=['symbol_id', 'metric_id'])
+            create_vertical_compatibility_view(conn, WIDE_HISTORY_TABLE_NAME, VERTICAL_HISTORY_TABLE_NAME, snapshot_history=True)
+            return
+
+        with conn.cursor() as cursor:
+            logging.info(f"Dropping and recreating vertical fact table: {full_fact_table_name}")
+            drop_table_or_view(cursor, VERTICAL_FACT_TABLE_NAME)
+            cursor.execute(f"CREATE TABLE {full_fact_table_name} ({build_column_definitions(fact_columns)}, "
+                           f'PRIMARY KEY ("symbol_id", "metric_id"));')
+            copy_dataframe(cursor, df_fact, full_fact_table_name, fact_columns)
+        conn.commit()
+        logging.info(f"Successfully inserted {len(df_fact)} rows into {full_fact_table_name}.")
+        create_vertical_compatibility_view(conn, WIDE_TABLE_NAME, VERTICAL_FACT_TABLE_NAME, snapshot_history=False)
     except Exception as e:
         logging.error(f"An error occurred during vertical table creation: {e}", exc_info=True)
         conn.rollback()
 
-# --- MODIFIED: Function to create the summary materialized view ---
-def create_summary_materialized_view(conn):
+SUMMARY_DIMENSIONS = ['sector', 'industry', 'market_cap_group', 'country', 'exchange', 'analyst_rating', 'ma50_vs_200d', 'tags']
+
+# Every set is implicitly grouped by screener_metric as well.
+SUMMARY_GROUPING_SETS = [
+    # 1. Grand Total for each metric
+    (),
+
+    # 2. Every single dimension by itself
+    ('sector',), ('industry',), ('market_cap_group',), ('country',), ('exchange',),
+    ('analyst_rating',), ('ma50_vs_200d',), ('tags',),
+
+    # 3. Core Hierarchy
+    ('sector', 'industry'),
+
+    # 4. Common & Requested PAIRS
+    ('sector', 'market_cap_group'), ('sector', 'analyst_rating'), ('sector', 'ma50_vs_200d'), ('sector', 'country'),
+    ('industry', 'market_cap_group'), ('industry', 'analyst_rating'), ('industry', 'ma50_vs_200d'),
+    ('market_cap_group', 'analyst_rating'), ('market_cap_group', 'ma50_vs_200d'), ('analyst_rating', 'ma50_vs_200d'),
+    ('country', 'analyst_rating'),
+
+    # 5. Common & Requested TRIPLETS
+    ('sector', 'industry', 'market_cap_group'), ('sector', 'industry', 'analyst_rating'),
+    ('sector', 'industry', 'ma50_vs_200d'), ('sector', 'market_cap_group', 'analyst_rating'),
+    ('sector', 'market_cap_group', 'ma50_vs_200d'), ('sector', 'analyst_rating', 'ma50_vs_200d'),
+    ('industry', 'market_cap_group', 'analyst_rating'),
+
+    # 6. Requested High-Complexity Sets
+    ('sector', 'industry', 'market_cap_group', 'analyst_rating'),
+    ('sector', 'industry', 'market_cap_group', 'ma50_vs_200d'),
+    ('sector', 'industry', 'analyst_rating', 'ma50_vs_200d'),
+    ('sector', 'market_cap_group', 'analyst_rating', 'ma50_vs_200d'),
+    ('sector', 'industry', 'market_cap_group', 'analyst_rating', 'ma50_vs_200d'),
+]
+
+SUMMARY_STAT_COLUMNS = ['average', 'max_value', 'min_value', 'standard_deviation', 'median']
+
+SUMMARY_CUBE_COLUMNS = ([(dim, 'TEXT') for dim in SUMMARY_DIMENSIONS]
+                        + [('screener_metric', 'TEXT'), ('grouping_set', 'SMALLINT'), ('count_of_records', 'BIGINT')]
+                        + [(stat, 'DOUBLE PRECISION') for stat in SUMMARY_STAT_COLUMNS])
+
+
+def summary_dimension_hash(df_typed: pd.DataFrame) -> str:
     """
-    Creates a materialized view that calculates aggregate statistics based on the vertical table.
-    This version uses GROUPING SETS for powerful, multi-dimensional analysis.
+    Returns a hash of the symbol universe, every symbol's dimension columns and the grouping sets. When it
+    changes, the groups of every metric may have changed, so the whole cube has to be recomputed.
+    The frame is expected in symbol order (see refresh_summary_cube).
     """
-    full_vertical_table_name = f'"{SCHEMA_NAME}"."{VERTICAL_TABLE_NAME}"'
-    full_mv_name = f'"{SCHEMA_NAME}"."{MATERIALIZED_VIEW_NAME}"'
-    
-    logging.info(f"Creating summary materialized view: {full_mv_name}")
-
-    # --- THIS IS THE NEW, COMPREHENSIVE SQL QUERY ---
-    mv_sql = f"""
-    CREATE MATERIALIZED VIEW {full_mv_name} AS
-    WITH source_data AS (
-        SELECT
-            sector, industry, market_cap_group, country, exchange,
-            analyst_rating, ma50_vs_200d, tags,
-            screener_metric, metric_value
-        FROM {full_vertical_table_name}
-        WHERE metric_value IS NOT NULL
-    )
-    SELECT
-        sector, industry, market_cap_group, country, exchange,
-        analyst_rating, ma50_vs_200d, tags,
-        screener_metric,
-        count(metric_value) AS count_of_records,
-        COALESCE(round(avg(metric_value), 3), 0::numeric) AS average,
-        COALESCE(round(max(metric_value), 3), 0::numeric) AS max_value,
-        COALESCE(round(min(metric_value), 3), 0::numeric) AS min_value,
-        COALESCE(round(stddev_samp(metric_value), 3), 0::numeric) AS standard_deviation,
-        COALESCE(round((percentile_cont(0.5) WITHIN GROUP (ORDER BY metric_value))::numeric, 3), 0::numeric) AS median
-    FROM
-        source_data
-    GROUP BY
-        GROUPING SETS (
-            -- 1. Grand Total for each metric
-            (screener_metric),
-
-            -- 2. Every single dimension by itself
-            (screener_metric, sector),
-            (screener_metric, industry),
-            (screener_metric, market_cap_group),
-            (screener_metric, country),
-            (screener_metric, exchange),
-            (screener_metric, analyst_rating),
-            (screener_metric, ma50_vs_200d),
-            (screener_metric, tags),
-
-            -- 3. Core Hierarchy
-            (screener_metric, sector, industry),
-
-            -- 4. Common & Requested PAIRS
-            (screener_metric, sector, market_cap_group),
-            (screener_metric, sector, analyst_rating),
-            (screener_metric, sector, ma50_vs_200d),
-            (screener_metric, sector, country),
-            (screener_metric, industry, market_cap_group),
-            (screener_metric, industry, analyst_rating),
-            (screener_metric, industry, ma50_vs_200d),
-            (screener_metric, market_cap_group, analyst_rating),
-            (screener_metric, market_cap_group, ma50_vs_200d),
-            (screener_metric, analyst_rating, ma50_vs_200d),
-            (screener_metric, country, analyst_rating),
-
-            -- 5. Common & Requested TRIPLETS
-            (screener_metric, sector, industry, market_cap_group),
-            (screener_metric, sector, industry, analyst_rating),
-            (screener_metric, sector, industry, ma50_vs_200d),
-            (screener_metric, sector, market_cap_group, analyst_rating),
-            (screener_metric, sector, market_cap_group, ma50_vs_200d),
-            (screener_metric, sector, analyst_rating, ma50_vs_200d),
-            (screener_metric, industry, market_cap_group, analyst_rating),
-
-            -- 6. Requested High-Complexity Sets
-            (screener_metric, sector, industry, market_cap_group, analyst_rating),
-            (screener_metric, sector, industry, market_cap_group, ma50_vs_200d),
-            (screener_metric, sector, industry, analyst_rating, ma50_vs_200d),
-            (screener_metric, sector, market_cap_group, analyst_rating, ma50_vs_200d),
-            (screener_metric, sector, industry, market_cap_group, analyst_rating, ma50_vs_200d)
-        )
-    ORDER BY
-        sector, industry, market_cap_group, country, exchange,
-        analyst_rating, ma50_vs_200d, tags,
-        screener_metric;
+    dims = [col for col in ['symbol'] + SUMMARY_DIMENSIONS if col in df_typed.columns]
+    digest = hashlib.sha256(repr(SUMMARY_GROUPING_SETS).encode())
+    digest.update(pd.util.hash_pandas_object(df_typed[dims].astype(object), index=False).to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+def summary_metric_hashes(df_typed: pd.DataFrame, metrics: list[str]) -> dict[str, str]:
+    """
+    Returns a hash of each metric's values, row by row in symbol order. With an unchanged dimension hash,
+    a metric only needs its cube rows recomputed when its value hash changes.
+    """
+    hashes = {}
+    for metric in metrics:
+        digest = hashlib.sha256(metric.encode())
+        digest.update(df_typed[metric].to_numpy(dtype='float64', na_value=np.nan).tobytes())
+        hashes[metric] = digest.hexdigest()
+    return hashes
+
+
+def compute_summary_cube(df_typed: pd.DataFrame, metrics: list[str]) -> pd.DataFrame:
+    """
+    Computes count, average, max, min, sample standard deviation and exact median (percentile_cont(0.5))
+    of every metric for every group of every grouping set, over the finite values only.
+
+    All metrics are handled together as one (symbols x metrics) matrix. Each metric is ranked once;
+    per grouping set, one sort of (group, rank) keys puts every group's values in order, so medians are
+    read off by position instead of sorting each group separately.
+    """
+    values = df_typed[metrics].to_numpy(dtype='float64', na_value=np.nan)
+    n_rows, n_metrics = values.shape
+    finite = np.isfinite(values)
+    # Missing values sort after every finite value of their column.
+    values_for_rank = np.where(finite, values, np.inf)
+    rank_order = np.argsort(values_for_rank, axis=0, kind='stable')
+    sorted_values = np.take_along_axis(values_for_rank, rank_order, axis=0)
+    ranks = np.empty_like(rank_order)
+    np.put_along_axis(ranks, rank_order, np.arange(n_rows)[:, None], axis=0)
+
+    dim_codes, dim_labels = {}, {}
+    for dim in SUMMARY_DIMENSIONS:
+        series = df_typed[dim].astype(object) if dim in df_typed.columns else pd.Series([None] * n_rows, dtype=object)
+        # Missing values get code -1 and form their own group, as NULLs do in GROUP BY.
+        dim_codes[dim], dim_labels[dim] = pd.factorize(series)
+
+    cube_columns = {col: [] for col, _ in SUMMARY_CUBE_COLUMNS}
+    for set_index, grouping_set in enumerate(SUMMARY_GROUPING_SETS):
+        if grouping_set:
+            group_keys, group_codes = np.unique(np.column_stack([dim_codes[dim] for dim in grouping_set]),
+                                                axis=0, return_inverse=True)
+            group_codes = group_codes.ravel()
+        else:
+            group_keys, group_codes = np.zeros((1, 0), dtype='int64'), np.zeros(n_rows, dtype='int64')
+        n_groups = len(group_keys)
+        group_sizes = np.bincount(group_codes, minlength=n_groups)
+        group_starts = np.concatenate(([0], np.cumsum(group_sizes)[:-1]))
+
+        row_order = np.argsort(group_codes, kind='stable')
+        grouped_values, grouped_finite = values[row_order], finite[row_order]
+
+        counts = np.add.reduceat(grouped_finite, group_starts, axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means = np.add.reduceat(np.where(grouped_finite, grouped_values, 0.0), group_starts, axis=0) / counts
+            deviations = np.where(grouped_finite, grouped_values - np.repeat(means, group_sizes, axis=0), 0.0)
+            m2 = np.add.reduceat(deviations * deviations, group_starts, axis=0)
+            std = np.where(counts > 1, np.sqrt(m2 / np.maximum(counts - 1, 1)), 0.0)
+        maxima = np.maximum.reduceat(np.where(grouped_finite, grouped_values, -np.inf), group_starts, axis=0)
+        minima = np.minimum.reduceat(np.where(grouped_finite, grouped_values, np.inf), group_starts, axis=0)
+
+        # Within each group's segment of the sorted keys, the finite values come first and in order.
+        sorted_keys = np.sort(group_codes[:, None] * n_rows + ranks, axis=0)
+        lower_pos = group_starts[:, None] + np.maximum(counts - 1, 0) // 2
+        upper_pos = group_starts[:, None] + counts // 2
+        upper_pos = np.where(counts > 0, upper_pos, lower_pos)
+        lower_rank = np.take_along_axis(sorted_keys, lower_pos, axis=0) % n_rows
+        upper_rank = np.take_along_axis(sorted_keys, upper_pos, axis=0) % n_rows
+        medians = (np.take_along_axis(sorted_values, lower_rank, axis=0)
+                   + np.take_along_axis(sorted_values, upper_rank, axis=0)) / 2
+
+        present = (counts > 0).ravel()
+        for dim in SUMMARY_DIMENSIONS:
+            if dim in grouping_set:
+                codes = np.repeat(group_keys[:, grouping_set.index(dim)], n_metrics)[present]
+            else:
+                codes = np.full(int(present.sum()), -1)
+            cube_columns[dim].append(codes)
+        cube_columns['screener_metric'].append(np.tile(np.arange(n_metrics), n_groups)[present])
+        cube_columns['grouping_set'].append(np.full(int(present.sum()), set_index, dtype='int16'))
+        cube_columns['count_of_records'].append(counts.ravel()[present])
+        for stat, matrix in zip(SUMMARY_STAT_COLUMNS, [means, maxima, minima, std, medians]):
+            cube_columns[stat].append(matrix.ravel()[present])
+
+    # Text columns are assembled as category codes; materializing millions of label strings dominated the runtime.
+    cube = {col: np.concatenate(parts) for col, parts in cube_columns.items()}
+    for dim in SUMMARY_DIMENSIONS:
+        cube[dim] = pd.Categorical.from_codes(cube[dim], categories=pd.Index(dim_labels[dim], dtype=object))
+    cube['screener_metric'] = pd.Categorical.from_codes(cube['screener_metric'], categories=pd.Index(metrics, dtype=object))
+    return pd.DataFrame(cube)
+
+
+def create_summary_view(conn):
+    """
+    (Re)creates MATERIALIZED_VIEW_NAME as a plain view over the cube table, with the columns and rounding
+    of the GROUPING SETS materialized view it replaces.
     """
+    full_view_name = f'"{SCHEMA_NAME}"."{MATERIALIZED_VIEW_NAME}"'
+    full_cube_name = f'"{SCHEMA_NAME}"."{SUMMARY_CUBE_TABLE_NAME}"'
+    stat_columns = ',\n            '.join(f'COALESCE(round("{stat}"::numeric, 3), 0::numeric) AS {stat}' for stat in SUMMARY_STAT_COLUMNS)
+    with conn.cursor() as cursor:
+        drop_table_or_view(cursor, MATERIALIZED_VIEW_NAME)
+        cursor.execute(f"""
+            CREATE VIEW {full_view_name} AS
+            SELECT
+                {', '.join(SUMMARY_DIMENSIONS)},
+                screener_metric, grouping_set, count_of_records,
+                {stat_columns}
+            FROM {full_cube_name};
+        """)
+    conn.commit()
+
+
+def refresh_summary_cube(df_typed: pd.DataFrame, conn, column_types: dict[str, str]):
+    """
+    Brings the summary cube table up to date with the typed wide frame. If the symbol universe or any
+    symbol's dimension columns changed since the last refresh, every metric is recomputed; otherwise only
+    metrics whose values changed are recomputed and replaced. Metrics no longer present are removed.
+    """
+    full_cube_name = f'"{SCHEMA_NAME}"."{SUMMARY_CUBE_TABLE_NAME}"'
+    full_state_name = f'"{SCHEMA_NAME}"."{SUMMARY_CUBE_STATE_TABLE_NAME}"'
+    logging.info(f"Refreshing summary cube: {full_cube_name}")
+
+    # Symbol order makes the hashes independent of the order the screener returned the rows in.
+    df_typed = df_typed[df_typed['symbol'].notna()].sort_values('symbol', ignore_index=True)
+    metrics = [col for col in df_typed.columns
+               if col not in VERTICAL_ID_COLUMNS and column_types[col] in ('DOUBLE PRECISION', 'BIGINT')]
+    dimension_hash = summary_dimension_hash(df_typed)
+    metric_hashes = summary_metric_hashes(df_typed, metrics)
 
     try:
         with conn.cursor() as cursor:
-            logging.info(f"Dropping and recreating materialized view: {full_mv_name}")
-            cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {full_mv_name} CASCADE;")
-            cursor.execute(mv_sql)
-            conn.commit()
-            logging.info(f"Successfully created materialized view {full_mv_name}.")
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {full_cube_name} ({build_column_definitions(SUMMARY_CUBE_COLUMNS)});")
+            cursor.execute(f'CREATE INDEX IF NOT EXISTS "{SUMMARY_CUBE_TABLE_NAME}_grouping_key_idx" ON {full_cube_name} '
+                           f'(screener_metric, grouping_set, {", ".join(SUMMARY_DIMENSIONS)});')
+            cursor.execute(f"CREATE TABLE IF NOT EXISTS {full_state_name} (screener_metric TEXT PRIMARY KEY, content_hash TEXT NOT NULL);")
+            cursor.execute(f"SELECT screener_metric, content_hash FROM {full_state_name};")
+            previous_hashes = dict(cursor.fetchall())
+
+        dimensions_changed = previous_hashes.pop(SUMMARY_DIMENSIONS_STATE_KEY, None) != dimension_hash
+        if dimensions_changed:
+            logging.info("Symbol universe or dimension columns changed; recomputing every metric.")
+            changed = metrics
+        else:
+            changed = [metric for metric in metrics if previous_hashes.get(metric) != metric_hashes[metric]]
+        removed = [metric for metric in previous_hashes if metric not in metric_hashes]
+        if not changed and not removed:
+            logging.info("No metric changed since the last cube refresh.")
+            create_summary_view(conn)
+            return
+
+        df_cube = compute_summary_cube(df_typed, changed) if changed else pd.DataFrame(columns=[col for col, _ in SUMMARY_CUBE_COLUMNS])
+        with conn.cursor() as cursor:
+            cursor.execute(f"DELETE FROM {full_cube_name} WHERE screener_metric = ANY(%s);", (changed + removed,))
+            copy_dataframe(cursor, df_cube, full_cube_name, SUMMARY_CUBE_COLUMNS)
+            cursor.execute(f"DELETE FROM {full_state_name} WHERE screener_metric = ANY(%s);", (removed,))
+            cursor.execute(f"""
+                INSERT INTO {full_state_name} (screener_metric, content_hash)
+                SELECT unnest(%s::text[]), unnest(%s::text[])
+                ON CONFLICT (screener_metric) DO UPDATE SET content_hash = EXCLUDED.content_hash;
+            """, (changed + [SUMMARY_DIMENSIONS_STATE_KEY], [metric_hashes[metric] for metric in changed] + [dimension_hash]))
+            cursor.execute(f"ANALYZE {full_cube_name};")
+        conn.commit()
+        logging.info(f"Recomputed {len(changed)} of {len(metrics)} metrics ({len(df_cube)} cube rows), removed {len(removed)}.")
+        create_summary_view(conn)
     except Exception as e:
-        logging.error(f"An error occurred during materialized view creation: {e}", exc_info=True)
+        logging.error(f"An error occurred during the summary cube refresh: {e}", exc_info=True)
         conn.rollback()
 
 
-def main():
-    metric_batches = [
-        METRIC_ABBREVIATIONS[i:i + METRICS_PER_BATCH]
-        for i in range(0, len(METRIC_ABBREVIATIONS), METRICS_PER_BATCH)
-    ]
-    logging.info(f"Split {len(METRIC_ABBREVIATIONS)} metrics into {len(metric_batches)} batches.")
+def write_screener_snapshot(final_df: pd.DataFrame, dataset_dir: str, snapshot_date: str):
+    """
+    Writes the wide screener table as one snapshot_date partition of a Parquet dataset, replacing any
+    earlier write for the same date. Low-cardinality text columns are stored dictionary-encoded.
+    """
+    if pa is None:
+        logging.warning("pyarrow is not installed; skipping Parquet staging.")
+        return
+    staged_df = final_df.loc[:, ~final_df.columns.duplicated()].copy()
+    for col in staged_df.columns[staged_df.dtypes == object]:
+        # Screener text columns can mix numbers, strings and lists; stage them uniformly as text.
+        staged_df[col] = staged_df[col].map(lambda v: v if v is None or (isinstance(v, float) and np.isnan(v)) else str(v))
+    for col in SCREENER_DICTIONARY_COLUMNS:
+        if col in staged_df.columns:
+            staged_df[col] = staged_df[col].astype('category')
+    staged_df['snapshot_date'] = snapshot_date
+    ds.write_dataset(
+        pa.Table.from_pandas(staged_df, preserve_index=False), dataset_dir, format='parquet',
+        partitioning=['snapshot_date'], partitioning_flavor='hive',
+        existing_data_behavior='delete_matching', basename_template='part-{i}.parquet'
+    )
+    logging.info(f"Staged {len(staged_df)} screener rows for {snapshot_date} in {dataset_dir}.")
+
+
+def read_screener_snapshot(dataset_dir: str, snapshot_date: str | None = None) -> pd.DataFrame:
+    """Reads one staged screener snapshot (the latest one by default) back into a wide DataFrame."""
+    partitioning = ds.partitioning(pa.schema([('snapshot_date', pa.string())]), flavor='hive')
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=partitioning)
+    if snapshot_date is None:
+        snapshot_dates = dataset.to_table(columns=['snapshot_date']).column('snapshot_date').unique().to_pylist()
+        if not snapshot_dates:
+            logging.error(f"No staged screener snapshots found in {dataset_dir}.")
+            return pd.DataFrame()
+        snapshot_date = max(snapshot_dates)
+    df = dataset.to_table(filter=ds.field('snapshot_date') == snapshot_date).to_pandas().drop(columns=['snapshot_date'])
+    for col in df.columns[df.dtypes == 'category']:
+        df[col] = df[col].astype(object)
+    df.attrs['snapshot_date'] = snapshot_date
+    logging.info(f"Loaded staged screener snapshot {snapshot_date} with {len(df)} rows.")
+    return df
+
+
+def consolidate_screener_batches(batch_dfs: list[pd.DataFrame]) -> pd.DataFrame:
+    """
+    Combines the metric batches into one wide frame with a single concat over a shared, pre-aligned index.
+    Columns repeated across batches (e.g. name/sector) are taken from the first batch that has them, which is
+    decided from the column labels alone, before any data is copied. Each batch keeps the dtypes inferred
+    when its response was parsed.
+    """
+    seen_columns = set()
+    pieces = []
+    for df_batch in batch_dfs:
+        new_columns = [col for col in dict.fromkeys(df_batch.columns) if col not in seen_columns]
+        seen_columns.update(new_columns)
+        if new_columns:
+            pieces.append(df_batch if len(new_columns) == df_batch.shape[1] else df_batch.loc[:, new_columns])
+
+    # One union over every batch's symbols, sorted like the outer joins this replaces.
+    symbols = pieces[0].index.append([piece.index for piece in pieces[1:]]).unique().sort_values()
+    aligned = [piece if piece.index.equals(symbols) else piece.reindex(symbols) for piece in pieces]
+
+    return pd.concat(aligned, axis=1) if len(aligned) > 1 else aligned[0]
 
-    rate_limiter = RateLimiter(REQUESTS_PER_MINUTE)
-    all_dfs = []
-    with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
-        future_to_batch = {executor.submit(fetch_screener_batch, batch, rate_limiter): batch for batch in metric_batches}
-        for future in concurrent.futures.as_completed(future_to_batch):
-            df_batch = future.result()
-            if df_batch is not None and not df_batch.empty:
-                all_dfs.append(df_batch)
+
+def fetch_screener_snapshot() -> pd.DataFrame | None:
+    """Fetches every metric batch and consolidates them into the ordered wide screener table."""
+    rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, burst=REQUEST_BURST)
+    all_dfs = fetch_screener_metrics(METRIC_ABBREVIATIONS, rate_limiter)
 
     if not all_dfs:
         logging.error("No data was fetched. Exiting script.")
-        return
+        return None
 
     logging.info("Consolidating all fetched data...")
-    final_df = all_dfs[0]
-    if len(all_dfs) > 1:
-        for df_batch in all_dfs[1:]:
-            final_df = final_df.join(df_batch, how='outer')
-
-    final_df = final_df.loc[:, ~final_df.columns.duplicated()]
+    final_df = consolidate_screener_batches(all_dfs)
     final_df.reset_index(inplace=True)
     
     # --- THIS IS THE CHANGE YOU REQUESTED ---
@@ -452,61 +1162,58 @@ def main():
     final_df = final_df[ordered_cols + remaining_cols]
 
     logging.info(f"Final table has {final_df.shape[0]} rows and {final_df.shape[1]} columns.")
+    return final_df
+
 
+def load_screener_tables(final_df: pd.DataFrame, snapshot_date: str | None = None):
+    """
+    Converts the screener table to its typed schema, loads the wide table, then rebuilds the vertical
+    table and refreshes the summary cube. In SNAPSHOT_MODE the wide and vertical rows are stored as
+    the snapshot_date partitions of the history tables, and the table names become latest-snapshot views.
+    """
     conn = None
     try:
         conn = psycopg2.connect(**DB_PARAMS)
         cursor = conn.cursor()
-        
-        pg_cols = []
-        unique_columns = final_df.columns.unique().tolist()
-        
-        for col_name in unique_columns:
-            column_data = final_df[col_name]
-            if isinstance(column_data, pd.DataFrame):
-                column_series = column_data.iloc[:, 0]
+
+        snapshot_date = (snapshot_date or datetime.now().strftime('%Y-%m-%d')) if SNAPSHOT_MODE else None
+        # Columns already in the history table keep the type they were first stored with.
+        existing_types = fetch_table_column_types(cursor, WIDE_HISTORY_TABLE_NAME) if snapshot_date else {}
+        df_typed, table_columns = apply_screener_schema(final_df.loc[:, ~final_df.columns.duplicated()], existing_types)
+        ensure_screener_enum_types(df_typed, conn)
+
+        if snapshot_date:
+            replace_snapshot_partition(conn, WIDE_HISTORY_TABLE_NAME, df_typed, table_columns, snapshot_date, key_columns=['symbol'])
+            create_latest_snapshot_view(conn, WIDE_TABLE_NAME, WIDE_HISTORY_TABLE_NAME)
+            create_and_load_vertical_table(df_typed, conn, dict(table_columns), snapshot_date)
+            cursor.execute(f'SELECT max("snapshot_date") FROM "{SCHEMA_NAME}"."{WIDE_HISTORY_TABLE_NAME}";')
+            latest_snapshot = cursor.fetchone()[0]
+            if latest_snapshot and latest_snapshot.isoformat() > snapshot_date:
+                logging.info(f"Snapshot {snapshot_date} is older than the latest ({latest_snapshot}); leaving the summary cube as is.")
             else:
-                column_series = column_data
-
-            dtype = column_series.dtype
-            pg_type = "TEXT"
-            if pd.api.types.is_numeric_dtype(dtype):
-                pg_type = "NUMERIC"
-            elif pd.api.types.is_datetime64_any_dtype(dtype):
-                pg_type = "DATE"
-            
-            pg_cols.append(f'"{col_name}" {pg_type}')
-
-        if pg_cols and '"symbol"' in pg_cols[0]:
-                pg_cols[0] += " PRIMARY KEY"
-        else:
-                logging.warning("'symbol' was not the first column, PRIMARY KEY not set automatically.")
+                refresh_summary_cube(df_typed, conn, dict(table_columns))
+            return
 
+        column_definitions = build_column_definitions(table_columns)
+        if table_columns and table_columns[0][0] == 'symbol':
+            column_definitions = column_definitions.replace('"symbol" TEXT', '"symbol" TEXT PRIMARY KEY', 1)
+        else:
+            logging.warning("'symbol' was not the first column, PRIMARY KEY not set automatically.")
 
         full_table_name = f'"{SCHEMA_NAME}"."{WIDE_TABLE_NAME}"'
         logging.info(f"Dropping and recreating table: {full_table_name}")
-        cursor.execute(f"DROP TABLE IF EXISTS {full_table_name} CASCADE;")
+        drop_table_or_view(cursor, WIDE_TABLE_NAME)
         
-        create_table_sql = f"CREATE TABLE {full_table_name} ({', '.join(pg_cols)});"
+        create_table_sql = f"CREATE TABLE {full_table_name} ({column_definitions});"
         cursor.execute(create_table_sql)
-        
-        df_for_db = final_df.replace({np.nan: None, pd.NaT: None})
-        
-        df_for_db = df_for_db[unique_columns]
 
-        db_cols = [f'"{col}"' for col in df_for_db.columns]
-        
-        insert_sql = (f"INSERT INTO {full_table_name} ({', '.join(db_cols)}) VALUES %s "
-                        f"ON CONFLICT (symbol) DO UPDATE SET " + 
-                        ", ".join([f'{col} = EXCLUDED.{col}' for col in db_cols if col != '"symbol"']))
-        
-        psycopg2.extras.execute_values(cursor, insert_sql, list(df_for_db.itertuples(index=False, name=None)), page_size=250)
+        copy_dataframe(cursor, df_typed, full_table_name, table_columns)
         conn.commit()
         
-        logging.info(f"Successfully inserted/updated {len(df_for_db)} rows into {full_table_name}.")
+        logging.info(f"Successfully inserted {len(df_typed)} rows into {full_table_name}.")
         
-        create_and_load_vertical_table(final_df.copy(), conn)
-        create_summary_materialized_view(conn)
+        create_and_load_vertical_table(df_typed, conn, dict(table_columns))
+        refresh_summary_cube(df_typed, conn, dict(table_columns))
 
     except Exception as e:
         logging.error(f"A database error occurred: {e}", exc_info=True)
@@ -517,5 +1224,22 @@ def main():
             logging.info("Database connection closed.")
 
 
+def main():
+    if RELOAD_FROM_PARQUET and not (PARQUET_STAGING_DIR and ds is not None):
+        logging.error("RELOAD_FROM_PARQUET needs PARQUET_STAGING_DIR to be set and pyarrow to be installed.")
+        return
+
+    if RELOAD_FROM_PARQUET:
+        final_df = read_screener_snapshot(os.path.join(PARQUET_STAGING_DIR, "screener"))
+    else:
+        final_df = fetch_screener_snapshot()
+        if final_df is not None and PARQUET_STAGING_DIR:
+            write_screener_snapshot(final_df, os.path.join(PARQUET_STAGING_DIR, "screener"), datetime.now().strftime('%Y-%m-%d'))
+
+    if final_df is None or final_df.empty:
+        return
+    load_screener_tables(final_df, final_df.attrs.get('snapshot_date'))
+
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
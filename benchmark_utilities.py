@@ -0,0 +1,508 @@
+# --- IMPORTS ---
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import json
+import logging
+import os
+import re
+import resource
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+from functools import wraps
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlencode, urlsplit
+
+import pandas as pd
+import psycopg2
+from psycopg2 import sql
+from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
+import requests
+
+# --- CORE CONFIGURATION ---
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+FIXTURES_DIR = os.path.join(REPO_DIR, "benchmark_fixtures")  # Recorded HTTP responses, one gzipped JSON file per request
+RESULTS_DIR = os.path.join(REPO_DIR, "benchmark_results")  # One JSON file per benchmark run, compared run to run
+MAX_COMPANIES = 25  # Caps each pipeline's sector universe so a benchmark finishes in minutes
+REGRESSION_THRESHOLD = 0.10  # A stage whose wall time grows by more than this vs. the baseline is flagged
+
+# --- Throwaway Postgres Configuration ---
+# With initdb/pg_ctl on the PATH a private cluster is created in a temp directory and removed afterwards;
+# otherwise pass --db-host/--db-port/--db-user/--db-password and throwaway databases are created on that server.
+BENCH_DB_NAME = "cap_intel_bench"
+BENCH_DATALAKE_DB_NAME = "cap_intel_bench_datalake"
+BENCH_DB_USER = "postgres"
+
+# --- Fixture Matching ---
+# Secrets never take part in matching and are never written to disk.
+SECRET_QUERY_PARAMS = {"apiKey", "api_key", "apikey"}
+# Polygon and FRED requests are built from "today", so dates are masked to keep recorded fixtures matching.
+DATE_PATTERN = re.compile(r"\d{4}-\d{2}-\d{2}")
+ORIGINAL_URL_HEADER = "X-Bench-Original-Url"
+
+# Each pipeline's stages map to the script functions that make them up. Timings are exclusive: when a
+# wrapped function calls another wrapped function, the inner call's time counts toward its own stage only.
+# Calls made on other threads are not subtracted, so the screener's transform also covers waiting on its
+# fetch pool; its cpu_s is the figure to compare there.
+PIPELINES = {
+    "screener": {
+        "script": "aggregate_screener_table_all sectors.py",
+        "entry": ("main", ()),
+        "db_params": {"DB_PARAMS": BENCH_DB_NAME},
+        "universe": None,
+        "stages": {
+            "fetch": ["fetch_screener_batch"],
+            "transform": ["fetch_screener_snapshot"],
+            "load": ["load_screener_tables"],
+        },
+    },
+    "fs": {
+        "script": "fs_utilities.py",
+        "entry": ("main", ([],)),
+        "db_params": {"DB_PARAMS": BENCH_DB_NAME},
+        "universe": "fetch_companies_by_sector",
+        "stages": {
+            "fetch": ["fetch_companies_by_sector", "fetch_historical_monthly_forex_rates_fred", "plan_edgar_strategies", "fetch_company_statements",
+                      "get_company_facts_data", "fetch_stockanalysis_data", "fetch_company_profile_currency"],
+            # Covers the hand-off to the transform processes and back; the per-step split is in fs_run_metrics/.
+            "transform": ["transform_company"],
+            "load": ["create_and_insert_data", "build_aggregates_and_views"],
+        },
+    },
+    "ratios": {
+        "script": "ratios_utilities.py",
+        "entry": ("main", ()),
+        "db_params": {"DB_PARAMS": BENCH_DB_NAME},
+        "universe": "fetch_companies_by_sector",
+        "stages": {
+            "fetch": ["fetch_companies_by_sector", "fetch_financial_ratios_stockanalysis"],
+            "transform": ["process_company_worker", "parse_ratio_payload"],
+            "load": ["create_and_insert_ratio_data", "build_ratio_aggregates_and_views"],
+        },
+    },
+    "price": {
+        "script": "stock_price_history_utilities.py",
+        "entry": ("main", ()),
+        "db_params": {"DB_PARAMS": BENCH_DB_NAME},
+        "universe": "fetch_companies_by_sector",
+        "stages": {
+            "fetch": ["fetch_companies_by_sector", "fetch_historical_data_polygon"],
+            "transform": ["build_price_panel", "compute_price_indicators", "format_indicator_columns", "build_price_frame"],
+            "load": ["flush_price_batch", "seed_indicator_state"],
+        },
+    },
+    "etl": {
+        "script": "etl_code_to_cap_intel_datalake.py",
+        "entry": ("run_etl", ()),
+        "db_params": {"SOURCE_DB_PARAMS": BENCH_DB_NAME, "TARGET_DB_PARAMS": BENCH_DATALAKE_DB_NAME},
+        "universe": None,
+        "stages": {
+            "fetch": ["get_tables_and_mvs", "get_table_columns_and_types"],
+            "load": ["extract_and_load_data"],
+        },
+    },
+}
+LOAD_STAGE = "load"  # Rows for the load stage are counted from the frames passed in rather than returned
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+# ==============================================================================
+# STAGE 1: RECORDED FIXTURES AND LOCAL STUB
+# ==============================================================================
+class FixtureStore:
+    """Recorded HTTP responses on disk, keyed by method, host, path and query (secrets dropped, dates masked)."""
+    def __init__(self, fixtures_dir):
+        self.fixtures_dir = fixtures_dir
+
+    @staticmethod
+    def request_key(method, url):
+        parts = urlsplit(url)
+        query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True) if k not in SECRET_QUERY_PARAMS)
+        canonical = DATE_PATTERN.sub("<date>", f"{method} {parts.netloc}{parts.path}?{urlencode(query)}")
+        return hashlib.sha1(canonical.encode()).hexdigest()[:20], canonical
+
+    def _path(self, key):
+        return os.path.join(self.fixtures_dir, f"{key}.json.gz")
+
+    def save(self, method, url, status, content_type, body):
+        key, canonical = self.request_key(method, url)
+        os.makedirs(self.fixtures_dir, exist_ok=True)
+        with gzip.open(self._path(key), 'wt', encoding='utf-8') as f:
+            json.dump({"request": canonical, "status": status, "content_type": content_type,
+                       "body": body.decode('utf-8', 'replace')}, f)
+
+    def load(self, method, url):
+        key, _ = self.request_key(method, url)
+        if not os.path.exists(self._path(key)):
+            return None
+        with gzip.open(self._path(key), 'rt', encoding='utf-8') as f:
+            return json.load(f)
+
+
+def start_fixture_stub(store):
+    """Serves recorded fixtures from a local HTTP server. Returns the server and the list of unmatched requests."""
+    misses = []
+
+    class FixtureHandler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            original_url = self.headers.get(ORIGINAL_URL_HEADER, "")
+            fixture = store.load("GET", original_url)
+            if fixture is None:
+                misses.append(store.request_key("GET", original_url)[1])
+                status, content_type, body = 404, "application/json", b"{}"
+            else:
+                status, content_type, body = fixture["status"], fixture["content_type"] or "application/json", fixture["body"].encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", content_type)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), FixtureHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="FixtureStub", daemon=True).start()
+    return server, misses
+
+
+def route_requests(store, stub_url=None):
+    """
+    Hooks every requests call made by the scripts. With a stub URL each request is sent to the local stub
+    (carrying its original URL in a header); without one, live responses are recorded into the store.
+    """
+    original_send = requests.adapters.HTTPAdapter.send
+
+    def send(adapter, request, **kwargs):
+        if stub_url:
+            request.headers[ORIGINAL_URL_HEADER] = request.url
+            request.url = stub_url
+            return original_send(adapter, request, **kwargs)
+        response = original_send(adapter, request, **kwargs)
+        if response.status_code < 500 and response.status_code != 429:
+            store.save(request.method, request.url, response.status_code, response.headers.get("Content-Type"), response.content)
+        return response
+
+    requests.adapters.HTTPAdapter.send = send
+
+
+class NoSleepTime:
+    """Stands in for a script's `time` module so rate-limit and politeness sleeps return immediately."""
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+    @staticmethod
+    def sleep(seconds):
+        pass
+
+
+# ==============================================================================
+# STAGE 2: THROWAWAY POSTGRES
+# ==============================================================================
+def find_free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def start_throwaway_cluster(work_dir):
+    """Creates and starts a private, trust-auth Postgres cluster. Returns (server params, stop function) or None."""
+    initdb, pg_ctl = shutil.which("initdb"), shutil.which("pg_ctl")
+    if not (initdb and pg_ctl):
+        return None
+    data_dir = os.path.join(work_dir, "pgdata")
+    port = find_free_port()
+    subprocess.run([initdb, "-D", data_dir, "-U", BENCH_DB_USER, "--auth=trust", "-E", "UTF8"], check=True, capture_output=True)
+    subprocess.run([pg_ctl, "-D", data_dir, "-l", os.path.join(work_dir, "postgres.log"), "-w", "start",
+                    "-o", f"-p {port} -k {data_dir} -c listen_addresses=localhost"], check=True, capture_output=True)
+    logging.info(f"Started a throwaway Postgres cluster on port {port}.")
+
+    def stop():
+        subprocess.run([pg_ctl, "-D", data_dir, "-m", "fast", "-w", "stop"], capture_output=True)
+
+    return {"host": "localhost", "port": str(port), "user": BENCH_DB_USER, "password": ""}, stop
+
+
+def recreate_databases(server_params, db_names, drop_only=False):
+    conn = psycopg2.connect(dbname="postgres", **server_params)
+    conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+    try:
+        with conn.cursor() as cur:
+            for db_name in db_names:
+                cur.execute(sql.SQL("DROP DATABASE IF EXISTS {}").format(sql.Identifier(db_name)))
+                if not drop_only:
+                    cur.execute(sql.SQL("CREATE DATABASE {}").format(sql.Identifier(db_name)))
+    finally:
+        conn.close()
+
+
+# ==============================================================================
+# STAGE 3: STAGE TIMING INSIDE A PIPELINE PROCESS
+# ==============================================================================
+def count_rows(obj):
+    if isinstance(obj, pd.DataFrame):
+        return len(obj)
+    if isinstance(obj, (list, tuple)):
+        return sum(count_rows(item) for item in obj)
+    return 0
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux; includes finished child processes (e.g. the MV pools)
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss, resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+class StageRecorder:
+    """
+    Accumulates exclusive wall time, thread CPU time and rows per stage, plus the process's peak RSS
+    at the end of the stage's calls. CPU time of threads or processes a call starts on its own is not
+    attributed to the stage; it shows up in the pipeline's process CPU total.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stages = {}
+
+    def wrap(self, stage, func):
+        @wraps(func)
+        def timed(*args, **kwargs):
+            stack = self._local.__dict__.setdefault('stack', [])
+            nested = [0.0, 0.0]  # Wall and CPU seconds spent in wrapped calls made from this one
+            stack.append(nested)
+            result = None
+            wall_start, cpu_start = time.perf_counter(), time.thread_time()
+            try:
+                result = func(*args, **kwargs)
+                return result
+            finally:
+                wall, cpu = time.perf_counter() - wall_start, time.thread_time() - cpu_start
+                stack.pop()
+                if stack:
+                    stack[-1][0] += wall
+                    stack[-1][1] += cpu
+                rows = count_rows(args[:2]) if stage == LOAD_STAGE else count_rows(result)
+                self._add(stage, wall - nested[0], cpu - nested[1], rows)
+        return timed
+
+    def _add(self, stage, wall, cpu, rows):
+        with self._lock:
+            stats = self.stages.setdefault(stage, {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "rows": 0, "peak_rss_mb": 0.0})
+            stats["calls"] += 1
+            stats["wall_s"] += wall
+            stats["cpu_s"] += cpu
+            stats["rows"] += rows
+            stats["peak_rss_mb"] = max(stats["peak_rss_mb"], peak_rss_mb())
+
+
+def load_script_module(name, script):
+    spec = importlib.util.spec_from_file_location(f"bench_{name}", os.path.join(REPO_DIR, script))
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # Lets the scripts' multiprocessing pools find their worker functions
+    spec.loader.exec_module(module)
+    return module
+
+
+def run_pipeline(name, record, server_params, max_companies, throttle):
+    """Runs one pipeline end to end in this process and returns its measurements."""
+    pipeline = PIPELINES[name]
+    module = load_script_module(name, pipeline["script"])
+    store = FixtureStore(FIXTURES_DIR)
+    misses = []
+    if record:
+        route_requests(store)
+    else:
+        server, misses = start_fixture_stub(store)
+        route_requests(store, stub_url=f"http://127.0.0.1:{server.server_address[1]}/")
+
+    for attr, db_name in pipeline["db_params"].items():
+        setattr(module, attr, {**server_params, "database": db_name})
+    if not throttle:
+        module.time = NoSleepTime()
+    if pipeline["universe"]:
+        fetch_universe = getattr(module, pipeline["universe"])
+        setattr(module, pipeline["universe"], wraps(fetch_universe)(lambda *a, **k: fetch_universe(*a, **k).head(max_companies)))
+
+    recorder = StageRecorder()
+    for stage, func_names in pipeline["stages"].items():
+        for func_name in func_names:
+            setattr(module, func_name, recorder.wrap(stage, getattr(module, func_name)))
+
+    entry_name, entry_args = pipeline["entry"]
+    usage_before = os.times()
+    started = time.perf_counter()
+    getattr(module, entry_name)(*entry_args)
+    elapsed = time.perf_counter() - started
+    usage_after = os.times()
+
+    stages = {}
+    for stage, stats in recorder.stages.items():
+        stages[stage] = {**stats, "rows_per_s": stats["rows"] / stats["wall_s"] if stats["wall_s"] else None}
+    return {
+        "elapsed_s": elapsed,
+        "cpu_s": sum(usage_after[i] - usage_before[i] for i in range(4)),  # user + system, self + children
+        "peak_rss_mb": peak_rss_mb(),
+        "stages": stages,
+        "fixture_misses": len(misses),
+        "missed_requests": sorted(set(misses))[:20],
+    }
+
+
+# ==============================================================================
+# STAGE 4: REPORTING AND RUN-TO-RUN COMPARISON
+# ==============================================================================
+def results_to_frame(results):
+    rows = []
+    for name, pipeline in results["pipelines"].items():
+        if "error" in pipeline:
+            continue
+        for stage, stats in pipeline["stages"].items():
+            rows.append({"pipeline": name, "stage": stage, **stats})
+        rows.append({"pipeline": name, "stage": "(total)", "wall_s": pipeline["elapsed_s"], "cpu_s": pipeline["cpu_s"],
+                     "peak_rss_mb": pipeline["peak_rss_mb"]})
+    return pd.DataFrame(rows, columns=["pipeline", "stage", "calls", "wall_s", "cpu_s", "rows", "rows_per_s", "peak_rss_mb"])
+
+
+def latest_results_path(exclude=None):
+    if not os.path.isdir(RESULTS_DIR):
+        return None
+    paths = sorted(os.path.join(RESULTS_DIR, f) for f in os.listdir(RESULTS_DIR) if f.endswith(".json"))
+    paths = [p for p in paths if p != exclude]
+    return paths[-1] if paths else None
+
+
+def compare_results(current, baseline):
+    """Logs per-stage wall-time and throughput changes against a baseline run and flags regressions."""
+    current_df = results_to_frame(current).set_index(["pipeline", "stage"])
+    baseline_df = results_to_frame(baseline).set_index(["pipeline", "stage"])
+    joined = current_df[["wall_s", "rows_per_s"]].join(baseline_df[["wall_s", "rows_per_s"]], rsuffix="_baseline", how="inner")
+    if joined.empty:
+        logging.info("No pipelines in common with the baseline run.")
+        return
+    joined["wall_change"] = joined["wall_s"] / joined["wall_s_baseline"] - 1
+    joined["regression"] = joined["wall_change"] > REGRESSION_THRESHOLD
+    logging.info(f"\n--- Compared with {baseline['run_id']} ({baseline.get('git_commit')}) ---\n"
+                 + joined.round(3).to_string())
+    regressions = joined[joined["regression"]]
+    if not regressions.empty:
+        logging.warning(f"{len(regressions)} stages regressed by more than {REGRESSION_THRESHOLD:.0%}: "
+                        + ", ".join(f"{p}/{s}" for p, s in regressions.index))
+
+
+def current_git_commit():
+    result = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True)
+    return result.stdout.strip() or None
+
+
+# ==============================================================================
+# MAIN EXECUTION
+# ==============================================================================
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline benchmarks of every pipeline's fetch -> transform -> load path.")
+    parser.add_argument("--pipelines", nargs="+", choices=list(PIPELINES), default=list(PIPELINES),
+                        help="Pipelines to run, in order (default: all; etl copies what the others loaded).")
+    parser.add_argument("--record", action="store_true",
+                        help="Hit the live APIs (throttled) and record their responses as fixtures instead of replaying them.")
+    parser.add_argument("--max-companies", type=int, default=MAX_COMPANIES)
+    parser.add_argument("--throttle", action="store_true", help="Keep the scripts' rate-limit sleeps when replaying.")
+    parser.add_argument("--compare", metavar="RESULTS_JSON", help="Baseline results file (default: the previous run).")
+    parser.add_argument("--db-host", help="Use this Postgres server instead of a private cluster.")
+    parser.add_argument("--db-port", default="5432")
+    parser.add_argument("--db-user", default=BENCH_DB_USER)
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--keep-work-dir", action="store_true")
+    # Internal: run a single pipeline in a fresh process so its CPU and peak RSS are its own.
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    parser.add_argument("--child-output", help=argparse.SUPPRESS)
+    parser.add_argument("--server-json", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def run_child(args):
+    result = run_pipeline(args.child, args.record, json.loads(args.server_json), args.max_companies, args.throttle or args.record)
+    with open(args.child_output, "w") as f:
+        json.dump(result, f)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    if args.child:
+        run_child(args)
+        return
+
+    work_dir = tempfile.mkdtemp(prefix="cap_intel_bench_")
+    stop_cluster = None
+    if args.db_host:
+        server_params = {"host": args.db_host, "port": args.db_port, "user": args.db_user, "password": args.db_password}
+    else:
+        cluster = start_throwaway_cluster(work_dir)
+        if cluster is None:
+            logging.error("initdb/pg_ctl not found on the PATH; pass --db-host to use an existing server.")
+            return
+        server_params, stop_cluster = cluster
+
+    results = {
+        "run_id": datetime.now().strftime('%Y%m%dT%H%M%S'),
+        "git_commit": current_git_commit(),
+        "mode": "record" if args.record else "replay",
+        "max_companies": args.max_companies,
+        "throttle": args.throttle or args.record,
+        "pipelines": {},
+    }
+    try:
+        recreate_databases(server_params, [BENCH_DB_NAME, BENCH_DATALAKE_DB_NAME])
+        for name in args.pipelines:
+            logging.info(f"--- Running pipeline '{name}' ({results['mode']}) ---")
+            output_path = os.path.join(work_dir, f"{name}.json")
+            command = [sys.executable, os.path.abspath(__file__), "--child", name, "--child-output", output_path,
+                       "--server-json", json.dumps(server_params), "--max-companies", str(args.max_companies)]
+            command += ["--record"] * args.record + ["--throttle"] * args.throttle
+            log_path = os.path.join(work_dir, f"{name}.log")
+            with open(log_path, "w") as log_file:
+                completed = subprocess.run(command, cwd=work_dir, stdout=log_file, stderr=subprocess.STDOUT)
+            if completed.returncode != 0 or not os.path.exists(output_path):
+                logging.error(f"Pipeline '{name}' failed (exit code {completed.returncode}); see {log_path}.")
+                results["pipelines"][name] = {"error": completed.returncode, "log": log_path}
+                continue
+            with open(output_path) as f:
+                results["pipelines"][name] = json.load(f)
+            if results["pipelines"][name]["fixture_misses"]:
+                logging.warning(f"Pipeline '{name}' made {results['pipelines'][name]['fixture_misses']} requests with no "
+                                f"recorded fixture; re-record with --record. First few: {results['pipelines'][name]['missed_requests'][:3]}")
+    finally:
+        if stop_cluster:
+            stop_cluster()
+        elif args.db_host:
+            recreate_databases(server_params, [BENCH_DB_NAME, BENCH_DATALAKE_DB_NAME], drop_only=True)
+        if not args.keep_work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary_df = results_to_frame(results)
+    if not summary_df.empty:
+        logging.info("\n--- Benchmark results ---\n" + summary_df.round(3).to_string(index=False))
+    if args.record:
+        logging.info(f"Fixtures recorded to {FIXTURES_DIR}; timings from a recording run are not stored.")
+        return
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    results_path = os.path.join(RESULTS_DIR, f"{results['run_id']}.json")
+    with open(results_path, "w") as f:
+        json.dump(results, f, indent=2)
+    logging.info(f"Results written to {results_path}.")
+
+    baseline_path = args.compare or latest_results_path(exclude=results_path)
+    if baseline_path:
+        with open(baseline_path) as f:
+            compare_results(results, json.load(f))
+
+
+if __name__ == "__main__":
+    main()
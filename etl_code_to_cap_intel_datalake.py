@@ -84,8 +84,11 @@ def get_table_columns_and_types(conn, schema_name, table_name):
     with conn.cursor() as cursor:
         try:
             query = sql.SQL("""
-                SELECT a.attname AS column_name, pg_catalog.format_type(a.atttypid, a.atttypmod) AS data_type
+                SELECT a.attname AS column_name,
+                       -- Enum types exist only in the source database, so their columns are copied as text.
+                       CASE WHEN t.typtype = 'e' THEN 'text' ELSE pg_catalog.format_type(a.atttypid, a.atttypmod) END AS data_type
                 FROM pg_catalog.pg_attribute a
+                JOIN pg_catalog.pg_type t ON t.oid = a.atttypid
                 JOIN pg_catalog.pg_class c ON c.oid = a.attrelid
                 JOIN pg_catalog.pg_namespace n ON n.oid = c.relnamespace
                 WHERE n.nspname = %s AND c.relname = %s AND a.attnum > 0 AND NOT a.attisdropped
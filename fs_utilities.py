@@ -1,11 +1,22 @@
 # --- IMPORTS ---
+import argparse
 import concurrent.futures
+import hashlib
+import io
+import json
 import logging
+import mmap
 import multiprocessing
+import os
 import random
 import re
 import threading
 import time
+import zipfile
+import zlib
+from multiprocessing import shared_memory
+from collections import Counter, defaultdict
+from contextlib import contextmanager
 from datetime import datetime
 from functools import partial
 
@@ -14,9 +25,14 @@ import pandas as pd
 import psycopg2
 from psycopg2 import sql
 from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from psycopg2.extras import execute_values
 import requests
 
+try:  # Parquet staging is optional; everything else works without pyarrow.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
+
 # --- CORE CONFIGURATION ---
 SECTOR_TO_PROCESS = "Utilities"
 SCHEMA_NAME = "fs"
@@ -33,6 +49,59 @@ DB_PARAMS = {
     "port": "5433"
 }
 MAX_WORKERS = 15  # IMPORTANT: Reduced to a safer number for multiple rate-limited APIs
+# "upsert" keeps each company table in place and applies only the diff from a staging table;
+# "replace" drops and recreates the table on every run (the original behaviour).
+REFRESH_MODE = "upsert"
+
+# --- PARQUET STAGING CONFIGURATION ---
+# When set, every processed company is also written to a Parquet dataset partitioned by sector/symbol (requires pyarrow).
+PARQUET_STAGING_DIR = None  # e.g. "parquet_staging"
+# When True, no network calls are made: the company tables are rebuilt from PARQUET_STAGING_DIR instead.
+RELOAD_FROM_PARQUET = False
+FS_DICTIONARY_COLUMNS = ["statement_type", "item", "header"]
+
+# --- RUN JOURNAL (CHECKPOINT / RESUME) CONFIGURATION ---
+# Every run appends per-company stage completions here; `--resume` continues the latest run from it.
+FS_RUN_JOURNAL_PATH = "fs_run_journal.jsonl"
+FS_RUN_CACHE_DIR = "fs_run_cache"  # Cached universe, forex and transformed frames, one sub-directory per run
+FAILED_COMPANY_RETRY_PASSES = 1  # Extra passes over just the companies that failed, at the end of a run
+
+# --- Earnings-Calendar Refresh Scheduling ---
+# When True, a new run only refreshes the companies that could have filed since their last successful load, judged
+# from the filing and earnings dates the screener script loads into public.aggregate_screener_table. The others
+# keep their tables and are still part of the aggregate. `--all-companies` refreshes everything.
+SCHEDULE_FROM_EARNINGS_CALENDAR = True
+SCREENER_TABLE = ("public", "aggregate_screener_table")
+SCREENER_FILING_DATE_COLUMNS = ["last_earnings_date", "last_report_date", "last_10k_filing_date"]
+REFRESH_LOG_TABLE = "company_refresh_log"  # Time of each company's last successful load, kept in SCHEMA_NAME
+
+# --- EDGAR Bulk Planning Configuration ---
+# With a path set, companyfacts are read from EDGAR's nightly bulk archive (or a locally mirrored copy) instead of
+# one API call per company, and each company's EDGAR/StockAnalysis strategy is planned before any worker starts.
+EDGAR_BULK_COMPANYFACTS_PATH = None  # e.g. "edgar_bulk/companyfacts.zip"
+EDGAR_BULK_COMPANYFACTS_URL = "https://www.sec.gov/Archives/edgar/daily-index/xbrl/companyfacts.zip"
+EDGAR_BULK_MAX_AGE_HOURS = 24  # Re-download when the local copy is older than this; None never downloads (mirror only)
+
+# --- EDGAR Mirror Configuration ---
+# A one-time extraction of the bulk archive into a compact store: one zlib block per CIK plus an offset table
+# addressed by CIK number, both memory-mapped. When built, companyfacts are read from it instead of the API,
+# and each run refreshes only the CIKs whose archive entries changed.
+EDGAR_MIRROR_DIR = None  # e.g. "edgar_bulk/mirror"
+EDGAR_MIRROR_COMPRESSION_LEVEL = 6
+
+# --- StockAnalysis Request Pool ---
+# A company's statement requests are issued concurrently on this shared pool; the SA rate limiter still paces them.
+SA_REQUEST_THREADS = 6
+
+# --- Transform Process Pool Configuration ---
+# The CPU-bound transforms run in worker processes while the I/O threads keep fetching under the rate limiters.
+# Raw facts and results cross the process boundary as Arrow IPC buffers, so this needs pyarrow; 0 (or no pyarrow)
+# runs the transforms in the fetching thread instead.
+TRANSFORM_PROCESSES = max(1, (os.cpu_count() or 2) - 1)
+
+# --- Metrics Configuration ---
+# Per-stage timings and counters for each run are written here as JSON, next to the run journal.
+FS_METRICS_DIR = "fs_run_metrics"
 # Specific headers for EDGAR, using the required User-Agent format.
 EDGAR_HEADERS = {"User-Agent": EDGAR_USER_AGENT, "Accept-Encoding": "gzip, deflate", "Host": "data.sec.gov"}
 
@@ -57,6 +126,38 @@ STATEMENT_ORDER_MAP = {
     "Supplemental Cash Flow": 7
 }
 
+# --- PER-COMPANY TABLE SCHEMA ---
+# Single source of truth for the column order of every company table; used for both CREATE TABLE and COPY.
+FS_TABLE_COLUMNS = [
+    ("symbol", "TEXT"), ("company_name", "TEXT"), ("sector", "TEXT"), ("industry", "TEXT"),
+    ("market_cap_group", "TEXT"), ("statement_type", "TEXT"), ("item", "TEXT"), ("header", "TEXT"),
+    ("original_value", "NUMERIC"), ("original_currency", "TEXT"), ("forex_rate_vs_usd", "NUMERIC"),
+    ("value", "NUMERIC"), ("sort_order_item", "INTEGER"), ("sort_order_metric", "INTEGER"),
+    ("sort_key", "INTEGER"), ("extracted_order", "INTEGER"), ("period_date", "DATE"),
+    ("filing_type", "TEXT"), ("country", "TEXT"), ("statement_sort_order", "INTEGER"), ("period_ordinal", "INTEGER")
+]
+FS_TABLE_KEY = ["symbol", "statement_type", "item", "header"]
+
+# --- COMPANY DIMENSION ---
+# Company attributes live once per symbol in the dimension shared with the screener and price pipelines. The
+# company tables and the aggregate fact table store only its symbol_id; FS_TABLE_COLUMNS stays the layout of
+# the in-memory frames, the Parquet dataset and the aggregate compatibility view.
+DIM_COMPANY_TABLE = ("public", "dim_company")
+DIM_COMPANY_ATTRIBUTES = ["company_name", "sector", "industry", "market_cap_group", "country", "analyst_rating", "ma50_vs_200d"]
+FS_COMPANY_COLUMNS = ["symbol", "company_name", "sector", "industry", "market_cap_group", "country"]
+
+# --- ITEM AND PERIOD DIMENSIONS ---
+# statement_type/item and header are stored as small integer ids into these dimensions. dim_item is seeded from
+# the concept and metric mappings and grows as unmapped items are loaded; dim_period carries each header's
+# fiscal period and a chronological ordinal, which every sort and window ORDER BY uses instead of the text.
+DIM_ITEM_TABLE = ("public", "dim_item")
+DIM_PERIOD_TABLE = ("public", "dim_period")
+FS_DIMENSION_COLUMNS = ["statement_type", "item", "header"]  # Replaced by item_id/period_id in the fact tables
+FS_FACT_COLUMNS = [("symbol_id", "INTEGER"), ("item_id", "SMALLINT"), ("period_id", "SMALLINT")] + [
+    (col, pg_type) for col, pg_type in FS_TABLE_COLUMNS if col not in FS_COMPANY_COLUMNS + FS_DIMENSION_COLUMNS
+]
+FS_FACT_KEY = ["symbol_id", "item_id", "period_id"]
+
 # <<< ADD THIS SNIPPET >>>
 # --- MASTER HEADER LISTS FOR SORTING ---
 # Generate master lists to enforce a perfect chronological sort, ignoring messy period_dates.
@@ -781,17 +882,20 @@ class RateLimiter:
     A simple, thread-safe rate limiter that enforces a consistent delay
     between consume calls, preventing request bursts.
     """
-    def __init__(self, requests_per_unit: int, unit_in_seconds: int = 60):
+    def __init__(self, requests_per_unit: int, unit_in_seconds: int = 60, name: str = None, metrics=None):
         # Calculate the minimum delay required between requests.
         self.delay = unit_in_seconds / requests_per_unit
         self._lock = threading.Lock()
         self.last_request_time = 0
+        self.name = name
+        self.metrics = metrics  # Optional PipelineMetrics; time spent blocked here is recorded as 'wait_<name>'
 
     def consume(self):
         """
         Blocks until the required delay has passed since the last call,
         then proceeds.
         """
+        started = time.perf_counter()
         with self._lock:
             now = time.monotonic()
             elapsed = now - self.last_request_time
@@ -803,30 +907,29 @@ class RateLimiter:
             # Update the last request time to the current time.
             self.last_request_time = time.monotonic()
 
+        if self.metrics is not None:
+            self.metrics.add_time(f"wait_{self.name}", time.perf_counter() - started)
+            self.metrics.count(f"{self.name}_requests")
+
 
 # ==============================================================================
 # HELPER AND DATA PROCESSING FUNCTIONS (FINALIZED)
 # ==============================================================================
-def get_period_sort_key(header_str):
+# Chronological rank of each fiscal period within its year. A header's ordinal is year * 10 + rank, so
+# ordinals sort chronologically and ordinal % 10 recovers the period (e.g. for year-over-year partitions).
+PERIOD_RANKS = {'Q1': 1, 'H1': 2, 'Q2': 3, 'Q3': 4, 'H2': 5, 'Q4': 6, 'FY': 7}
+UNKNOWN_PERIOD_RANK = 9  # Unrecognized periods sort after FY of their year
+
+
+def encode_period_ordinals(headers):
     """
-    Converts a standardized period header string into a sortable tuple.
-    Example: 'Q1_2023' -> (2023, 1), 'FY_2023' -> (2023, 5)
+    Converts period headers into chronological integer ordinals in one vectorized pass.
+    Example: 'Q1_2023' -> 20231, 'FY_2023' -> 20237; malformed headers get 0.
     """
-    if not isinstance(header_str, str) or '_' not in header_str:
-        return (0, 0) # Sort malformed headers last
-
-    try:
-        period, year_str = header_str.split('_')
-        year = int(year_str)
-        
-        # This map defines the chronological order within a year
-        period_map = {'Q1': 1, 'H1': 2, 'Q2': 3, 'Q3': 4, 'H2': 5, 'Q4': 6, 'FY': 7}
-        
-        period_order = period_map.get(period, 99) # Sort unknown periods last
-        
-        return (year, period_order)
-    except (ValueError, IndexError):
-        return (0, 0) # Handle cases where splitting or conversion fails
+    parts = pd.Series(headers).astype(str).str.upper().str.extract(r'^([A-Z0-9]+)_(\d{4})$')
+    ranks = parts[0].map(PERIOD_RANKS).fillna(UNKNOWN_PERIOD_RANK)
+    years = pd.to_numeric(parts[1], errors='coerce')
+    return (years * 10 + ranks).fillna(0).astype('int64').set_axis(pd.Series(headers).index)
 
 
 def apply_final_sorting(df):
@@ -838,8 +941,8 @@ def apply_final_sorting(df):
         
     logging.info(f"Applying final sorting to the DataFrame for {df['symbol'].iloc[0]}...")
 
-    # Step 1: Create the dynamic chronological sort key from the 'header' column.
-    df['period_sort_key'] = df['header'].apply(get_period_sort_key)
+    # Step 1: Encode the chronological period ordinal from the 'header' column (stored with the rows).
+    df['period_ordinal'] = encode_period_ordinals(df['header'])
     
     # Step 2: Define the full sorting hierarchy.
     # This ensures statements are grouped, items are in order, metrics follow their parents,
@@ -848,12 +951,11 @@ def apply_final_sorting(df):
         'statement_sort_order',
         'sort_order_item',
         'sort_order_metric',
-        'period_sort_key'
+        'period_ordinal'
     ]
 
     # Step 3: Apply the sort and clean up.
     df.sort_values(by=final_sort_columns, ascending=True, inplace=True, na_position='last')
-    df.drop(columns=['period_sort_key'], inplace=True)
     
     # Step 4: Create the final sort_key and extracted_order for the database.
     df.reset_index(drop=True, inplace=True)
@@ -1496,6 +1598,18 @@ def get_company_facts_data(cik_code, edgar_rate_limiter):
         logging.warning(f"Invalid CIK provided: '{cik_code}'. Cannot fetch from EDGAR.")
         return pd.DataFrame(), None
 
+    mirror = get_edgar_mirror()
+    if mirror is not None:
+        try:
+            data = mirror.load_company_facts(cik_code)
+        except (OSError, ValueError, zlib.error) as e:
+            logging.error(f"Error reading CIK {cik_code} from the EDGAR mirror: {e}")
+            return pd.DataFrame(), None
+        if data is None:
+            logging.info(f"CIK {cik_code} has no facts in the local EDGAR mirror.")
+            return pd.DataFrame(), None
+        return parse_company_facts(data)
+
     # Consume a token from the EDGAR rate limiter before making the request.
     edgar_rate_limiter.consume()
     logging.info(f"EDGAR token acquired. Fetching all facts for CIK {cik_code}...")
@@ -1506,54 +1620,7 @@ def get_company_facts_data(cik_code, edgar_rate_limiter):
         # This call now correctly uses the EDGAR-specific headers.
         response = requests.get(company_facts_url, headers=EDGAR_HEADERS, timeout=60)
         response.raise_for_status()
-        data = response.json()
-
-        # ... (rest of the function logic is unchanged) ...
-        facts_by_end_date = {}
-        processed_taxonomies = set()
-        for taxonomy_name, taxonomy_facts in data.get('facts', {}).items():
-            for concept, data_points in taxonomy_facts.items():
-                if concept in MASTER_CONCEPT_MAPPING:
-                    mapped_info = MASTER_CONCEPT_MAPPING[concept]
-                    processed_taxonomies.add(taxonomy_name)
-                    for currency, facts_list in data_points.get('units', {}).items():
-                        for fact in facts_list:
-                            form = fact.get('form', 'N/A').upper()
-                            if form in ('10-K', '20-F', '40-F', '10-Q', '10-K/A', '20-F/A', '40-F/A', '10-Q/A'):
-                                group_key = (mapped_info["item"], fact.get('end'))
-                                if group_key not in facts_by_end_date:
-                                    facts_by_end_date[group_key] = []
-                                fact_tuple = (fact, mapped_info, currency.upper())
-                                facts_by_end_date[group_key].append(fact_tuple)
-        final_facts = []
-        for group_key, fact_group in facts_by_end_date.items():
-            best_fact_tuple = sorted(fact_group, key=lambda x: (0 if '/A' in x[0]['form'] else 1, x[0]['filed']))[0]
-            final_facts.append(best_fact_tuple)
-
-        primary_taxonomy = 'us-gaap' if 'us-gaap' in processed_taxonomies else 'ifrs-full'
-        if not final_facts:
-            return pd.DataFrame(), primary_taxonomy
-
-        df_data = []
-        for fact_tuple in final_facts:
-            fact, mapped_info, currency = fact_tuple
-            df_data.append({
-                "item": mapped_info['item'],
-                "statement_type": mapped_info.get("statement_type", "N/A"),
-                "sort_order_item": mapped_info.get("sort_order_item", 999),
-                "sort_order_metric": 0,
-                "fiscal_year": fact['fy'],
-                "fiscal_period": fact['fp'],
-                "period_date": datetime.strptime(fact['end'], '%Y-%m-%d').date(),
-                "original_value": fact['val'],
-                "original_currency": currency,
-                "filing_type": fact['form'],
-                "filed_date": datetime.strptime(fact['filed'], '%Y-%m-%d').date(),
-                "header": format_period_header(fact['fy'], fact['fp'])
-            })
-
-        final_df = pd.DataFrame(df_data)
-        return final_df.sort_values(by='filed_date').drop_duplicates(subset=['item', 'header'], keep='first'), primary_taxonomy
+        return parse_company_facts(response.json())
 
     except requests.exceptions.RequestException as e:
         logging.error(f"Request error for CIK {cik_code}: {e}")
@@ -1563,6 +1630,58 @@ def get_company_facts_data(cik_code, edgar_rate_limiter):
         return pd.DataFrame(), None
 
 
+def parse_company_facts(data):
+    """
+    Maps a companyfacts document (from the API or the bulk archive) onto the standard items, keeping
+    the best filing per item and period end. Returns (facts frame, primary taxonomy).
+    """
+    facts_by_end_date = {}
+    processed_taxonomies = set()
+    for taxonomy_name, taxonomy_facts in data.get('facts', {}).items():
+        for concept, data_points in taxonomy_facts.items():
+            if concept in MASTER_CONCEPT_MAPPING:
+                mapped_info = MASTER_CONCEPT_MAPPING[concept]
+                processed_taxonomies.add(taxonomy_name)
+                for currency, facts_list in data_points.get('units', {}).items():
+                    for fact in facts_list:
+                        form = fact.get('form', 'N/A').upper()
+                        if form in ('10-K', '20-F', '40-F', '10-Q', '10-K/A', '20-F/A', '40-F/A', '10-Q/A'):
+                            group_key = (mapped_info["item"], fact.get('end'))
+                            if group_key not in facts_by_end_date:
+                                facts_by_end_date[group_key] = []
+                            fact_tuple = (fact, mapped_info, currency.upper())
+                            facts_by_end_date[group_key].append(fact_tuple)
+    final_facts = []
+    for group_key, fact_group in facts_by_end_date.items():
+        best_fact_tuple = sorted(fact_group, key=lambda x: (0 if '/A' in x[0]['form'] else 1, x[0]['filed']))[0]
+        final_facts.append(best_fact_tuple)
+
+    primary_taxonomy = 'us-gaap' if 'us-gaap' in processed_taxonomies else 'ifrs-full'
+    if not final_facts:
+        return pd.DataFrame(), primary_taxonomy
+
+    df_data = []
+    for fact_tuple in final_facts:
+        fact, mapped_info, currency = fact_tuple
+        df_data.append({
+            "item": mapped_info['item'],
+            "statement_type": mapped_info.get("statement_type", "N/A"),
+            "sort_order_item": mapped_info.get("sort_order_item", 999),
+            "sort_order_metric": 0,
+            "fiscal_year": fact['fy'],
+            "fiscal_period": fact['fp'],
+            "period_date": datetime.strptime(fact['end'], '%Y-%m-%d').date(),
+            "original_value": fact['val'],
+            "original_currency": currency,
+            "filing_type": fact['form'],
+            "filed_date": datetime.strptime(fact['filed'], '%Y-%m-%d').date(),
+            "header": format_period_header(fact['fy'], fact['fp'])
+        })
+
+    final_df = pd.DataFrame(df_data)
+    return final_df.sort_values(by='filed_date').drop_duplicates(subset=['item', 'header'], keep='first'), primary_taxonomy
+
+
 def fetch_company_profile_currency(symbol, sa_rate_limiter):
     """
     Fetches profile currency from StockAnalysis.
@@ -1602,12 +1721,123 @@ def fetch_company_profile_currency(symbol, sa_rate_limiter):
     except (requests.exceptions.RequestException, ValueError) as e:
         logging.error(f"Critical error fetching profile currency for {symbol}: {e}", exc_info=False)
         return None
+
+
+_sa_request_pool = None
+_sa_request_pool_lock = threading.Lock()
+
+
+def get_sa_request_pool():
+    """Shared thread pool for StockAnalysis downloads; pacing still comes from the shared SA rate limiter."""
+    global _sa_request_pool
+    with _sa_request_pool_lock:
+        if _sa_request_pool is None:
+            _sa_request_pool = concurrent.futures.ThreadPoolExecutor(max_workers=SA_REQUEST_THREADS, thread_name_prefix='SA_Request')
+    return _sa_request_pool
+
+
+def fetch_stockanalysis_payload(url, sa_rate_limiter, description):
+    """Downloads one StockAnalysis __data.json payload under the shared SA rate limiter."""
+    sa_rate_limiter.consume()
+    logging.info(f"SA token acquired. Fetching {description}.")
+    response = requests.get(url, headers=get_stockanalysis_headers(), timeout=30)
+    response.raise_for_status()
+    return response.json()
+
+
+def extract_payload_currency(json_data, currency_keys=('financialCurrency', 'currency')):
+    """Finds the reporting currency referenced by a StockAnalysis __data.json payload, or None."""
+    for node in json_data.get('nodes', []):
+        data_section = node.get('data') if isinstance(node, dict) and node.get('type') == 'data' else None
+        if not isinstance(data_section, list):
+            continue
+        for key in currency_keys:  # financialCurrency is preferred over the trading currency
+            for item in data_section:
+                if not isinstance(item, dict):
+                    continue
+                pointer = item.get(key)
+                if type(pointer) is int and 0 <= pointer < len(data_section):
+                    currency = data_section[pointer]
+                    if isinstance(currency, str) and re.fullmatch(r'[A-Za-z]{3}', currency):
+                        return currency.upper()
+    return None
+
+
+def parse_stockanalysis_statement(json_data, stmt_info):
+    """Parses one statement payload into fact rows, resolving the nested pointer structure to real values."""
+    rows = []
+    data_section = next((node['data'] for node in json_data.get('nodes', []) if node.get('type') == 'data' and isinstance(node.get('data'), list) and len(node['data']) > 0 and 'financialData' in node['data'][0]), None)
+    if not data_section: return rows
+
+    key_map = data_section[0]
+    financial_data_map = data_section[key_map.get('financialData')]
+    headers = []
+
+    column_map_index = key_map.get('column')
+    if column_map_index and isinstance(data_section[column_map_index], dict):
+        columns_list_index = data_section[column_map_index].get('columns')
+        if columns_list_index: headers = [data_section[i]['t'] for i in data_section[columns_list_index]]
+    
+    if not headers:
+        fy_index, fq_index = financial_data_map.get('fiscalYear'), financial_data_map.get('fiscalQuarter')
+        if fy_index and fq_index:
+            years = [data_section[i] for i in data_section[fy_index]]
+            quarters = [data_section[i] for i in data_section[fq_index]]
+            if len(quarters) == 1 and len(years) > 1: quarters *= len(years)
+            headers = [f"{q} {y}" for q, y in zip(quarters, years)]
+
+    if not headers: return rows
+
+    item_titles = {data_section[e['id']]: data_section[e['title']] for e in data_section if isinstance(e, dict) and 'id' in e and 'title' in e}
+    
+    for item_id, data_pointer in financial_data_map.items():
+        scraped_item_name = item_titles.get(item_id)
+        if not scraped_item_name or "ttm" in scraped_item_name.lower(): continue
+
+        if not (isinstance(data_pointer, int) and data_pointer < len(data_section)): continue
+        value_pointers = data_section[data_pointer]
+        if not isinstance(value_pointers, list): continue
+
+        for i, period_header_text in enumerate(headers):
+            if i >= len(value_pointers): continue
+            
+            try:
+                # *** THIS IS THE CRITICAL FIX ***
+                # 1. Get the index that points to the actual value
+                value_index = value_pointers[i]
+                if not (isinstance(value_index, int) and value_index < len(data_section)): continue
+
+                # 2. Use the index to get the value object from the main data list
+                value_obj = data_section[value_index]
+                if value_obj is None: continue
+
+                # 3. Extract the float value
+                numeric_value = float(value_obj[0] if isinstance(value_obj, list) else value_obj)
+                if pd.isna(numeric_value): continue
+                # *** END CRITICAL FIX ***
+
+                match = re.search(r'([A-Z0-9]+)\s(\d{4})', period_header_text)
+                if not match: continue
+                
+                fiscal_period, fiscal_year_str = match.groups()
+                rows.append({
+                    'item': scraped_item_name, 'header': f"{fiscal_period}_{int(fiscal_year_str)}",
+                    'original_value': numeric_value, 'fiscal_year': int(fiscal_year_str),
+                    'fiscal_period': fiscal_period, 'statement_type': stmt_info['display_name'],
+                    'filing_type': 'Scraped-JSON'
+                })
+            except (ValueError, TypeError, IndexError):
+                continue
+    return rows
+
+
 def fetch_stockanalysis_data(symbol, sa_rate_limiter, periods_to_fetch='ALL'):
     """
     Fetches financial statements from StockAnalysis.com for specified period types.
-    This version correctly parses the nested JSON structure to get real values.
+    Every statement/period request for the company is queued at once on the shared SA request pool (paced by
+    the shared limiter), and each payload is parsed as soon as it arrives while the rest download.
+    Returns (facts frame, reporting currency found in the payloads or None).
     """
-    all_rows = []
     fetch_modes = []
     if periods_to_fetch in ['ALL', 'A_ONLY']:
         fetch_modes.append({'param': '', 'label': 'Annual'})
@@ -1620,196 +1850,664 @@ def fetch_stockanalysis_data(symbol, sa_rate_limiter, periods_to_fetch='ALL'):
         {"slug": "financials/cash-flow-statement", "display_name": "Cash Flow Statement"}
     ]
 
-    for mode in fetch_modes:
-        for stmt_info in statement_map:
-            url = f"https://stockanalysis.com/stocks/{symbol.lower()}/{stmt_info['slug']}/__data.json?p={mode['param']}"
-            try:
-                sa_rate_limiter.consume()
-                logging.info(f"SA token acquired. Fetching {mode['label']} {stmt_info['display_name']} for {symbol}.")
-                response = requests.get(url, headers=get_stockanalysis_headers(), timeout=30)
-                response.raise_for_status()
-                json_data = response.json()
-
-                data_section = next((node['data'] for node in json_data.get('nodes', []) if node.get('type') == 'data' and isinstance(node.get('data'), list) and len(node['data']) > 0 and 'financialData' in node['data'][0]), None)
-                if not data_section: continue
-
-                key_map = data_section[0]
-                financial_data_map = data_section[key_map.get('financialData')]
-                headers = []
-
-                column_map_index = key_map.get('column')
-                if column_map_index and isinstance(data_section[column_map_index], dict):
-                    columns_list_index = data_section[column_map_index].get('columns')
-                    if columns_list_index: headers = [data_section[i]['t'] for i in data_section[columns_list_index]]
-                
-                if not headers:
-                    fy_index, fq_index = financial_data_map.get('fiscalYear'), financial_data_map.get('fiscalQuarter')
-                    if fy_index and fq_index:
-                        years = [data_section[i] for i in data_section[fy_index]]
-                        quarters = [data_section[i] for i in data_section[fq_index]]
-                        if len(quarters) == 1 and len(years) > 1: quarters *= len(years)
-                        headers = [f"{q} {y}" for q, y in zip(quarters, years)]
+    requests_to_make = [(mode, stmt_info) for mode in fetch_modes for stmt_info in statement_map]
+    futures = {
+        get_sa_request_pool().submit(
+            fetch_stockanalysis_payload,
+            f"https://stockanalysis.com/stocks/{symbol.lower()}/{stmt_info['slug']}/__data.json?p={mode['param']}",
+            sa_rate_limiter, f"{mode['label']} {stmt_info['display_name']} for {symbol}"
+        ): position
+        for position, (mode, stmt_info) in enumerate(requests_to_make)
+    }
+    rows_by_request = [[] for _ in requests_to_make]
+    currency = None
+    for future in concurrent.futures.as_completed(futures):
+        position = futures[future]
+        stmt_info = requests_to_make[position][1]
+        try:
+            json_data = future.result()
+            rows_by_request[position] = parse_stockanalysis_statement(json_data, stmt_info)
+            currency = currency or extract_payload_currency(json_data)
+        except Exception as e:
+            logging.error(f"Critical error fetching {stmt_info['display_name']} for {symbol}: {e}", exc_info=False)
 
-                if not headers: continue
+    # Rows keep the original request order so de-duplication downstream is unaffected by arrival order.
+    return pd.DataFrame([row for rows in rows_by_request for row in rows]), currency
 
-                item_titles = {data_section[e['id']]: data_section[e['title']] for e in data_section if isinstance(e, dict) and 'id' in e and 'title' in e}
-                
-                for item_id, data_pointer in financial_data_map.items():
-                    scraped_item_name = item_titles.get(item_id)
-                    if not scraped_item_name or "ttm" in scraped_item_name.lower(): continue
-
-                    if not (isinstance(data_pointer, int) and data_pointer < len(data_section)): continue
-                    value_pointers = data_section[data_pointer]
-                    if not isinstance(value_pointers, list): continue
-
-                    for i, period_header_text in enumerate(headers):
-                        if i >= len(value_pointers): continue
-                        
-                        try:
-                            # *** THIS IS THE CRITICAL FIX ***
-                            # 1. Get the index that points to the actual value
-                            value_index = value_pointers[i]
-                            if not (isinstance(value_index, int) and value_index < len(data_section)): continue
-
-                            # 2. Use the index to get the value object from the main data list
-                            value_obj = data_section[value_index]
-                            if value_obj is None: continue
-
-                            # 3. Extract the float value
-                            numeric_value = float(value_obj[0] if isinstance(value_obj, list) else value_obj)
-                            if pd.isna(numeric_value): continue
-                            # *** END CRITICAL FIX ***
-
-                            match = re.search(r'([A-Z0-9]+)\s(\d{4})', period_header_text)
-                            if not match: continue
-                            
-                            fiscal_period, fiscal_year_str = match.groups()
-                            all_rows.append({
-                                'item': scraped_item_name, 'header': f"{fiscal_period}_{int(fiscal_year_str)}",
-                                'original_value': numeric_value, 'fiscal_year': int(fiscal_year_str),
-                                'fiscal_period': fiscal_period, 'statement_type': stmt_info['display_name'],
-                                'filing_type': 'Scraped-JSON'
-                            })
-                        except (ValueError, TypeError, IndexError):
-                            continue
+
+# ==============================================================================
+# EDGAR BULK PLANNING
+# ==============================================================================
+def edgar_strategy(edgar_df, taxonomy):
+    """Decides how a company's statements are sourced: 'ALL EDGAR', 'HYBRID' or 'FULL FALLBACK'."""
+    if not edgar_df.empty and taxonomy == 'us-gaap' and has_sufficient_quarterly_data(edgar_df.copy()):
+        return 'ALL EDGAR'
+    return 'HYBRID' if not edgar_df.empty else 'FULL FALLBACK'
+
+
+def ensure_edgar_bulk_archive(archive_path):
+    """Downloads EDGAR's nightly companyfacts archive when the local copy is missing or stale. Returns True if usable."""
+    if os.path.exists(archive_path) and (
+            EDGAR_BULK_MAX_AGE_HOURS is None or time.time() - os.path.getmtime(archive_path) < EDGAR_BULK_MAX_AGE_HOURS * 3600):
+        return True
+    if EDGAR_BULK_MAX_AGE_HOURS is None:
+        logging.error(f"EDGAR bulk archive '{archive_path}' not found and downloads are disabled.")
+        return False
+
+    logging.info(f"Downloading EDGAR bulk companyfacts archive to {archive_path}...")
+    partial_path = archive_path + ".part"
+    try:
+        os.makedirs(os.path.dirname(archive_path) or '.', exist_ok=True)
+        with requests.get(EDGAR_BULK_COMPANYFACTS_URL, headers={**EDGAR_HEADERS, "Host": "www.sec.gov"}, stream=True, timeout=600) as response:
+            response.raise_for_status()
+            with open(partial_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=1 << 20):
+                    f.write(chunk)
+        os.replace(partial_path, archive_path)
+        return True
+    except (requests.exceptions.RequestException, OSError) as e:
+        logging.error(f"Could not download the EDGAR bulk archive: {e}")
+        # A stale copy is still better than one API call per company.
+        return os.path.exists(archive_path)
+
+
+def plan_edgar_strategies(companies, load_facts):
+    """
+    Reads every company's companyfacts from a local bulk source (no HTTP) and decides its strategy up front.
+    load_facts(cik_code) returns the companyfacts document, or None when the CIK has none.
+    Returns {symbol: (edgar_df, taxonomy, strategy)}.
+    """
+    plan = {}
+    for company in companies:
+        symbol, cik_code = company['symbol'], company.get('cik_code')
+        edgar_df, taxonomy = pd.DataFrame(), None
+        if isinstance(cik_code, str) and cik_code.isdigit():
+            try:
+                data = load_facts(cik_code)
+                if data is not None:
+                    edgar_df, taxonomy = parse_company_facts(data)
             except Exception as e:
-                logging.error(f"Critical error fetching {stmt_info['display_name']} for {symbol}: {e}", exc_info=False)
+                logging.error(f"Error reading bulk companyfacts for {symbol} (CIK {cik_code}): {e}", exc_info=True)
+        plan[symbol] = (edgar_df, taxonomy, edgar_strategy(edgar_df, taxonomy))
+
+    strategy_counts = Counter(strategy for _, _, strategy in plan.values())
+    logging.info(f"EDGAR bulk plan for {len(plan)} companies: {strategy_counts['ALL EDGAR']} all-EDGAR, "
+                 f"{strategy_counts['HYBRID']} hybrid, {strategy_counts['FULL FALLBACK']} full fallback.")
+    return plan
+
+
+def plan_from_edgar_bulk(companies):
+    """
+    Plans strategies from the local mirror (refreshed from the archive first, when one is configured),
+    or straight from the archive when there is no mirror. Returns None when neither is available.
+    """
+    archive_ok = bool(EDGAR_BULK_COMPANYFACTS_PATH) and ensure_edgar_bulk_archive(EDGAR_BULK_COMPANYFACTS_PATH)
+    if EDGAR_MIRROR_DIR:
+        if archive_ok and edgar_mirror_is_stale(EDGAR_BULK_COMPANYFACTS_PATH, EDGAR_MIRROR_DIR):
+            refresh_edgar_mirror(EDGAR_BULK_COMPANYFACTS_PATH, EDGAR_MIRROR_DIR)
+        mirror = get_edgar_mirror()
+        if mirror is not None:
+            return plan_edgar_strategies(companies, mirror.load_company_facts)
+    if not archive_ok:
+        return None
+    with zipfile.ZipFile(EDGAR_BULK_COMPANYFACTS_PATH) as archive:
+        members = set(archive.namelist())
+
+        def load_facts(cik_code):
+            member = f"CIK{cik_code}.json"
+            return json.loads(archive.read(member)) if member in members else None
+
+        return plan_edgar_strategies(companies, load_facts)
+
+
+# ==============================================================================
+# EDGAR BULK MIRROR
+# ==============================================================================
+EDGAR_MIRROR_INDEX_DTYPE = np.dtype([('offset', '<u8'), ('length', '<u4'), ('crc', '<u4')])
+EDGAR_ARCHIVE_MEMBER_PATTERN = re.compile(r'^CIK(\d{10})\.json$')
+_edgar_mirror = None
+_edgar_mirror_lock = threading.Lock()
+
+
+class EdgarMirror:
+    """
+    Read side of the local companyfacts mirror. The index is a memory-mapped array addressed directly by
+    CIK number (length 0 = no facts), so a lookup is one index read plus one slice of the mapped data file.
+    """
+    DATA_FILE = "companyfacts.dat"
+    INDEX_FILE = "companyfacts.idx"
+    META_FILE = "companyfacts.meta.json"
+
+    def __init__(self, mirror_dir):
+        self.mirror_dir = mirror_dir
+        self.index = np.memmap(os.path.join(mirror_dir, self.INDEX_FILE), dtype=EDGAR_MIRROR_INDEX_DTYPE, mode='r')
+        self._data_file = open(os.path.join(mirror_dir, self.DATA_FILE), 'rb')
+        data_size = os.fstat(self._data_file.fileno()).st_size
+        self._data = mmap.mmap(self._data_file.fileno(), 0, access=mmap.ACCESS_READ) if data_size else b''
+
+    @classmethod
+    def exists(cls, mirror_dir):
+        return all(os.path.exists(os.path.join(mirror_dir, f)) for f in (cls.DATA_FILE, cls.INDEX_FILE))
+
+    def load_company_facts(self, cik_code):
+        """Returns the companyfacts document for a CIK, or None if the archive had no entry for it."""
+        cik = int(cik_code)
+        if cik >= len(self.index):
+            return None
+        entry = self.index[cik]
+        if entry['length'] == 0:
+            return None
+        offset = int(entry['offset'])
+        return json.loads(zlib.decompress(self._data[offset:offset + int(entry['length'])]))
+
+
+def get_edgar_mirror():
+    """Opens the local EDGAR mirror once per process; None when no mirror is configured or built yet."""
+    global _edgar_mirror
+    if not EDGAR_MIRROR_DIR:
+        return None
+    with _edgar_mirror_lock:
+        if _edgar_mirror is None and EdgarMirror.exists(EDGAR_MIRROR_DIR):
+            _edgar_mirror = EdgarMirror(EDGAR_MIRROR_DIR)
+    return _edgar_mirror
+
+
+def load_edgar_mirror_meta(mirror_dir):
+    meta_path = os.path.join(mirror_dir, EdgarMirror.META_FILE)
+    if not os.path.exists(meta_path):
+        return {}
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def edgar_mirror_is_stale(archive_path, mirror_dir):
+    return load_edgar_mirror_meta(mirror_dir).get('archive_mtime') != os.path.getmtime(archive_path)
+
+
+def refresh_edgar_mirror(archive_path, mirror_dir):
+    """
+    Brings the mirror up to date with a companyfacts archive. Only members that are new or whose CRC changed
+    are recompressed and appended; superseded blocks stay in the data file until they outweigh the live ones,
+    and then the next refresh rebuilds the mirror from scratch. Returns the number of CIKs written.
+    """
+    os.makedirs(mirror_dir, exist_ok=True)
+    data_path = os.path.join(mirror_dir, EdgarMirror.DATA_FILE)
+    index_path = os.path.join(mirror_dir, EdgarMirror.INDEX_FILE)
+    meta = load_edgar_mirror_meta(mirror_dir)
+    live_bytes, dead_bytes = meta.get('live_bytes', 0), meta.get('dead_bytes', 0)
+
+    if EdgarMirror.exists(mirror_dir) and dead_bytes <= live_bytes:
+        index = np.fromfile(index_path, dtype=EDGAR_MIRROR_INDEX_DTYPE)
+    else:
+        logging.info(f"Building the EDGAR mirror in {mirror_dir} from scratch.")
+        index = np.zeros(0, dtype=EDGAR_MIRROR_INDEX_DTYPE)
+        open(data_path, 'wb').close()
+        live_bytes = dead_bytes = 0
+
+    written = 0
+    with zipfile.ZipFile(archive_path) as archive:
+        members = {}
+        for info in archive.infolist():
+            match = EDGAR_ARCHIVE_MEMBER_PATTERN.match(info.filename)
+            if match:
+                members[int(match.group(1))] = info
+        if members and max(members) >= len(index):
+            index = np.concatenate([index, np.zeros(max(members) + 1 - len(index), dtype=EDGAR_MIRROR_INDEX_DTYPE)])
+
+        with open(data_path, 'ab') as data_file:
+            offset = data_file.tell()
+            for cik, info in members.items():
+                entry = index[cik]
+                if entry['length'] and entry['crc'] == info.CRC:
+                    continue
+                dead_bytes += int(entry['length'])
+                live_bytes -= int(entry['length'])
+                block = zlib.compress(archive.read(info), EDGAR_MIRROR_COMPRESSION_LEVEL)
+                data_file.write(block)
+                index[cik] = (offset, len(block), info.CRC)
+                offset += len(block)
+                live_bytes += len(block)
+                written += 1
+
+    # CIKs that dropped out of the archive
+    in_archive = np.zeros(len(index), dtype=bool)
+    in_archive[list(members)] = True
+    removed = (index['length'] > 0) & ~in_archive
+    removed_bytes = int(index['length'][removed].sum())
+    dead_bytes += removed_bytes
+    live_bytes -= removed_bytes
+    index[removed] = 0
+
+    # Readers keep the previous index mapped until they reopen the mirror.
+    index.tofile(index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+    with open(os.path.join(mirror_dir, EdgarMirror.META_FILE), 'w') as f:
+        json.dump({'archive_path': os.path.abspath(archive_path), 'archive_mtime': os.path.getmtime(archive_path),
+                   'refreshed_at': datetime.now().isoformat(timespec='seconds'), 'ciks': int((index['length'] > 0).sum()),
+                   'live_bytes': live_bytes, 'dead_bytes': dead_bytes}, f, indent=2)
+    logging.info(f"EDGAR mirror refreshed: {written} CIKs written, {int(removed.sum())} removed, "
+                 f"{int((index['length'] > 0).sum())} CIKs in the mirror.")
+    return written
+
 
-    return pd.DataFrame(all_rows)
 # ==============================================================================
 # DATABASE FUNCTIONS
 # ==============================================================================
+def build_column_definitions(table_columns):
+    """Builds the column definition list of a CREATE TABLE statement from a table schema."""
+    return sql.SQL(", ").join(
+        sql.SQL("{col} {pg_type}").format(col=sql.Identifier(col), pg_type=sql.SQL(pg_type))
+        for col, pg_type in table_columns
+    )
+
+
+def serialize_for_copy(df, table_columns):
+    """
+    Converts a DataFrame into a tab-delimited COPY buffer one column at a time.
+    Each column is formatted and NULL-masked as a whole array in table-schema order; rows are
+    only touched once at the end, when the pre-formatted fields are joined into lines.
+    """
+    buffer = io.StringIO()
+    if df.empty:
+        return buffer
+
+    encoded_columns = []
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'INTEGER', 'BIGINT', 'SMALLINT', 'DOUBLE PRECISION'):
+            numeric = pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            null_mask = ~np.isfinite(numeric)
+            if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+                values = np.where(null_mask, 0.0, numeric).tolist()
+            else:
+                values = np.where(null_mask, 0, np.round(numeric)).astype('int64').tolist()
+            text = np.array(list(map(str, values)), dtype=object)
+        elif pg_type == 'DATE':
+            dates = pd.to_datetime(series, errors='coerce')
+            null_mask = dates.isna().to_numpy()
+            text = dates.dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+        else:
+            null_mask = series.isna().to_numpy()
+            text = (series.astype(str)
+                    .str.replace('\\', '\\\\', regex=False)
+                    .str.replace('\t', '\\t', regex=False)
+                    .str.replace('\n', '\\n', regex=False)
+                    .str.replace('\r', '\\r', regex=False)
+                    .to_numpy(dtype=object))
+        text[null_mask] = '\\N'
+        encoded_columns.append(text)
+
+    buffer.write('\n'.join(map('\t'.join, zip(*encoded_columns))))
+    buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_dataframe(cur, df, full_table_name, table_columns):
+    """Bulk-loads a DataFrame into a table with COPY, using the table schema for column order."""
+    copy_query = sql.SQL("COPY {table_name} ({columns}) FROM STDIN;").format(
+        table_name=full_table_name,
+        columns=sql.SQL(", ").join(sql.Identifier(col) for col, _ in table_columns)
+    )
+    cur.copy_expert(copy_query, serialize_for_copy(df, table_columns))
+
+
+def table_has_primary_key(cur, schema_name, table_name_str):
+    """Returns True if the table exists and already carries a primary key (required for ON CONFLICT)."""
+    cur.execute("""
+        SELECT 1 FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s AND i.indisprimary;
+    """, (schema_name, table_name_str))
+    return cur.fetchone() is not None
+
+
+def table_has_columns(cur, schema_name, table_name_str, table_columns):
+    """Returns True if the table exists and has every column of the given table schema."""
+    cur.execute("""
+        SELECT count(*) FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s AND column_name = ANY(%s);
+    """, (schema_name, table_name_str, [col for col, _ in table_columns]))
+    return cur.fetchone()[0] == len(table_columns)
+
+
+def drop_table_or_view(cur, schema_name, relation_name):
+    """Drops a relation that may be a table (before the company dimension) or a view (after it)."""
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s;
+    """, (schema_name, relation_name))
+    existing = cur.fetchone()
+    if existing:
+        kind = "VIEW" if existing[0] == 'v' else "TABLE"
+        cur.execute(sql.SQL("DROP {kind} {relation} CASCADE;").format(
+            kind=sql.SQL(kind), relation=sql.Identifier(schema_name, relation_name)
+        ))
+
+
+def index_aggregate_fact_table(cur, full_table_id, key_columns):
+    """
+    Indexes a freshly built aggregate fact table and refreshes its statistics: a btree on the fact key serves
+    the per-company lookups of the wide-view workers, a BRIN on period_date serves period range scans.
+    """
+    cur.execute(sql.SQL("CREATE INDEX ON {table} ({columns});").format(
+        table=full_table_id, columns=sql.SQL(", ").join(map(sql.Identifier, key_columns))
+    ))
+    cur.execute(sql.SQL("CREATE INDEX ON {table} USING brin (period_date);").format(table=full_table_id))
+    cur.execute(sql.SQL("ANALYZE {table};").format(table=full_table_id))
+
+
+def ensure_dim_company_table(cur):
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {dim_table} (
+            symbol_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            symbol TEXT NOT NULL UNIQUE CHECK (symbol = lower(symbol)),
+            {attributes},
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """).format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE),
+        attributes=build_column_definitions([(col, "TEXT") for col in DIM_COMPANY_ATTRIBUTES])
+    ))
+
+
+def upsert_company(cur, company_record):
+    """
+    Registers a company in the shared company dimension and refreshes its attributes; as in the screener and
+    price writers, a new non-null value wins and a missing one keeps the stored value. Returns the symbol_id.
+    """
+    ensure_dim_company_table(cur)
+    attribute_columns = [col for col in FS_COMPANY_COLUMNS if col != "symbol"]
+    cur.execute(sql.SQL("""
+        INSERT INTO {dim_table} AS d (symbol, {columns})
+        VALUES (%s, {placeholders})
+        ON CONFLICT (symbol) DO UPDATE SET {assignments}, updated_at = now()
+        WHERE ({current_values}) IS DISTINCT FROM ({merged_values});
+    """).format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE),
+        columns=sql.SQL(", ").join(map(sql.Identifier, attribute_columns)),
+        placeholders=sql.SQL(", ").join(sql.Placeholder() * len(attribute_columns)),
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{col} = COALESCE(EXCLUDED.{col}, d.{col})").format(col=sql.Identifier(col)) for col in attribute_columns
+        ),
+        current_values=sql.SQL(", ").join(sql.SQL("d.{col}").format(col=sql.Identifier(col)) for col in attribute_columns),
+        merged_values=sql.SQL(", ").join(
+            sql.SQL("COALESCE(EXCLUDED.{col}, d.{col})").format(col=sql.Identifier(col)) for col in attribute_columns
+        )
+    ), [str(company_record['symbol']).lower()] + [
+        None if pd.isna(company_record.get(col)) else str(company_record.get(col)) for col in attribute_columns
+    ])
+    cur.execute(sql.SQL("SELECT symbol_id FROM {dim_table} WHERE symbol = %s;").format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE)
+    ), (str(company_record['symbol']).lower(),))
+    return cur.fetchone()[0]
+
+
+def build_item_dimension_seed():
+    """
+    Returns the (statement_type, item, statement_sort_order, sort_order_item) rows known from the XBRL concept
+    mappings, the StockAnalysis name map and the derived metrics, in statement and item order.
+    """
+    rows = {}
+    for mapping in MASTER_CONCEPT_MAPPING.values():
+        statement_type = mapping['statement_type']
+        rows.setdefault((statement_type, mapping['item']),
+                        (STATEMENT_ORDER_MAP.get(statement_type, 99), mapping['sort_order_item']))
+    for item_name in list(STOCKANALYSIS_TO_STANDARD_MAP.values()) + [info['name'] for info in METRIC_SORTING_MAP.values()]:
+        metadata = resolve_item_metadata(item_name)
+        if metadata['statement_type'] != "Unknown":
+            rows.setdefault((metadata['statement_type'], metadata['official_item_name']),
+                            (metadata['statement_sort_order'], metadata['sort_order_item']))
+    ordered = sorted(rows.items(), key=lambda row: (row[1], row[0]))
+    return [(statement_type, item, statement_sort_order, sort_order_item)
+            for (statement_type, item), (statement_sort_order, sort_order_item) in ordered]
+
+
+def ensure_item_and_period_tables(cur):
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {dim_item} (
+            item_id SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            statement_type TEXT NOT NULL,
+            item TEXT NOT NULL,
+            statement_sort_order INTEGER,
+            sort_order_item INTEGER,
+            UNIQUE (statement_type, item)
+        );
+        CREATE TABLE IF NOT EXISTS {dim_period} (
+            period_id SMALLINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            header TEXT NOT NULL UNIQUE,
+            fiscal_period TEXT,
+            fiscal_year SMALLINT,
+            period_ordinal INTEGER NOT NULL
+        );
+    """).format(dim_item=sql.Identifier(*DIM_ITEM_TABLE), dim_period=sql.Identifier(*DIM_PERIOD_TABLE)))
+
+
+def prepare_dimension_tables():
+    """
+    Creates the company, item and period dimensions once per run, before any worker needs them, and seeds
+    dim_item from the mappings so known items get their ids in statement order.
+    """
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        cur = conn.cursor()
+        ensure_dim_company_table(cur)
+        ensure_item_and_period_tables(cur)
+        seed_rows = build_item_dimension_seed()
+        cur.execute(sql.SQL("""
+            INSERT INTO {dim_item} (statement_type, item, statement_sort_order, sort_order_item)
+            SELECT * FROM unnest(%s::text[], %s::text[], %s::int[], %s::int[]) AS s(statement_type, item, sso, soi)
+            WHERE NOT EXISTS (SELECT 1 FROM {dim_item} d WHERE d.statement_type = s.statement_type AND d.item = s.item)
+            ON CONFLICT (statement_type, item) DO NOTHING;
+        """).format(dim_item=sql.Identifier(*DIM_ITEM_TABLE)),
+            [list(column) for column in zip(*seed_rows)])
+        conn.commit()
+        logging.info(f"Dimension tables ready; {cur.rowcount} of {len(seed_rows)} mapped items were new to dim_item.")
+    except psycopg2.Error as e:
+        if conn: conn.rollback()
+        logging.error(f"Could not prepare the dimension tables: {e}", exc_info=True)
+    finally:
+        if conn:
+            conn.close()
+
+
+def resolve_item_ids(cur, df):
+    """Returns {(statement_type, item): item_id} for the frame's items, adding unmapped items to dim_item first."""
+    items = df[['statement_type', 'item', 'statement_sort_order', 'sort_order_item']].drop_duplicates(subset=['statement_type', 'item'])
+    arrays = [items['statement_type'].astype(str).tolist(), items['item'].astype(str).tolist(),
+              [None if pd.isna(value) else int(value) for value in items['statement_sort_order']],
+              [None if pd.isna(value) else int(value) for value in items['sort_order_item']]]
+    cur.execute(sql.SQL("""
+        INSERT INTO {dim_item} (statement_type, item, statement_sort_order, sort_order_item)
+        SELECT * FROM unnest(%s::text[], %s::text[], %s::int[], %s::int[]) AS s(statement_type, item, sso, soi)
+        WHERE NOT EXISTS (SELECT 1 FROM {dim_item} d WHERE d.statement_type = s.statement_type AND d.item = s.item)
+        ON CONFLICT (statement_type, item) DO NOTHING;
+    """).format(dim_item=sql.Identifier(*DIM_ITEM_TABLE)), arrays)
+    cur.execute(sql.SQL("""
+        SELECT d.statement_type, d.item, d.item_id FROM {dim_item} d
+        JOIN unnest(%s::text[], %s::text[]) AS k(statement_type, item) ON d.statement_type = k.statement_type AND d.item = k.item;
+    """).format(dim_item=sql.Identifier(*DIM_ITEM_TABLE)), arrays[:2])
+    return {(statement_type, item): item_id for statement_type, item, item_id in cur.fetchall()}
+
+
+def resolve_period_ids(cur, headers):
+    """Returns {header: period_id} for the given headers, adding new headers (with their ordinal) to dim_period first."""
+    headers = pd.Series(sorted(set(headers)), dtype=object)
+    ordinals = encode_period_ordinals(headers)
+    known = ordinals > 0
+    fiscal_periods = headers.str.split('_').str[0].where(known, None)
+    fiscal_years = (ordinals // 10).where(known, None)
+    cur.execute(sql.SQL("""
+        INSERT INTO {dim_period} (header, fiscal_period, fiscal_year, period_ordinal)
+        SELECT * FROM unnest(%s::text[], %s::text[], %s::smallint[], %s::int[]) AS s(header, fp, fy, ordinal)
+        WHERE NOT EXISTS (SELECT 1 FROM {dim_period} d WHERE d.header = s.header)
+        ON CONFLICT (header) DO NOTHING;
+    """).format(dim_period=sql.Identifier(*DIM_PERIOD_TABLE)), (
+        headers.tolist(), fiscal_periods.tolist(), [None if pd.isna(year) else int(year) for year in fiscal_years], ordinals.tolist()
+    ))
+    cur.execute(sql.SQL("SELECT header, period_id FROM {dim_period} WHERE header = ANY(%s);").format(
+        dim_period=sql.Identifier(*DIM_PERIOD_TABLE)
+    ), (headers.tolist(),))
+    return dict(cur.fetchall())
+
+
+def attach_dimension_ids(cur, df):
+    """Adds the item_id and period_id columns the fact tables store in place of statement_type/item and header."""
+    item_ids = resolve_item_ids(cur, df)
+    period_ids = resolve_period_ids(cur, df['header'].astype(str))
+    return df.assign(
+        item_id=[item_ids[key] for key in zip(df['statement_type'].astype(str), df['item'].astype(str))],
+        period_id=df['header'].astype(str).map(period_ids)
+    )
+
+
+def upsert_from_staging(cur, df, full_table_name, table_columns, key_columns):
+    """
+    Loads the DataFrame into a temporary staging table with COPY and applies only the difference
+    to the target table: new keys are inserted, rows whose non-key columns changed are updated,
+    and rows that no longer exist in the source are deleted. Unchanged rows are not rewritten.
+    Returns (rows_upserted, rows_deleted).
+    """
+    staging_table = sql.Identifier("staging_company_load")
+    key_list = sql.SQL(", ").join(sql.Identifier(col) for col in key_columns)
+    value_columns = [col for col, _ in table_columns if col not in key_columns]
+    column_list = sql.SQL(", ").join(sql.Identifier(col) for col, _ in table_columns)
+
+    cur.execute(sql.SQL("CREATE TEMP TABLE {staging} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP;").format(
+        staging=staging_table, target=full_table_name
+    ))
+    copy_dataframe(cur, df, staging_table, table_columns)
+
+    upsert_query = sql.SQL("""
+        INSERT INTO {target} AS t ({columns})
+        SELECT {columns} FROM {staging}
+        ON CONFLICT ({keys}) DO UPDATE SET {assignments}
+        WHERE ({current_values}) IS DISTINCT FROM ({new_values});
+    """).format(
+        target=full_table_name,
+        staging=staging_table,
+        columns=column_list,
+        keys=key_list,
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(col)) for col in value_columns
+        ),
+        current_values=sql.SQL(", ").join(sql.SQL("t.{col}").format(col=sql.Identifier(col)) for col in value_columns),
+        new_values=sql.SQL(", ").join(sql.SQL("EXCLUDED.{col}").format(col=sql.Identifier(col)) for col in value_columns)
+    )
+    cur.execute(upsert_query)
+    rows_upserted = cur.rowcount
+
+    delete_query = sql.SQL("""
+        DELETE FROM {target} AS t
+        WHERE NOT EXISTS (SELECT 1 FROM {staging} s WHERE {key_match});
+    """).format(
+        target=full_table_name,
+        staging=staging_table,
+        key_match=sql.SQL(" AND ").join(
+            sql.SQL("s.{col} = t.{col}").format(col=sql.Identifier(col)) for col in key_columns
+        )
+    )
+    cur.execute(delete_query)
+    rows_deleted = cur.rowcount
+    return rows_upserted, rows_deleted
+
+
+def prepare_company_frame(df, company_metadata):
+    """Deduplicates a company's rows on the table key and attaches the company-level metadata."""
+    df = df.drop_duplicates(subset=FS_TABLE_KEY, keep='first')
+    # Company-level metadata comes from the discovery record, not from the fact rows.
+    df = df.assign(
+        symbol=df['symbol'].astype(str).str.lower(),
+        period_ordinal=encode_period_ordinals(df['header']),
+        sector=company_metadata.get('sector'),
+        industry=company_metadata.get('industry'),
+        market_cap_group=company_metadata.get('market_cap_group'),
+        country=company_metadata.get('country')
+    )
+    if 'sort_order_metric' not in df.columns:
+        df['sort_order_metric'] = 0
+    return df
+
+
 def create_and_insert_data(df_to_insert, symbol, company_name, company_metadata):
     """
-    Drops and recreates the table for a single company, then inserts the processed data.
+    Loads the processed data for a single company. The company, its items and its periods are registered in
+    the dimension tables and its table stores the facts under the returned ids. In "upsert" mode the table is
+    kept in place and only changed rows are written; in "replace" mode the table is dropped, recreated and bulk-loaded.
+    Returns True if the company table was committed.
     """
     conn = None
     try:
         conn = psycopg2.connect(**DB_PARAMS)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         cur = conn.cursor()
         cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {schema};").format(schema=sql.Identifier(SCHEMA_NAME)))
 
         table_name_str = symbol.lower().replace('.', '_')
         full_table_name = sql.Identifier(SCHEMA_NAME, table_name_str)
 
+        df_to_insert = prepare_company_frame(df_to_insert, company_metadata)
+        symbol_id = upsert_company(cur, {**company_metadata, 'symbol': symbol, 'company_name': company_name})
+        df_to_insert = attach_dimension_ids(cur, df_to_insert.assign(symbol_id=symbol_id))
+        conn.commit()  # The dimensions are append-only; committing now keeps other workers from waiting on new keys
+
+        # Tables created before the upsert mode or the current fact layout existed are rebuilt once.
+        if (REFRESH_MODE == "upsert" and table_has_primary_key(cur, SCHEMA_NAME, table_name_str)
+                and table_has_columns(cur, SCHEMA_NAME, table_name_str, FS_FACT_COLUMNS)):
+            rows_upserted, rows_deleted = upsert_from_staging(cur, df_to_insert, full_table_name, FS_FACT_COLUMNS, FS_FACT_KEY)
+            conn.commit()
+            logging.info(f"Refreshed {full_table_name.as_string(conn)} in place: {rows_upserted} rows inserted/updated, "
+                         f"{rows_deleted} rows deleted, {len(df_to_insert)} rows in source.")
+            return True
+
         logging.debug(f"Dropping table {full_table_name.as_string(conn)} if it exists to ensure fresh schema.")
         cur.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_table_name))
-
-        # --- REVISED SECTION: New column order and added 'sort_order_metric' ---
-        create_table_query = sql.SQL("""
-            CREATE TABLE {table_name} (
-                symbol TEXT,
-                company_name TEXT,
-                sector TEXT,
-                industry TEXT,
-                market_cap_group TEXT,
-                statement_type TEXT,
-                item TEXT,
-                header TEXT,
-                original_value NUMERIC,
-                original_currency TEXT,
-                forex_rate_vs_usd NUMERIC,
-                value NUMERIC,
-                sort_order_item INTEGER,
-                sort_order_metric INTEGER,
-                sort_key INTEGER,
-                extracted_order INTEGER,
-                period_date DATE,
-                filing_type TEXT,
-                country TEXT,
-                statement_sort_order INTEGER, -- <-- ADD THIS LINE,
-                PRIMARY KEY (symbol, statement_type, item, header)
-            );
-        """).format(table_name=full_table_name)
+        create_table_query = sql.SQL("CREATE TABLE {table_name} ({columns}, PRIMARY KEY ({keys}));").format(
+            table_name=full_table_name,
+            columns=build_column_definitions(FS_FACT_COLUMNS),
+            keys=sql.SQL(", ").join(sql.Identifier(col) for col in FS_FACT_KEY)
+        )
         cur.execute(create_table_query)
 
-        df_to_insert.drop_duplicates(subset=['symbol', 'statement_type', 'item', 'header'], keep='first', inplace=True)
-
-        insert_data = []
-        for _, row in df_to_insert.iterrows():
-            original_val = pd.to_numeric(row.get('original_value'), errors='coerce')
-            final_val_usd = pd.to_numeric(row.get('value'), errors='coerce')
-            forex_rate = pd.to_numeric(row.get('forex_rate_vs_usd'), errors='coerce')
-            symbol_lower = str(row.get('symbol', '')).lower()
-
-            # Reorder the tuple to match the new table structure
-            insert_data.append((
-                symbol_lower,
-                row.get('company_name'),
-                company_metadata.get('sector'),
-                company_metadata.get('industry'),
-                company_metadata.get('market_cap_group'),
-                row.get('statement_type'),
-                row.get('item'),
-                row.get('header'),
-                None if pd.isna(original_val) else original_val,
-                row.get('original_currency'),
-                None if pd.isna(forex_rate) else forex_rate,
-                None if pd.isna(final_val_usd) else final_val_usd,
-                row.get('sort_order_item'),
-                row.get('sort_order_metric', 0),  # Default to 0 if not present
-                row.get('sort_key'),
-                row.get('extracted_order'),
-                row.get('period_date'),
-                row.get('filing_type'),
-                company_metadata.get('country'),
-                row.get('statement_sort_order')
-            ))
-
-        # Update column list in INSERT query to match the new order
-        insert_query = sql.SQL("""
-            INSERT INTO {table_name} (
-                symbol, company_name, sector, industry, market_cap_group,
-                statement_type, item, header, original_value, original_currency,
-                forex_rate_vs_usd, value, sort_order_item, sort_order_metric,
-                sort_key, extracted_order, period_date, filing_type, country, statement_sort_order
-            ) VALUES %s;
-        """).format(table_name=full_table_name)
-        # --- END REVISED SECTION ---
-
-        if insert_data:
-            execute_values(cur, insert_query, insert_data, page_size=500)
-            logging.info(f"Successfully inserted {len(insert_data)} rows into {full_table_name.as_string(conn)}.")
+        if not df_to_insert.empty:
+            copy_dataframe(cur, df_to_insert, full_table_name, FS_FACT_COLUMNS)
+            logging.info(f"Successfully inserted {len(df_to_insert)} rows into {full_table_name.as_string(conn)}.")
         else:
             logging.info(f"No data to insert for {full_table_name.as_string(conn)}.")
+        conn.commit()
+        return True
 
     except Exception as e:
+        if conn: conn.rollback()
         logging.error(f"Database error for {symbol}: {e}", exc_info=True)
+        return False
     finally:
         if conn:
             if 'cur' in locals() and cur: cur.close()
             conn.close()
 
 
+def reload_company_table_in_current_layout(cursor, company):
+    """Rewrites a company table stored in an older layout (e.g. text item/header columns) through the current loader."""
+    table_id = sql.Identifier(SCHEMA_NAME, company['symbol'].lower().replace('.', '_'))
+    cursor.execute(sql.SQL("SELECT * FROM {table};").format(table=table_id))
+    df = pd.DataFrame(cursor.fetchall(), columns=[column[0] for column in cursor.description])
+    logging.info(f"Converting {len(df)} rows of {company['symbol']} from an older table layout.")
+    return create_and_insert_data(df.assign(symbol=company['symbol']), company['symbol'], company['company_name'], company)
+
+
 def create_aggregate_table(conn, cursor, processed_symbols_info):
     """
-    Drops and recreates the main public aggregate table from all individual company tables.
+    Drops and recreates the main public aggregate fact table from all individual company tables, and
+    the aggregate_table_<schema> view that joins the company attributes back on in the original layout.
     This version is adapted from the stable standalone script.
     """
     aggregate_table_name = f"aggregate_table_{SCHEMA_NAME}"
     full_aggregate_table_id = sql.Identifier("public", aggregate_table_name)
-    logging.info(f"\n--- Recreating aggregate table: {full_aggregate_table_id.as_string(conn)} ---")
+    full_aggregate_fact_id = sql.Identifier("public", f"aggregate_fact_{SCHEMA_NAME}")
+    logging.info(f"\n--- Recreating aggregate table: {full_aggregate_fact_id.as_string(conn)} ---")
 
     # --- Step 1: Drop all dependent materialized views first ---
     logging.info("Dropping all potentially dependent materialized views...")
@@ -1833,13 +2531,21 @@ def create_aggregate_table(conn, cursor, processed_symbols_info):
 
     # --- Step 2: Drop and recreate the aggregate table ---
     logging.info("Recreating the aggregate table structure.")
-    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_aggregate_table_id))
+    drop_table_or_view(cursor, "public", aggregate_table_name)
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_aggregate_fact_id))
 
+    fact_columns = sql.SQL(", ").join(sql.Identifier(col) for col, _ in FS_FACT_COLUMNS)
     union_queries = []
     for company in processed_symbols_info:
         individual_table_name = company['symbol'].lower().replace('.', '_')
         individual_table_id = sql.Identifier(SCHEMA_NAME, individual_table_name)
-        union_queries.append(sql.SQL("SELECT * FROM {individual_table}").format(individual_table=individual_table_id))
+        # Company tables not reloaded since the current fact layout was introduced are converted first.
+        if not table_has_columns(cursor, SCHEMA_NAME, individual_table_name, FS_FACT_COLUMNS):
+            if not reload_company_table_in_current_layout(cursor, company):
+                continue
+        union_queries.append(sql.SQL("SELECT {columns} FROM {individual_table}").format(
+            columns=fact_columns, individual_table=individual_table_id
+        ))
 
     if not union_queries:
         logging.error("No individual company tables found to aggregate.")
@@ -1847,23 +2553,54 @@ def create_aggregate_table(conn, cursor, processed_symbols_info):
 
     full_union_query = sql.SQL(" UNION ALL ").join(union_queries)
     create_table_sql = sql.SQL("CREATE TABLE {agg_table_name} AS ({union_query});").format(
-        agg_table_name=full_aggregate_table_id,
+        agg_table_name=full_aggregate_fact_id,
         union_query=full_union_query
     )
     cursor.execute(create_table_sql)
+    index_aggregate_fact_table(cursor, full_aggregate_fact_id, FS_FACT_KEY)
+
+    # The compatibility view keeps the original column order, taking the text columns from the dimensions.
+    column_sources = {**{col: "d" for col in FS_COMPANY_COLUMNS}, "statement_type": "i", "item": "i", "header": "p"}
+    create_view_sql = sql.SQL("""
+        CREATE VIEW {view_name} AS
+        SELECT {columns}
+        FROM {fact_table} f
+        JOIN {dim_company} d ON d.symbol_id = f.symbol_id
+        JOIN {dim_item} i ON i.item_id = f.item_id
+        JOIN {dim_period} p ON p.period_id = f.period_id;
+    """).format(
+        view_name=full_aggregate_table_id,
+        columns=sql.SQL(", ").join(
+            sql.SQL("{alias}.{col}").format(alias=sql.Identifier(column_sources.get(col, "f")), col=sql.Identifier(col))
+            for col, _ in FS_TABLE_COLUMNS
+        ),
+        fact_table=full_aggregate_fact_id,
+        dim_company=sql.Identifier(*DIM_COMPANY_TABLE),
+        dim_item=sql.Identifier(*DIM_ITEM_TABLE),
+        dim_period=sql.Identifier(*DIM_PERIOD_TABLE)
+    )
+    cursor.execute(create_view_sql)
     conn.commit()
-    logging.info(f"Aggregate table '{full_aggregate_table_id.as_string(conn)}' created successfully.")
+    logging.info(f"Aggregate table '{full_aggregate_fact_id.as_string(conn)}' and view "
+                 f"'{full_aggregate_table_id.as_string(conn)}' created successfully.")
     return True
 
 
-def create_materialized_views(conn, cursor, processed_symbols_info):
+def create_materialized_views(conn, cursor, processed_symbols_info, build_change_mvs=True):
     """
     Orchestrates creation of all materialized views.
-    1. Creates company-specific wide MVs in parallel.
+    1. Creates company-specific wide MVs in parallel (for the companies in processed_symbols_info).
     2. Creates sequential (period-over-period) change MV.
     3. Creates year-over-year change MV.
+    Returns (symbols whose wide MVs were all created, whether both change MVs were created).
     """
-    aggregate_table_id = sql.Identifier("public", f"aggregate_table_{SCHEMA_NAME}")
+    aggregate_fact_id = sql.Identifier("public", f"aggregate_fact_{SCHEMA_NAME}")
+    dim_ids = {
+        'dim_company': sql.Identifier(*DIM_COMPANY_TABLE),
+        'dim_item': sql.Identifier(*DIM_ITEM_TABLE),
+        'dim_period': sql.Identifier(*DIM_PERIOD_TABLE),
+    }
+    change_mvs_ok = build_change_mvs
 
     # --- Part 1: Parallel creation of company-specific wide MVs ---
     logging.info(f"\n--- Starting PARALLEL creation of {len(processed_symbols_info)} sets of company-wide MVs ---")
@@ -1874,44 +2611,54 @@ def create_materialized_views(conn, cursor, processed_symbols_info):
     task_func = partial(create_wide_views_for_ticker_worker, db_params=DB_PARAMS, schema_name=SCHEMA_NAME)
 
     with multiprocessing.Pool(processes=num_processes) as pool:
-        pool.map(task_func, processed_symbols_info)
+        wide_mv_results = pool.map(task_func, processed_symbols_info)
+    built_symbols = [symbol for symbol, ok in wide_mv_results if ok]
     logging.info("--- Finished parallel creation of company-specific wide MVs. ---")
 
+    if not build_change_mvs:
+        return built_symbols, change_mvs_ok
+
     # --- Part 2: Sequential (Period-over-Period) Percent Change MV ---
     logging.info(f"\n--- Creating Sequential (Period-over-Period) Change MV for {SCHEMA_NAME} ---")
     pop_mv_name = sql.Identifier("public", f"{SCHEMA_NAME}_financial_statement_changes")
     try:
         cursor.execute(sql.SQL('DROP MATERIALIZED VIEW IF EXISTS {mv_name};').format(mv_name=pop_mv_name))
 
+        # Quarters, half-years and fiscal years are each compared with the previous period of the same kind.
         create_pop_sql = sql.SQL("""
             CREATE MATERIALIZED VIEW {mv_name} AS
             WITH lagged_values AS (
                 SELECT
-                    t.*,
+                    t.*, i.statement_type, i.item, p.header,
                     lag(t.value, 1) OVER (
-                        PARTITION BY t.symbol, t.statement_type, t.item
-                        ORDER BY t.period_date
+                        PARTITION BY t.symbol_id, t.item_id,
+                                     CASE mod(t.period_ordinal, 10) WHEN 7 THEN 'FY' WHEN 2 THEN 'H' WHEN 5 THEN 'H' ELSE 'Q' END
+                        ORDER BY t.period_ordinal
                     ) AS previous_period_value
                 FROM {agg_table} t
-                WHERE t.statement_type IN ('Income Statement', 'Cash Flow Statement', 'Comprehensive Income')
+                JOIN {dim_item} i ON i.item_id = t.item_id
+                JOIN {dim_period} p ON p.period_id = t.period_id
+                WHERE i.statement_type IN ('Income Statement', 'Cash Flow Statement', 'Comprehensive Income')
             )
             SELECT
-                symbol, company_name, sector, industry, statement_type, item AS financial_metric,
-                header AS period, period_date, value AS current_value, previous_period_value,
-                round(((value - previous_period_value) / abs(NULLIF(previous_period_value, 0))) * 100, 4) AS sequential_percent_change,
-                sort_order_item,
-                sort_order_metric,
-                sort_key,
-                extracted_order,
-                statement_sort_order
-            FROM lagged_values
-            WHERE previous_period_value IS NOT NULL AND value IS NOT NULL
-            ORDER BY symbol, item, period_date;
-        """).format(mv_name=pop_mv_name, agg_table=aggregate_table_id)
+                d.symbol, d.company_name, d.sector, d.industry, l.statement_type, l.item AS financial_metric,
+                l.header AS period, l.period_date, l.value AS current_value, l.previous_period_value,
+                round(((l.value - l.previous_period_value) / abs(NULLIF(l.previous_period_value, 0))) * 100, 4) AS sequential_percent_change,
+                l.sort_order_item,
+                l.sort_order_metric,
+                l.sort_key,
+                l.extracted_order,
+                l.statement_sort_order
+            FROM lagged_values l
+            JOIN {dim_company} d ON d.symbol_id = l.symbol_id
+            WHERE l.previous_period_value IS NOT NULL AND l.value IS NOT NULL
+            ORDER BY d.symbol, l.item, l.period_ordinal;
+        """).format(mv_name=pop_mv_name, agg_table=aggregate_fact_id, **dim_ids)
         cursor.execute(create_pop_sql)
         logging.info(f"Sequential PoP MV '{pop_mv_name.as_string(conn)}' created.")
     except Exception as e:
         logging.error(f"Error creating Sequential PoP MV: {e}", exc_info=True)
+        change_mvs_ok = False
 
     # --- Part 3: Year-over-Year Percent Change MV ---
     logging.info(f"\n--- Creating Year-over-Year (YoY) Change MV for {SCHEMA_NAME} ---")
@@ -1921,39 +2668,40 @@ def create_materialized_views(conn, cursor, processed_symbols_info):
 
         create_yoy_sql = sql.SQL("""
             CREATE MATERIALIZED VIEW {mv_name} AS
-            WITH parsed_periods AS (
-                SELECT t.*, SUBSTRING(t.header FROM '^[A-Z0-9]+') AS period_type
-                FROM {agg_table} t
-                WHERE t.statement_type IN ('Income Statement', 'Cash Flow Statement', 'Comprehensive Income')
-            ),
-            lagged_values AS (
+            WITH lagged_values AS (
                 SELECT
-                    p.*,
-                    lag(p.value, 1) OVER (
-                        PARTITION BY p.symbol, p.statement_type, p.item, p.period_type
-                        ORDER BY p.period_date
+                    t.*, i.statement_type, i.item, p.header,
+                    lag(t.value, 1) OVER (
+                        PARTITION BY t.symbol_id, t.item_id, mod(t.period_ordinal, 10)
+                        ORDER BY t.period_ordinal
                     ) AS previous_year_value
-                FROM parsed_periods p
+                FROM {agg_table} t
+                JOIN {dim_item} i ON i.item_id = t.item_id
+                JOIN {dim_period} p ON p.period_id = t.period_id
+                WHERE i.statement_type IN ('Income Statement', 'Cash Flow Statement', 'Comprehensive Income')
             )
             SELECT
-                symbol, company_name, sector, industry, statement_type, item AS financial_metric,
-                header AS period, period_date, value AS current_value, previous_year_value,
-                round(((value - previous_year_value) / abs(NULLIF(previous_year_value, 0))) * 100, 4) AS yoy_percent_change,
-                sort_order_item,
-                sort_order_metric,
-                sort_key,
-                extracted_order,
-                statement_sort_order
-            FROM lagged_values
-            WHERE previous_year_value IS NOT NULL AND value IS NOT NULL
-            ORDER BY symbol, item, period_date;
-        """).format(mv_name=yoy_mv_name, agg_table=aggregate_table_id)
+                d.symbol, d.company_name, d.sector, d.industry, l.statement_type, l.item AS financial_metric,
+                l.header AS period, l.period_date, l.value AS current_value, l.previous_year_value,
+                round(((l.value - l.previous_year_value) / abs(NULLIF(l.previous_year_value, 0))) * 100, 4) AS yoy_percent_change,
+                l.sort_order_item,
+                l.sort_order_metric,
+                l.sort_key,
+                l.extracted_order,
+                l.statement_sort_order
+            FROM lagged_values l
+            JOIN {dim_company} d ON d.symbol_id = l.symbol_id
+            WHERE l.previous_year_value IS NOT NULL AND l.value IS NOT NULL
+            ORDER BY d.symbol, l.item, l.period_ordinal;
+        """).format(mv_name=yoy_mv_name, agg_table=aggregate_fact_id, **dim_ids)
         cursor.execute(create_yoy_sql)
         logging.info(f"YoY MV '{yoy_mv_name.as_string(conn)}' created.")
     except Exception as e:
         logging.error(f"Error creating YoY MV: {e}", exc_info=True)
+        change_mvs_ok = False
 
     conn.commit()
+    return built_symbols, change_mvs_ok
 
 
 def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
@@ -1961,6 +2709,7 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
     Worker function to create wide-format materialized views for a single company.
     This function is designed to be called by a multiprocessing Pool.
     It connects to the database, generates, and executes the SQL for the MVs.
+    Returns (symbol, True) if every MV for the company was created.
     """
     # --- CHANGE 1: Unpack the new metadata from the ticker_info dictionary ---
     symbol = ticker_info['symbol']
@@ -1978,9 +2727,20 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
 
         logging.info(f"WORKER for '{symbol}': Starting wide MV creation.")
 
-        aggregate_table_id = sql.Identifier("public", f"aggregate_table_{schema_name}")
+        aggregate_table_id = sql.Identifier("public", f"aggregate_fact_{schema_name}")
         ticker_clean_str = symbol.lower().replace('.', '_')
 
+        cursor.execute(sql.SQL("SELECT symbol_id FROM {dim_table} WHERE symbol = %s;").format(
+            dim_table=sql.Identifier(*DIM_COMPANY_TABLE)
+        ), (symbol.lower(),))
+        symbol_id_row = cursor.fetchone()
+        if symbol_id_row is None:
+            logging.warning(f"WORKER for '{symbol}': Not in the company dimension, skipping MVs.")
+            return symbol, False
+        symbol_id = symbol_id_row[0]
+        dim_item_id = sql.Identifier(*DIM_ITEM_TABLE)
+        dim_period_id = sql.Identifier(*DIM_PERIOD_TABLE)
+
         # Define the financial statements to create views for.
         statement_types_for_mv = [
             {"display_name": "Balance Sheet", "slug": "bs_wide"},
@@ -1997,29 +2757,22 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
             mv_name_str = f"{ticker_clean_str}_{stmt_info['slug']}"
             full_mv_name = sql.Identifier(schema_name, mv_name_str)
 
-            # Fetch the headers (e.g., Q1_2023, Q2_2023) for the current statement type
+            # Fetch the headers (e.g., Q1_2023, Q2_2023) for the current statement type, most recent first
             header_query = sql.SQL("""
-                SELECT DISTINCT header FROM {agg_table}
-                WHERE lower(symbol) = %s AND statement_type = %s;
-            """).format(agg_table=aggregate_table_id)
-            cursor.execute(header_query, (symbol.lower(), statement_type_display))
-
-            headers = [row[0] for row in cursor.fetchall()]
-            if not headers:
+                SELECT p.header FROM {dim_period} p
+                WHERE p.period_id IN (
+                    SELECT f.period_id FROM {agg_table} f JOIN {dim_item} i ON i.item_id = f.item_id
+                    WHERE f.symbol_id = %s AND i.statement_type = %s
+                )
+                ORDER BY p.period_ordinal DESC;
+            """).format(agg_table=aggregate_table_id, dim_item=dim_item_id, dim_period=dim_period_id)
+            cursor.execute(header_query, (symbol_id, statement_type_display))
+
+            ordered_headers = [row[0] for row in cursor.fetchall()]
+            if not ordered_headers:
                 logging.debug(f"WORKER for '{symbol}': No data for '{statement_type_display}', skipping MV.")
                 continue
 
-            # Sort headers chronologically (most recent first)
-            def sort_key_func(h):
-                parts = h.split('_')
-                if len(parts) != 2 or not parts[1].isdigit(): return (0, 0)
-                year = int(parts[1])
-                period_map = {'Q1': 1, 'Q2': 2, 'H1': 2.5, 'Q3': 3, 'Q4': 4, 'H2': 4.5, 'FY': 5}
-                period = period_map.get(parts[0], 99)
-                return (year, period)
-
-            ordered_headers = sorted(headers, key=sort_key_func, reverse=True)
-
             # Define the columns for the crosstab function (pivoted table)
             crosstab_defs_list = ["item TEXT", "sort_order_item INTEGER", "sort_order_metric INTEGER"] + \
                                  [sql.SQL("{h} NUMERIC").format(h=sql.Identifier(h)).as_string(conn) for h in ordered_headers]
@@ -2027,11 +2780,14 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
 
             # SQL to get the source data for pivoting
             source_sql_str = cursor.mogrify(sql.SQL("""
-                SELECT item, sort_order_item, sort_order_metric, header, value
-                FROM {agg_table}
-                WHERE lower(symbol) = %s AND statement_type = %s
+                SELECT i.item, f.sort_order_item, f.sort_order_metric, p.header, f.value
+                FROM {agg_table} f
+                JOIN {dim_item} i ON i.item_id = f.item_id
+                JOIN {dim_period} p ON p.period_id = f.period_id
+                WHERE f.symbol_id = %s AND i.statement_type = %s
                 ORDER BY 1, 2, 3;
-            """).format(agg_table=aggregate_table_id), (symbol.lower(), statement_type_display)).decode('utf-8')
+            """).format(agg_table=aggregate_table_id, dim_item=dim_item_id, dim_period=dim_period_id),
+                (symbol_id, statement_type_display)).decode('utf-8')
 
             # SQL to get the category columns for pivoting
             category_sql_str = cursor.mogrify("SELECT unnest(%s::text[])", (ordered_headers,)).decode('utf-8')
@@ -2069,6 +2825,7 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
             cursor.execute(final_query, (symbol, company_name, sector, industry, market_cap_group))
 
         logging.info(f"WORKER: Successfully created all wide MVs for {symbol}.")
+        return symbol, True
 
     except psycopg2.Error as e:
         logging.error(f"WORKER DB ERROR for ticker {symbol}: {e}")
@@ -2077,35 +2834,507 @@ def create_wide_views_for_ticker_worker(ticker_info, db_params, schema_name):
     finally:
         if conn:
             conn.close()
+    return symbol, False
+
+
+# ==============================================================================
+# PARQUET STAGING FUNCTIONS
+# ==============================================================================
+
+def conform_to_table_schema(df, table_columns):
+    """Selects the table's columns in schema order and coerces each one to the type it will have in Postgres."""
+    conformed = pd.DataFrame(index=df.index)
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').astype('float64')
+        elif pg_type in ('INTEGER', 'BIGINT', 'SMALLINT'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').round().astype('Int64')
+        elif pg_type == 'DATE':
+            conformed[col] = pd.to_datetime(series, errors='coerce')
+        else:
+            conformed[col] = series.astype(object).where(series.notna(), None).map(lambda v: v if v is None else str(v))
+    return conformed.reset_index(drop=True)
+
+
+def write_parquet_dataset(df, dataset_dir, partition_cols, table_columns, dictionary_cols=()):
+    """
+    Writes rows to a hive-partitioned Parquet dataset, replacing only the partitions present in df.
+    Columns in dictionary_cols are stored dictionary-encoded and read back as pandas categoricals.
+    """
+    if pa is None:
+        logging.warning("pyarrow is not installed; skipping Parquet staging.")
+        return
+    staged_df = conform_to_table_schema(df, table_columns)
+    for col in dictionary_cols:
+        staged_df[col] = staged_df[col].astype('category')
+    ds.write_dataset(
+        pa.Table.from_pandas(staged_df, preserve_index=False), dataset_dir, format='parquet',
+        partitioning=partition_cols, partitioning_flavor='hive',
+        existing_data_behavior='delete_matching', basename_template='part-{i}.parquet'
+    )
+
+
+def read_parquet_dataset(dataset_dir, partition_cols, filter_expression=None, columns=None):
+    """Reads a hive-partitioned Parquet dataset (optionally filtered and column-pruned) into a DataFrame."""
+    partitioning = ds.partitioning(pa.schema([(col, pa.string()) for col in partition_cols]), flavor='hive')
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=partitioning)
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def reload_company_tables_from_parquet(dataset_dir):
+    """Rebuilds every company table of the configured sector from the staged dataset, without any network calls."""
+    df = read_parquet_dataset(dataset_dir, ['sector', 'symbol'], filter_expression=ds.field('sector') == SECTOR_TO_PROCESS)
+    if df.empty:
+        logging.warning(f"No staged data found for sector '{SECTOR_TO_PROCESS}' in {dataset_dir}.")
+        return []
+
+    processed_symbols_info = []
+    for symbol, company_df in df.groupby('symbol', sort=True):
+        company_info = company_df.iloc[0][['symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 'country']].to_dict()
+        create_and_insert_data(company_df.reset_index(drop=True), symbol, company_info['company_name'], company_info)
+        processed_symbols_info.append(company_info)
+    logging.info(f"Reloaded {len(processed_symbols_info)} company tables from {dataset_dir}.")
+    return processed_symbols_info
+
+
+# ==============================================================================
+# RUN JOURNAL (CHECKPOINT / RESUME)
+# ==============================================================================
+
+def frame_content_hash(df):
+    """Returns a stable SHA-256 of a DataFrame's columns and values, used to detect unchanged work."""
+    try:
+        row_hashes = pd.util.hash_pandas_object(df, index=False)
+    except TypeError:  # Unhashable cells (lists, dicts) are hashed through their text form
+        row_hashes = pd.util.hash_pandas_object(df.astype(str), index=False)
+    digest = hashlib.sha256(",".join(map(str, df.columns)).encode())
+    digest.update(row_hashes.to_numpy().tobytes())
+    return digest.hexdigest()
+
+
+class RunJournal:
+    """
+    Append-only JSON-lines record of which stage each company reached in a run (fetched, transformed,
+    loaded, wide_mvs) plus run-level stages (universe, forex, aggregate, change_mvs). Expensive inputs
+    and transformed frames are cached next to it so a resumed run can pick up where the last one stopped.
+    """
+    RUN_KEY = "__run__"
+
+    def __init__(self, path, cache_dir, resume=False):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = {}
+        self.last_entries = {}
+
+        previous_entries = []
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                previous_entries = [json.loads(line) for line in f if line.strip()]
+
+        if resume and previous_entries:
+            self.run_id = previous_entries[-1]['run_id']
+            for entry in previous_entries:
+                if entry['run_id'] == self.run_id:
+                    self.entries[(entry['symbol'], entry['stage'])] = entry
+                    self.last_entries[entry['symbol']] = entry
+            logging.info(f"Resuming run {self.run_id} with {len(self.entries)} journaled stage entries.")
+        else:
+            if resume:
+                logging.warning(f"No previous run found in {path}; starting a new run.")
+            self.run_id = datetime.now().strftime('%Y%m%dT%H%M%S')
+            logging.info(f"Starting run {self.run_id}; journal at {path}.")
+
+        self.cache_dir = os.path.join(cache_dir, self.run_id)
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def record(self, symbol, stage, status='ok', content_hash=None, detail=None):
+        entry = {'run_id': self.run_id, 'ts': datetime.now().isoformat(timespec='seconds'), 'symbol': symbol,
+                 'stage': stage, 'status': status, 'hash': content_hash, 'detail': detail}
+        with self._lock:
+            self.entries[(symbol, stage)] = entry
+            self.last_entries[symbol] = entry
+            with open(self.path, 'a', encoding="utf-8") as f:
+                f.write(json.dumps(entry) + "\n")
+
+    def latest(self, symbol, stage):
+        return self.entries.get((symbol, stage))
+
+    def is_done(self, symbol, stage):
+        entry = self.latest(symbol, stage)
+        return entry is not None and entry['status'] == 'ok'
+
+    def company_outcome(self, symbol):
+        """Returns 'loaded', 'empty', 'failed' or None (not attempted yet in this run)."""
+        if self.is_done(symbol, 'loaded'):
+            return 'loaded'
+        last_entry = self.last_entries.get(symbol)
+        if last_entry is None:
+            return None
+        # Anything short of a load, other than a clean "no data", means the company was interrupted or failed.
+        return 'empty' if last_entry['status'] == 'empty' else 'failed'
+
+    def _cache_path(self, name):
+        return os.path.join(self.cache_dir, f"{name.lower().replace('.', '_')}.pkl")
+
+    def save_frame(self, symbol, stage, df):
+        """Caches a frame for this run and journals the stage with the frame's content hash."""
+        df.to_pickle(self._cache_path(f"{symbol}.{stage}"))
+        self.record(symbol, stage, 'ok', frame_content_hash(df))
+
+    def load_frame(self, symbol, stage):
+        """Returns the cached frame for a completed stage, or None if it is missing or does not match its hash."""
+        entry = self.latest(symbol, stage)
+        cache_path = self._cache_path(f"{symbol}.{stage}")
+        if entry is None or entry['status'] != 'ok' or not os.path.exists(cache_path):
+            return None
+        df = pd.read_pickle(cache_path)
+        if frame_content_hash(df) != entry['hash']:
+            logging.warning(f"Cached '{stage}' frame for {symbol} does not match its journaled hash; redoing it.")
+            return None
+        return df
+
+    def save_run_artifact(self, name, df):
+        self.save_frame(self.RUN_KEY, name, df)
+
+    def load_run_artifact(self, name):
+        return self.load_frame(self.RUN_KEY, name)
+
+
+# ==============================================================================
+# EARNINGS-CALENDAR REFRESH SCHEDULING
+# ==============================================================================
+UNCHANGED_SINCE_LAST_LOAD = "unchanged since last load"  # Journal detail for companies the scheduler skipped
+
+
+def ensure_refresh_log_table(cur):
+    cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {schema};").format(schema=sql.Identifier(SCHEMA_NAME)))
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {table} (symbol TEXT PRIMARY KEY, loaded_at TIMESTAMP NOT NULL);").format(
+        table=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)))
+
+
+def select_companies_due_for_refresh(schedule_df, today=None):
+    """
+    Given one row per company with the screener's filing/earnings dates and the time of its last load
+    (loaded_at), returns the lowercased symbols whose data could have changed since that load:
+    never loaded, a filing or earnings release dated on or after the load day, or a nextEarningsDate that
+    has passed since the load (the screener's filing dates can lag the release by a day or two).
+    """
+    today = pd.Timestamp(today or datetime.now().date())
+    loaded_on = pd.to_datetime(schedule_df['loaded_at'], errors='coerce').dt.normalize()
+    due = loaded_on.isna()
+    for col in SCREENER_FILING_DATE_COLUMNS:
+        filed_on = pd.to_datetime(schedule_df[col], errors='coerce')
+        due |= filed_on >= loaded_on
+    expected_on = pd.to_datetime(schedule_df['next_earnings_date'], errors='coerce')
+    due |= (expected_on > loaded_on) & (expected_on <= today)
+    return set(schedule_df.loc[due, 'symbol'])
+
+
+def fetch_refresh_schedule(symbols):
+    """
+    Returns the subset of the given symbols (lowercased) that need a refresh, or None when the screener table
+    cannot be read, in which case every company should be refreshed. Symbols missing from the screener table
+    are always due.
+    """
+    schema_name, table_name = SCREENER_TABLE
+    date_columns = SCREENER_FILING_DATE_COLUMNS + ['next_earnings_date']
+    lowered = sorted({symbol.lower() for symbol in symbols})
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        cur = conn.cursor()
+        ensure_refresh_log_table(cur)
+        conn.commit()
+        cur.execute(sql.SQL("""
+            SELECT u.symbol, {date_columns}, l.loaded_at
+            FROM unnest(%s::text[]) AS u(symbol)
+            LEFT JOIN {screener} s ON s.symbol = u.symbol
+            LEFT JOIN {log} l ON l.symbol = u.symbol;
+        """).format(
+            date_columns=sql.SQL(", ").join(sql.SQL("s.{}::text").format(sql.Identifier(col)) for col in date_columns),
+            screener=sql.Identifier(schema_name, table_name),
+            log=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)
+        ), (lowered,))
+        schedule_df = pd.DataFrame(cur.fetchall(), columns=['symbol'] + date_columns + ['loaded_at'])
+    except psycopg2.Error as e:
+        logging.warning(f"Could not read the refresh schedule from {schema_name}.{table_name}; refreshing every company: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    due_symbols = select_companies_due_for_refresh(schedule_df)
+    logging.info(f"Earnings calendar: {len(due_symbols)} of {len(lowered)} companies could have new filings since their last load.")
+    return due_symbols
+
+
+def record_company_loads(loaded_at_by_symbol):
+    """Stores the time of each company's successful load, which the next run's schedule is measured from."""
+    if not loaded_at_by_symbol:
+        return
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        cur = conn.cursor()
+        ensure_refresh_log_table(cur)
+        cur.executemany(sql.SQL("""
+            INSERT INTO {log} (symbol, loaded_at) VALUES (%s, %s)
+            ON CONFLICT (symbol) DO UPDATE SET loaded_at = EXCLUDED.loaded_at;
+        """).format(log=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)),
+            [(symbol.lower(), loaded_at) for symbol, loaded_at in loaded_at_by_symbol.items()])
+        conn.commit()
+    except psycopg2.Error as e:
+        if conn: conn.rollback()
+        logging.error(f"Could not record company loads in {SCHEMA_NAME}.{REFRESH_LOG_TABLE}: {e}", exc_info=True)
+    finally:
+        if conn:
+            conn.close()
+
+
+# ==============================================================================
+# PIPELINE METRICS (STAGE TIMINGS)
+# ==============================================================================
+class PipelineMetrics:
+    """
+    Thread-safe stage timers and counters for one run. Samples are tagged with the company the
+    calling thread is working on (see company()), so they roll up per company and per run.
+    Rate-limiter waits are recorded as 'wait_<limiter>' stages and overlap the fetch stages they block.
+    """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.stage_seconds = defaultdict(dict)  # symbol -> {stage: seconds}
+        self.counters = defaultdict(dict)  # symbol -> {counter: count}
+        self.stage_order = {}  # Stages in the order they were first seen, for reporting
+        self.started_at = time.perf_counter()
+
+    @contextmanager
+    def company(self, symbol):
+        """Attributes every sample taken on this thread to the given company until the block exits."""
+        self._local.symbol = symbol
+        try:
+            yield
+        finally:
+            self._local.symbol = None
+
+    def _current_symbol(self):
+        return getattr(self._local, 'symbol', None) or RunJournal.RUN_KEY
+
+    def add_time(self, stage, seconds):
+        symbol = self._current_symbol()
+        with self._lock:
+            self.stage_order.setdefault(stage, len(self.stage_order))
+            stages = self.stage_seconds[symbol]
+            stages[stage] = stages.get(stage, 0.0) + seconds
+
+    def count(self, counter, amount=1):
+        symbol = self._current_symbol()
+        with self._lock:
+            counters = self.counters[symbol]
+            counters[counter] = counters.get(counter, 0) + amount
+
+    @contextmanager
+    def stage(self, stage):
+        """Times the enclosed block and adds it to the current company's total for the stage."""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(stage, time.perf_counter() - started)
+
+    def company_summary(self, symbol):
+        """One-line summary of a company's stage timings, for the worker's log."""
+        with self._lock:
+            stages = dict(self.stage_seconds.get(symbol, {}))
+        ordered = sorted(stages.items(), key=lambda kv: self.stage_order[kv[0]])
+        return ", ".join(f"{stage}={seconds:.2f}s" for stage, seconds in ordered)
+
+    def run_summary(self):
+        """Per-stage distribution of company timings (p50/p95/max) plus run-level stages, as a DataFrame."""
+        with self._lock:
+            company_stages = {s: dict(v) for s, v in self.stage_seconds.items() if s != RunJournal.RUN_KEY}
+            run_stages = dict(self.stage_seconds.get(RunJournal.RUN_KEY, {}))
+        rows = []
+        for stage in sorted(self.stage_order, key=self.stage_order.get):
+            samples = np.array([stages[stage] for stages in company_stages.values() if stage in stages])
+            if samples.size:
+                rows.append({'stage': stage, 'companies': samples.size, 'total_s': samples.sum(),
+                             'p50_s': np.percentile(samples, 50), 'p95_s': np.percentile(samples, 95), 'max_s': samples.max()})
+            if stage in run_stages:
+                rows.append({'stage': f"{stage} (run)", 'companies': None, 'total_s': run_stages[stage],
+                             'p50_s': None, 'p95_s': None, 'max_s': None})
+        return pd.DataFrame(rows, columns=['stage', 'companies', 'total_s', 'p50_s', 'p95_s', 'max_s'])
+
+    def counter_totals(self):
+        totals = defaultdict(int)
+        with self._lock:
+            for counters in self.counters.values():
+                for counter, amount in counters.items():
+                    totals[counter] += amount
+        return dict(totals)
+
+    def log_run_summary(self):
+        elapsed = time.perf_counter() - self.started_at
+        summary_df = self.run_summary()
+        if not summary_df.empty:
+            logging.info("\n--- Stage timings (seconds per company) ---\n" + summary_df.round(3).to_string(index=False))
+        totals = self.counter_totals()
+        rows_loaded = totals.get('rows_loaded', 0)
+        logging.info(f"Run took {elapsed:.1f}s: {totals.get('companies_loaded', 0)} companies and {rows_loaded} rows loaded "
+                     f"({rows_loaded / elapsed if elapsed else 0:.0f} rows/s). Counters: {totals}")
+
+    def export_json(self, path, run_id=None):
+        """Writes the raw per-company samples, counters and the run summary to a JSON file."""
+        with self._lock:
+            payload = {
+                'run_id': run_id,
+                'elapsed_seconds': time.perf_counter() - self.started_at,
+                'stage_seconds': {s: dict(v) for s, v in self.stage_seconds.items()},
+                'counters': {s: dict(v) for s, v in self.counters.items()},
+            }
+        payload['summary'] = self.run_summary().replace({np.nan: None}).to_dict('records')
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump(payload, f, indent=2, default=float)
+        logging.info(f"Run metrics written to {path}.")
+
+
+# ==============================================================================
+# TRANSFORM PROCESS POOL
+# ==============================================================================
+FOREX_SHM_DTYPE = np.dtype([('year_month', 'U7'), ('currency_code', 'U8'), ('rate_to_usd', 'f8')])
+_worker_forex_rates_df = None  # Built once per transform process from the shared-memory forex table
+
+
+def frame_to_arrow(df):
+    """Serializes a frame as an Arrow IPC stream, which is what crosses the process boundary."""
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def frame_from_arrow(payload):
+    return pa.ipc.open_stream(payload).read_all().to_pandas()
+
+
+def share_forex_rates(forex_rates_df):
+    """Copies the forex table into one shared-memory block that every transform process reads at start-up."""
+    records = np.empty(len(forex_rates_df), dtype=FOREX_SHM_DTYPE)
+    for col in FOREX_SHM_DTYPE.names:
+        records[col] = forex_rates_df[col].to_numpy()
+    forex_shm = shared_memory.SharedMemory(create=True, size=max(records.nbytes, 1))
+    np.ndarray(records.shape, dtype=FOREX_SHM_DTYPE, buffer=forex_shm.buf)[:] = records
+    return forex_shm
+
+
+def init_transform_worker(shm_name, row_count):
+    """Process-pool initializer: rebuilds the forex table from shared memory once per worker process."""
+    global _worker_forex_rates_df
+    if shm_name is None:
+        _worker_forex_rates_df = pd.DataFrame(columns=list(FOREX_SHM_DTYPE.names))
+        return
+    forex_shm = shared_memory.SharedMemory(name=shm_name)
+    records = np.ndarray((row_count,), dtype=FOREX_SHM_DTYPE, buffer=forex_shm.buf)
+    _worker_forex_rates_df = pd.DataFrame({col: records[col].copy() for col in FOREX_SHM_DTYPE.names})
+    _worker_forex_rates_df['year_month'] = _worker_forex_rates_df['year_month'].astype(str)
+    _worker_forex_rates_df['currency_code'] = _worker_forex_rates_df['currency_code'].astype(str)
+    forex_shm.close()
+
+
+def start_transform_pool(forex_rates_df):
+    """Starts the transform processes. Returns (pool, forex shared memory); (None, None) when transforms stay in-thread."""
+    if not TRANSFORM_PROCESSES:
+        return None, None
+    if pa is None:
+        logging.warning("pyarrow is not installed; running transforms in the fetching threads.")
+        return None, None
+    forex_shm = share_forex_rates(forex_rates_df) if not forex_rates_df.empty else None
+    transform_pool = concurrent.futures.ProcessPoolExecutor(
+        max_workers=TRANSFORM_PROCESSES, initializer=init_transform_worker,
+        initargs=(forex_shm.name if forex_shm else None, len(forex_rates_df))
+    )
+    # Start the workers now, before the I/O threads exist, rather than on the first submit from a fetch thread.
+    transform_pool.submit(int).result()
+    logging.info(f"Started {TRANSFORM_PROCESSES} transform processes.")
+    return transform_pool, forex_shm
+
+
+def transform_in_process(raw_payload, company_info):
+    """Transform-process entry point: raw facts in, load-ready company rows out, both as Arrow IPC bytes."""
+    symbol = company_info['symbol']
+    metrics = PipelineMetrics()
+    with metrics.company(symbol):
+        final_df = transform_company_statements(frame_from_arrow(raw_payload), company_info, _worker_forex_rates_df, metrics)
+        payload = None if final_df is None else frame_to_arrow(finalize_company_frame(final_df, company_info))
+    return payload, metrics.stage_seconds.get(symbol, {})
+
+
+def finalize_company_frame(final_df, company_info):
+    """Attaches company metadata and conforms the rows to the company table schema."""
+    return conform_to_table_schema(prepare_company_frame(final_df, company_info), FS_TABLE_COLUMNS)
+
+
+def transform_company(raw_df, company_info, forex_rates_df, metrics, transform_pool=None):
+    """
+    Transforms a company's raw facts into load-ready rows, in the transform pool when there is one
+    (stage timings come back with the result) and in the calling thread otherwise.
+    """
+    if transform_pool is None:
+        final_df = transform_company_statements(raw_df, company_info, forex_rates_df, metrics)
+        return None if final_df is None else finalize_company_frame(final_df, company_info)
+    with metrics.stage('transform_ipc'):
+        raw_payload = frame_to_arrow(raw_df)
+    payload, stage_seconds = transform_pool.submit(transform_in_process, raw_payload, company_info).result()
+    for stage, seconds in stage_seconds.items():
+        metrics.add_time(stage, seconds)
+    if payload is None:
+        return None
+    with metrics.stage('transform_ipc'):
+        return frame_from_arrow(payload)
 
 
 # ==============================================================================
 # MAIN WORKER FUNCTION (FINALIZED)
 # ==============================================================================
-def process_company_worker(company_info, forex_rates_df, sa_rate_limiter, edgar_rate_limiter, failed_ciks_lock, failed_ciks_list):
+def fetch_company_statements(company_info, sa_rate_limiter, edgar_rate_limiter, journal=None, metrics=None, edgar_plan=None):
+    """
+    Fetches a company's raw statement facts (EDGAR first, StockAnalysis as fallback).
+    EDGAR facts and the strategy come from the bulk plan when there is one.
+    Returns the combined raw frame, or None if no data was found.
+    """
     symbol = company_info['symbol']
-    company_name = company_info['company_name']
     cik_code = company_info.get('cik_code')
-    logging.info(f"--- Starting process for {symbol} ---")
+    metrics = metrics or PipelineMetrics()
 
     # Step 1: Fetch and Combine Data
-    edgar_df, taxonomy = get_company_facts_data(cik_code, edgar_rate_limiter)
+    planned = edgar_plan.get(symbol) if edgar_plan else None
+    if planned is not None:
+        edgar_df, taxonomy, strategy = planned
+        edgar_df = edgar_df.copy()  # The plan is kept for retry passes
+    else:
+        with metrics.stage('fetch_edgar'):
+            edgar_df, taxonomy = get_company_facts_data(cik_code, edgar_rate_limiter)
+        strategy = edgar_strategy(edgar_df, taxonomy)
     
     scraped_df = pd.DataFrame()
     # Logic to decide the data strategy
-    if not edgar_df.empty and taxonomy == 'us-gaap' and has_sufficient_quarterly_data(edgar_df.copy()):
+    if strategy == 'ALL EDGAR':
         final_df = edgar_df
         logging.info(f"Strategy for {symbol}: ALL EDGAR.")
     else:
-        fetch_period = 'Q_ONLY' if not edgar_df.empty else 'ALL'
-        log_msg = 'HYBRID' if not edgar_df.empty else 'FULL FALLBACK'
-        logging.info(f"Strategy for {symbol}: {log_msg}.")
-        scraped_df = fetch_stockanalysis_data(symbol, sa_rate_limiter, periods_to_fetch=fetch_period)
-        
-        # FIX: Add symbol to scraped data before concat to prevent KeyError
-        if not scraped_df.empty:
-            scraped_df['symbol'] = symbol 
-            scraped_df['original_currency'] = fetch_company_profile_currency(symbol, sa_rate_limiter) or 'USD'
+        fetch_period = 'Q_ONLY' if strategy == 'HYBRID' else 'ALL'
+        logging.info(f"Strategy for {symbol}: {strategy}.")
+        with metrics.stage('fetch_sa'):
+            scraped_df, scraped_currency = fetch_stockanalysis_data(symbol, sa_rate_limiter, periods_to_fetch=fetch_period)
+            
+            # FIX: Add symbol to scraped data before concat to prevent KeyError
+            if not scraped_df.empty:
+                scraped_df['symbol'] = symbol 
+                # The statement payloads usually carry the currency; the profile page is only requested when they don't.
+                scraped_df['original_currency'] = scraped_currency or fetch_company_profile_currency(symbol, sa_rate_limiter) or 'USD'
         
         combined_df = pd.concat([edgar_df, scraped_df], ignore_index=True)
         if not combined_df.empty:
@@ -2117,7 +3346,22 @@ def process_company_worker(company_info, forex_rates_df, sa_rate_limiter, edgar_
     
     if final_df.empty:
         logging.warning(f"No data could be retrieved for {symbol}. Skipping.")
+        if journal: journal.record(symbol, 'fetched', 'empty')
         return None
+    if journal: journal.record(symbol, 'fetched', 'ok', frame_content_hash(final_df))
+    metrics.count('rows_fetched', len(final_df))
+    return final_df
+
+
+def transform_company_statements(final_df, company_info, forex_rates_df, metrics=None):
+    """
+    Runs the full transform over a company's raw facts: normalization, period handling, Q4/FY
+    derivation, subtotals, ratios, forex conversion and sorting. CPU-bound and free of I/O, so it
+    can run in a transform process. Returns the processed frame, or None if nothing usable is left.
+    """
+    symbol = company_info['symbol']
+    company_name = company_info['company_name']
+    metrics = metrics or PipelineMetrics()
 
     # Step 2: Main Processing Pipeline
     final_df.reset_index(drop=True, inplace=True)
@@ -2127,90 +3371,163 @@ def process_company_worker(company_info, forex_rates_df, sa_rate_limiter, edgar_
     final_df['company_name'] = company_name
 
     # --- 2a. Normalize and Attach Metadata ---
-    final_df['item'] = final_df['item'].apply(lambda x: STOCKANALYSIS_TO_STANDARD_MAP.get(normalize_item_name(x), x))
-    meta_df = final_df['item'].apply(resolve_item_metadata).apply(pd.Series)
-    
-    cols_from_meta = ['official_item_name', 'statement_type', 'sort_order_item', 'statement_sort_order']
-    cols_to_drop = ['item'] + [col for col in cols_from_meta if col in final_df.columns and col != 'item']
-    final_df = pd.concat([final_df.drop(columns=cols_to_drop, errors='ignore'), meta_df], axis=1).rename(columns={'official_item_name': 'item'})
-    
-    # --- FIX: Ensure sort_order_metric is initialized and cleaned ---
-    if 'sort_order_metric' not in final_df.columns:
-        final_df['sort_order_metric'] = 0
-    final_df['sort_order_metric'] = final_df['sort_order_metric'].fillna(0)
+    with metrics.stage('normalize'):
+        final_df['item'] = final_df['item'].apply(lambda x: STOCKANALYSIS_TO_STANDARD_MAP.get(normalize_item_name(x), x))
+        meta_df = final_df['item'].apply(resolve_item_metadata).apply(pd.Series)
+        
+        cols_from_meta = ['official_item_name', 'statement_type', 'sort_order_item', 'statement_sort_order']
+        cols_to_drop = ['item'] + [col for col in cols_from_meta if col in final_df.columns and col != 'item']
+        final_df = pd.concat([final_df.drop(columns=cols_to_drop, errors='ignore'), meta_df], axis=1).rename(columns={'official_item_name': 'item'})
+        
+        # --- FIX: Ensure sort_order_metric is initialized and cleaned ---
+        if 'sort_order_metric' not in final_df.columns:
+            final_df['sort_order_metric'] = 0
+        final_df['sort_order_metric'] = final_df['sort_order_metric'].fillna(0)
 
     # --- 2b. Derive Dates & Process Periods ---
-    final_df['period_date'] = final_df.apply(lambda r: pd.to_datetime(r.get('period_date')) if pd.notna(r.get('period_date')) else datetime(int(r['fiscal_year']), {'Q1':3,'Q2':6,'Q3':9,'Q4':12,'H1':6,'H2':12,'FY':12}.get(r['fiscal_period'], 12), {'Q1':31,'Q2':30,'Q3':30,'Q4':31,'H1':30,'H2':31,'FY':31}.get(r['fiscal_period'], 31)).date(), axis=1)
-    final_df.dropna(subset=['period_date', 'item'], inplace=True)
-    if final_df.empty: return None
+    with metrics.stage('period_dates'):
+        final_df['period_date'] = final_df.apply(lambda r: pd.to_datetime(r.get('period_date')) if pd.notna(r.get('period_date')) else datetime(int(r['fiscal_year']), {'Q1':3,'Q2':6,'Q3':9,'Q4':12,'H1':6,'H2':12,'FY':12}.get(r['fiscal_period'], 12), {'Q1':31,'Q2':30,'Q3':30,'Q4':31,'H1':30,'H2':31,'FY':31}.get(r['fiscal_period'], 31)).date(), axis=1)
+        final_df.dropna(subset=['period_date', 'item'], inplace=True)
+    if final_df.empty:
+        return None
 
     # --- 2c. Run Calculations & Final Processing ---
-    final_df = process_quarterly_data(final_df)
-    final_df = relabel_semi_annual_periods(final_df)
-    # ** NEW STEP **: Derive Q4 data before calculating ratios
-    final_df = derive_q4_from_fy(final_df) 
-    final_df = derive_and_align_fy_data(final_df)
-    final_df = calculate_and_insert_subtotals(final_df)
-    final_df = calculate_and_insert_analytical_ratios(final_df)
+    with metrics.stage('quarterly'):
+        final_df = process_quarterly_data(final_df)
+        final_df = relabel_semi_annual_periods(final_df)
+    with metrics.stage('q4_fy'):
+        # ** NEW STEP **: Derive Q4 data before calculating ratios
+        final_df = derive_q4_from_fy(final_df) 
+        final_df = derive_and_align_fy_data(final_df)
+    with metrics.stage('subtotals'):
+        final_df = calculate_and_insert_subtotals(final_df)
+    with metrics.stage('ratios'):
+        final_df = calculate_and_insert_analytical_ratios(final_df)
     
     # --- 2d. Forex Conversion & Share Count Fix ---
-    share_count_keys = build_synonym_set({"Weighted-average shares: Basic", "Weighted-average shares: Diluted", "Entity common stock shares outstanding"})
-    final_df.loc[final_df['item'].apply(normalize_item_name).isin(share_count_keys), 'original_currency'] = 'SHARES'
-    
-    if not forex_rates_df.empty:
-        final_df['year_month'] = pd.to_datetime(final_df['period_date']).dt.strftime('%Y-%m')
-        final_df = pd.merge(final_df, forex_rates_df, left_on=['year_month', 'original_currency'], right_on=['year_month', 'currency_code'], how='left')
-    
-    final_df['forex_rate_vs_usd'] = final_df.apply(lambda r: 1.0 if r.get('original_currency') == 'USD' else r.get('rate_to_usd', 1.0), axis=1).fillna(1.0)
-    final_df['value'] = final_df.apply(lambda r: r['original_value'] if (r.get('item') in PERCENTAGE_METRICS or r.get('original_currency') == 'SHARES') else round(pd.to_numeric(r['original_value'], errors='coerce') * r['forex_rate_vs_usd'], -1) if pd.notna(r['original_value']) else None, axis=1)
+    with metrics.stage('forex'):
+        share_count_keys = build_synonym_set({"Weighted-average shares: Basic", "Weighted-average shares: Diluted", "Entity common stock shares outstanding"})
+        final_df.loc[final_df['item'].apply(normalize_item_name).isin(share_count_keys), 'original_currency'] = 'SHARES'
+        
+        if not forex_rates_df.empty:
+            final_df['year_month'] = pd.to_datetime(final_df['period_date']).dt.strftime('%Y-%m')
+            final_df = pd.merge(final_df, forex_rates_df, left_on=['year_month', 'original_currency'], right_on=['year_month', 'currency_code'], how='left')
+        
+        final_df['forex_rate_vs_usd'] = final_df.apply(lambda r: 1.0 if r.get('original_currency') == 'USD' else r.get('rate_to_usd', 1.0), axis=1).fillna(1.0)
+        final_df['value'] = final_df.apply(lambda r: r['original_value'] if (r.get('item') in PERCENTAGE_METRICS or r.get('original_currency') == 'SHARES') else round(pd.to_numeric(r['original_value'], errors='coerce') * r['forex_rate_vs_usd'], -1) if pd.notna(r['original_value']) else None, axis=1)
     
     # --- 2e. Final Sort ---
-    final_df = apply_final_sorting(final_df)
+    with metrics.stage('sort'):
+        final_df = apply_final_sorting(final_df)
     
-    # Step 3: Load to Database
-    create_and_insert_data(final_df, symbol, company_name, company_info)
-    return symbol
+    return final_df
 
-def main():
-    # --- Stage 1: Initial Setup ---
-    companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
-    if companies_df.empty:
-        logging.error(f"No companies found for sector '{SECTOR_TO_PROCESS}'. Halting.")
-        return
 
-    companies_to_process = companies_df.to_dict('records')
+def process_company_worker(company_info, forex_rates_df, sa_rate_limiter, edgar_rate_limiter, failed_ciks_lock, failed_ciks_list, journal=None, metrics=None, transform_pool=None, edgar_plan=None):
+    symbol = company_info['symbol']
+    metrics = metrics or PipelineMetrics()
+    logging.info(f"--- Starting process for {symbol} ---")
+    with metrics.company(symbol):
+        result = load_company(company_info, forex_rates_df, sa_rate_limiter, edgar_rate_limiter, journal, metrics, transform_pool, edgar_plan)
+    logging.info(f"Stage timings for {symbol}: {metrics.company_summary(symbol)}")
+    return result
 
-    # --- CORRECTED FOREX LOGIC ---
-    all_known_currencies = FRED_SERIES_ID_MAP.keys()
-    currency_map_for_fred = {
-        currency: FRED_SERIES_ID_MAP.get(currency)
-        for currency in all_known_currencies if currency != 'USD'
-    }
-    forex_rates_df = fetch_historical_monthly_forex_rates_fred(FRED_API_KEY, currency_map_for_fred)
-    if forex_rates_df.empty:
-        logging.warning("Could not fetch any forex data from FRED. All values will be treated as USD.")
 
-    # --- Stage 2: Concurrent Processing with Rate Limiters ---
-    failed_ciks_lock = threading.Lock()
-    failed_ciks_list = []
-    processed_symbols = []
+def load_company(company_info, forex_rates_df, sa_rate_limiter, edgar_rate_limiter, journal, metrics, transform_pool=None, edgar_plan=None):
+    symbol = company_info['symbol']
+    company_name = company_info['company_name']
 
-    sa_rate_limiter = RateLimiter(STOCKANALYSIS_API_CONFIG['REQUESTS_PER_UNIT'], STOCKANALYSIS_API_CONFIG['UNIT_IN_SECONDS'])
-    edgar_rate_limiter = RateLimiter(EDGAR_API_CONFIG['REQUESTS_PER_UNIT'], EDGAR_API_CONFIG['UNIT_IN_SECONDS'])
+    # Steps 1 & 2: Fetch and transform, unless this run already journaled the transformed frame
+    final_df = journal.load_frame(symbol, 'transformed') if journal else None
+    if final_df is not None:
+        logging.info(f"Resuming {symbol} from its journaled transform; skipping fetch.")
+    else:
+        raw_df = fetch_company_statements(company_info, sa_rate_limiter, edgar_rate_limiter, journal, metrics, edgar_plan)
+        if raw_df is None:
+            return None
+        final_df = transform_company(raw_df, company_info, forex_rates_df, metrics, transform_pool)
+        if final_df is None:
+            if journal: journal.record(symbol, 'transformed', 'empty')
+            return None
+        if journal: journal.save_frame(symbol, 'transformed', final_df)
+
+    # Step 3: Stage and Load to Database (rows are already conformed to the table schema by the transform)
+    if PARQUET_STAGING_DIR:
+        with metrics.stage('parquet_staging'):
+            write_parquet_dataset(final_df, os.path.join(PARQUET_STAGING_DIR, "fs"), ['sector', 'symbol'],
+                                  FS_TABLE_COLUMNS, FS_DICTIONARY_COLUMNS)
+    with metrics.stage('insert'):
+        loaded = create_and_insert_data(final_df, symbol, company_name, company_info)
+    if not loaded:
+        if journal: journal.record(symbol, 'loaded', 'failed')
+        return None
+    if journal: journal.record(symbol, 'loaded', 'ok', frame_content_hash(final_df))
+    metrics.count('rows_loaded', len(final_df))
+    metrics.count('companies_loaded')
+    return symbol
+
+def build_aggregates_and_views(processed_symbols_info, journal=None, rebuild_aggregate=True, metrics=None):
+    """
+    Rebuilds the aggregate table and all materialized views for the companies that were loaded.
+    With a journal and rebuild_aggregate=False, an aggregate that is already in place is kept and only
+    the wide/change MVs the journal does not list as built are created.
+    """
+    if not processed_symbols_info:
+        logging.warning("No companies were successfully processed. Skipping final aggregation.")
+        return
+
+    metrics = metrics or PipelineMetrics()
+    conn = None
+    try:
+        logging.info("\n--- STAGE 3: All fetching complete. Starting final aggregation and view creation. ---")
+        conn = psycopg2.connect(**DB_PARAMS)
+        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
+        cursor = conn.cursor()
+
+        if journal is None or rebuild_aggregate or not journal.is_done(RunJournal.RUN_KEY, 'aggregate'):
+            with metrics.stage('aggregate'):
+                aggregate_ok = create_aggregate_table(conn, cursor, processed_symbols_info)
+            if not aggregate_ok:
+                logging.error("Aggregation failed. Halting MV creation.")
+                if journal: journal.record(RunJournal.RUN_KEY, 'aggregate', 'failed')
+                return
+            if journal: journal.record(RunJournal.RUN_KEY, 'aggregate', 'ok', detail=len(processed_symbols_info))
+            # Recreating the aggregate drops every wide MV, so all of them have to be built again.
+            pending_mv_info = processed_symbols_info
+            build_change_mvs = True
+        else:
+            logging.info("Aggregate table already built in this run; keeping it.")
+            pending_mv_info = [info for info in processed_symbols_info if not journal.is_done(info['symbol'], 'wide_mvs')]
+            build_change_mvs = not journal.is_done(RunJournal.RUN_KEY, 'change_mvs')
+
+        if not pending_mv_info and not build_change_mvs:
+            logging.info("All materialized views are already built in this run.")
+            return
+        with metrics.stage('materialized_views'):
+            built_symbols, change_mvs_ok = create_materialized_views(conn, cursor, pending_mv_info, build_change_mvs)
+        if journal:
+            for info in pending_mv_info:
+                journal.record(info['symbol'], 'wide_mvs', 'ok' if info['symbol'] in built_symbols else 'failed')
+            if build_change_mvs:
+                journal.record(RunJournal.RUN_KEY, 'change_mvs', 'ok' if change_mvs_ok else 'failed')
+    except Exception as e:
+        logging.error(f"An error occurred during final database operations: {e}", exc_info=True)
+    finally:
+        if conn:
+            if 'cursor' in locals() and cursor and not cursor.closed:
+                cursor.close()
+            conn.close()
 
-    task_func = partial(process_company_worker,
-                          forex_rates_df=forex_rates_df,
-                          sa_rate_limiter=sa_rate_limiter,
-                          edgar_rate_limiter=edgar_rate_limiter,
-                          failed_ciks_lock=failed_ciks_lock,
-                          failed_ciks_list=failed_ciks_list)
 
+def run_company_pool(companies, task_func, journal):
+    """Runs the company worker over a list of companies on the thread pool. Returns the symbols that loaded."""
+    processed_symbols = []
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='FS_Worker') as executor:
-        futures = {executor.submit(task_func, company): company for company in companies_to_process}
+        futures = {executor.submit(task_func, company): company for company in companies}
         for i, future in enumerate(concurrent.futures.as_completed(futures)):
             company_info = futures[future]
             symbol = company_info['symbol']
-            logging.info(f"--- Main thread processing result for {symbol} ({i + 1}/{len(companies_to_process)}) ---")
+            logging.info(f"--- Main thread processing result for {symbol} ({i + 1}/{len(companies)}) ---")
             try:
                 # Check the return value from the worker
                 result = future.result()
@@ -2219,35 +3536,159 @@ def main():
                     processed_symbols.append(symbol)
             except Exception as e:
                 logging.error(f"--- Top-level error for {symbol} in worker thread: {e} ---", exc_info=True)
+                journal.record(symbol, 'processing', 'failed', detail=str(e))
+    return processed_symbols
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description=f"Fetch, transform and load financial statements into the '{SCHEMA_NAME}' schema.")
+    parser.add_argument("--resume", action="store_true",
+                        help="Continue the most recent run from its journal, skipping companies and stages already done.")
+    parser.add_argument("--retry-failed", action="store_true",
+                        help="Within the most recent run, re-process only the companies that failed, then finish aggregation.")
+    parser.add_argument("--all-companies", action="store_true",
+                        help="Refresh every company in the sector, not just those the earnings calendar marks as due.")
+    parser.add_argument("--refresh-edgar-mirror", action="store_true",
+                        help="Update the local EDGAR mirror from the bulk companyfacts archive, then exit.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    if args.refresh_edgar_mirror:
+        if not (EDGAR_BULK_COMPANYFACTS_PATH and EDGAR_MIRROR_DIR):
+            logging.error("Set EDGAR_BULK_COMPANYFACTS_PATH and EDGAR_MIRROR_DIR to refresh the EDGAR mirror.")
+        elif ensure_edgar_bulk_archive(EDGAR_BULK_COMPANYFACTS_PATH):
+            refresh_edgar_mirror(EDGAR_BULK_COMPANYFACTS_PATH, EDGAR_MIRROR_DIR)
+        return
+
+    if RELOAD_FROM_PARQUET and not (PARQUET_STAGING_DIR and ds is not None):
+        logging.error("RELOAD_FROM_PARQUET needs PARQUET_STAGING_DIR to be set and pyarrow to be installed.")
+        return
+
+    prepare_dimension_tables()
+
+    if RELOAD_FROM_PARQUET:
+        processed_symbols_info = reload_company_tables_from_parquet(os.path.join(PARQUET_STAGING_DIR, "fs"))
+        build_aggregates_and_views(processed_symbols_info)
+        return
+
+    journal = RunJournal(FS_RUN_JOURNAL_PATH, FS_RUN_CACHE_DIR, resume=args.resume or args.retry_failed)
+    metrics = PipelineMetrics()
+
+    # --- Stage 1: Initial Setup ---
+    companies_df = journal.load_run_artifact('universe')
+    if companies_df is None:
+        companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
+        if companies_df.empty:
+            logging.error(f"No companies found for sector '{SECTOR_TO_PROCESS}'. Halting.")
+            return
+        journal.save_run_artifact('universe', companies_df)
+
+    all_companies = companies_df.to_dict('records')
+
+    # A new run skips the companies that cannot have filed since their last load; they are journaled as loaded,
+    # since their tables are already current, so the aggregate and views still cover them.
+    if SCHEDULE_FROM_EARNINGS_CALENDAR and not (args.resume or args.retry_failed or args.all_companies):
+        due_symbols = fetch_refresh_schedule([c['symbol'] for c in all_companies])
+        if due_symbols is not None:
+            for company in all_companies:
+                if company['symbol'].lower() not in due_symbols and journal.company_outcome(company['symbol']) is None:
+                    journal.record(company['symbol'], 'loaded', 'ok', detail=UNCHANGED_SINCE_LAST_LOAD)
+            if not due_symbols:
+                logging.info("No company has filed since its last load; tables and views are current.")
+                return
+
+    # --- CORRECTED FOREX LOGIC ---
+    forex_rates_df = journal.load_run_artifact('forex')
+    if forex_rates_df is None:
+        all_known_currencies = FRED_SERIES_ID_MAP.keys()
+        currency_map_for_fred = {
+            currency: FRED_SERIES_ID_MAP.get(currency)
+            for currency in all_known_currencies if currency != 'USD'
+        }
+        forex_rates_df = fetch_historical_monthly_forex_rates_fred(FRED_API_KEY, currency_map_for_fred)
+        if forex_rates_df.empty:
+            logging.warning("Could not fetch any forex data from FRED. All values will be treated as USD.")
+        else:
+            journal.save_run_artifact('forex', forex_rates_df)
+
+    if args.retry_failed:
+        companies_to_process = [c for c in all_companies if journal.company_outcome(c['symbol']) == 'failed']
+    else:
+        companies_to_process = [c for c in all_companies if journal.company_outcome(c['symbol']) in (None, 'failed')]
+    logging.info(f"{len(companies_to_process)} of {len(all_companies)} companies need processing in run {journal.run_id}.")
+
+    # --- Stage 2: Concurrent Processing with Rate Limiters ---
+    failed_ciks_lock = threading.Lock()
+    failed_ciks_list = []
+
+    sa_rate_limiter = RateLimiter(STOCKANALYSIS_API_CONFIG['REQUESTS_PER_UNIT'], STOCKANALYSIS_API_CONFIG['UNIT_IN_SECONDS'],
+                                  name='sa', metrics=metrics)
+    edgar_rate_limiter = RateLimiter(EDGAR_API_CONFIG['REQUESTS_PER_UNIT'], EDGAR_API_CONFIG['UNIT_IN_SECONDS'],
+                                     name='edgar', metrics=metrics)
+
+    # Plan every company's strategy from the bulk archive, so only the companies that need StockAnalysis
+    # make any requests, and they go first: they are the long pole behind the SA rate limiter.
+    edgar_plan = None
+    if companies_to_process and (EDGAR_BULK_COMPANYFACTS_PATH or EDGAR_MIRROR_DIR):
+        with metrics.stage('edgar_bulk_plan'):
+            edgar_plan = plan_from_edgar_bulk(companies_to_process)
+    if edgar_plan:
+        companies_to_process.sort(key=lambda c: edgar_plan[c['symbol']][2] == 'ALL EDGAR')
+
+    # I/O threads fetch under the rate limiters and hand each company's raw facts to the transform processes.
+    transform_pool, forex_shm = start_transform_pool(forex_rates_df) if companies_to_process else (None, None)
+
+    task_func = partial(process_company_worker,
+                          forex_rates_df=forex_rates_df,
+                          sa_rate_limiter=sa_rate_limiter,
+                          edgar_rate_limiter=edgar_rate_limiter,
+                          failed_ciks_lock=failed_ciks_lock,
+                          failed_ciks_list=failed_ciks_list,
+                          journal=journal,
+                          metrics=metrics,
+                          transform_pool=transform_pool,
+                          edgar_plan=edgar_plan)
+
+    try:
+        processed_symbols = run_company_pool(companies_to_process, task_func, journal)
+
+        # Failed companies get their own passes; everything already loaded is left alone.
+        for retry_pass in range(FAILED_COMPANY_RETRY_PASSES):
+            failed_companies = [c for c in companies_to_process if journal.company_outcome(c['symbol']) == 'failed']
+            if not failed_companies:
+                break
+            logging.info(f"--- Retry pass {retry_pass + 1}: re-processing {len(failed_companies)} failed companies ---")
+            processed_symbols += run_company_pool(failed_companies, task_func, journal)
+    finally:
+        if transform_pool:
+            transform_pool.shutdown()
+        if forex_shm:
+            forex_shm.close()
+            forex_shm.unlink()
+
+    record_company_loads({
+        c['symbol']: journal.latest(c['symbol'], 'loaded')['ts'] for c in all_companies
+        if journal.company_outcome(c['symbol']) == 'loaded'
+        and journal.latest(c['symbol'], 'loaded')['detail'] != UNCHANGED_SINCE_LAST_LOAD
+    })
 
     # --- Stage 3 & 4: Final Database Operations & Reporting ---
-    # Now this list will ONLY contain symbols for which a table was actually created
+    # Every company loaded in this run, including those loaded before a resume
     processed_symbols_info = [
-        info for info in companies_to_process
-        if info['symbol'] in processed_symbols
+        info for info in all_companies
+        if journal.company_outcome(info['symbol']) == 'loaded'
     ]
 
-    if not processed_symbols_info:
-        logging.warning("No companies were successfully processed. Skipping final aggregation.")
-    else:
-        conn = None
-        try:
-            logging.info("\n--- STAGE 3: All fetching complete. Starting final aggregation and view creation. ---")
-            conn = psycopg2.connect(**DB_PARAMS)
-            conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
-            cursor = conn.cursor()
+    build_aggregates_and_views(processed_symbols_info, journal, rebuild_aggregate=bool(processed_symbols), metrics=metrics)
+    metrics.log_run_summary()
+    metrics.export_json(os.path.join(FS_METRICS_DIR, f"{journal.run_id}.{datetime.now().strftime('%H%M%S')}.json"), journal.run_id)
 
-            if create_aggregate_table(conn, cursor, processed_symbols_info):
-                create_materialized_views(conn, cursor, processed_symbols_info)
-            else:
-                logging.error("Aggregation failed. Halting MV creation.")
-        except Exception as e:
-            logging.error(f"An error occurred during final database operations: {e}", exc_info=True)
-        finally:
-            if conn:
-                if 'cursor' in locals() and cursor and not cursor.closed:
-                    cursor.close()
-                conn.close()
+    still_failed = [c['symbol'] for c in all_companies if journal.company_outcome(c['symbol']) == 'failed']
+    if still_failed:
+        logging.warning(f"{len(still_failed)} companies still failed; run again with --retry-failed: {', '.join(sorted(still_failed))}")
 
     if failed_ciks_list:
         logging.warning("\n" + "=" * 80)
@@ -1,20 +1,29 @@
 # --- IMPORTS ---
+import gzip
+import io
+import json
 import requests
+import numpy as np
 import pandas as pd
 import time
 import re
-from datetime import datetime
+from datetime import date, datetime
 import psycopg2
 from psycopg2 import sql
-from psycopg2.extensions import ISOLATION_LEVEL_AUTOCOMMIT
-from psycopg2.extras import execute_values
 import logging
 import random
 import threading
 import concurrent.futures
 import multiprocessing
+import os
 from functools import partial
 
+try:  # Parquet staging is optional; everything else works without pyarrow.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
+
 
 # --- Core Configuration ---
 SECTOR_TO_PROCESS = "Utilities"
@@ -31,7 +40,59 @@ DB_PARAMS = {
 
 # --- Concurrency and Rate Limiting Configuration ---
 MAX_WORKERS = 15
+# "upsert" keeps each ratio table in place and applies only the diff from a staging table;
+# "replace" drops and recreates the table on every run (the original behaviour).
+REFRESH_MODE = "upsert"
+
+# --- Parquet Staging Configuration ---
+# When set, every processed company is also written to a Parquet dataset partitioned by sector/symbol (requires pyarrow).
+PARQUET_STAGING_DIR = None  # e.g. "parquet_staging"
+# When True, no network calls are made: the ratio tables are rebuilt from PARQUET_STAGING_DIR instead.
+RELOAD_FROM_PARQUET = False
+RATIO_DICTIONARY_COLUMNS = ["statement_type", "item", "header"]
 API_REQUESTS_PER_MINUTE = 32 # Rate limit for fetching the ratio data itself
+API_REQUEST_BURST = API_REQUESTS_PER_MINUTE  # Unused request slots that may be spent back-to-back (the old bucket capacity)
+API_REQUEST_JITTER = 0.25  # Randomizes each request slot's spacing by up to +/-25% of the interval
+
+# --- Ratio Payload Cache Configuration ---
+# Raw ratio payloads are kept per symbol together with the screener's lastReportDate/nextEarningsDate at fetch
+# time; a symbol is only downloaded again once a newer report has been (or should have been) filed.
+RATIO_PAYLOAD_CACHE_DIR = "ratio_payload_cache"  # None disables the cache
+# Also fetch annual ratios in the same pass; they are loaded into <symbol>_annual_ratios tables.
+FETCH_ANNUAL_RATIOS = False
+RATIO_PERIOD_PARAMS = {"quarterly": "quarterly", "annual": ""}  # Value of the ?p= query parameter per period type
+RATIO_TABLE_SUFFIXES = {"quarterly": "_ratios", "annual": "_annual_ratios"}
+# Screener fields used only to schedule re-downloads; they are not copied into the ratio tables.
+RATIO_SCHEDULE_COLUMNS = ["last_report_date", "next_earnings_date"]
+
+# --- Earnings-Calendar Refresh Scheduling ---
+# When True, a run only refreshes the companies that could have filed since their last successful load, judged
+# from the filing and earnings dates the screener script loads into public.aggregate_screener_table. The others
+# keep their tables and are still part of the aggregate.
+SCHEDULE_FROM_EARNINGS_CALENDAR = True
+SCREENER_TABLE = ("public", "aggregate_screener_table")
+SCREENER_FILING_DATE_COLUMNS = ["last_earnings_date", "last_report_date", "last_10k_filing_date"]
+REFRESH_LOG_TABLE = "company_refresh_log"  # Time of each company's last successful load, kept in SCHEMA_NAME
+
+# --- Per-Company Ratio Table Schema ---
+# Single source of truth for the column order of every ratio table; used for both CREATE TABLE and COPY.
+RATIO_TABLE_COLUMNS = [
+    ("symbol", "TEXT"), ("company_name", "TEXT"), ("sector", "TEXT"), ("industry", "TEXT"),
+    ("market_cap_group", "TEXT"), ("country", "TEXT"), ("analyst_rating", "TEXT"), ("ma50_vs_200d", "TEXT"),
+    ("statement_type", "TEXT"), ("item", "TEXT"), ("header", "TEXT"), ("value", "NUMERIC"),
+    ("sort_key", "INTEGER"), ("extracted_order", "INTEGER"), ("period_date", "DATE"), ("filing_type", "TEXT"),
+    ("period_ordinal", "INTEGER")
+]
+RATIO_TABLE_KEY = ["symbol", "item", "header"]
+
+# --- Company Dimension ---
+# Company attributes live once per symbol in the dimension shared with the screener and price pipelines. The
+# ratio tables and the aggregate fact table store only its symbol_id; RATIO_TABLE_COLUMNS stays the layout of
+# the in-memory frames, the Parquet dataset and the aggregate compatibility view.
+DIM_COMPANY_TABLE = ("public", "dim_company")
+RATIO_COMPANY_COLUMNS = ["symbol", "company_name", "sector", "industry", "market_cap_group", "country", "analyst_rating", "ma50_vs_200d"]
+RATIO_FACT_COLUMNS = [("symbol_id", "INTEGER")] + [(col, pg_type) for col, pg_type in RATIO_TABLE_COLUMNS if col not in RATIO_COMPANY_COLUMNS]
+RATIO_FACT_KEY = ["symbol_id", "item", "header"]
 
 # Set up logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(threadName)s - %(levelname)s - %(message)s')
@@ -61,7 +122,8 @@ def fetch_companies_by_sector(sector_name: str) -> pd.DataFrame:
     """
     logging.info(f"--- STAGE 1: Starting dynamic company discovery for sector: '{sector_name}' ---")
 
-    metrics_to_fetch = ['name', 'sector', 'industry', 'marketCapCategory', 'country', 'analystRatings', 'ma50vs200']
+    metrics_to_fetch = ['name', 'sector', 'industry', 'marketCapCategory', 'country', 'analystRatings', 'ma50vs200',
+                        'lastReportDate', 'nextEarningsDate']
     rename_map = {
         'name': 'company_name',
         'sector': 'sector',
@@ -69,7 +131,9 @@ def fetch_companies_by_sector(sector_name: str) -> pd.DataFrame:
         'marketCapCategory': 'market_cap_group',
         'country': 'country',
         'analystRatings': 'analyst_rating',
-        'ma50vs200': 'ma50_vs_200d'
+        'ma50vs200': 'ma50_vs_200d',
+        'lastReportDate': 'last_report_date',
+        'nextEarningsDate': 'next_earnings_date'
     }
 
     batch_string = "+".join(metrics_to_fetch)
@@ -114,46 +178,51 @@ def fetch_companies_by_sector(sector_name: str) -> pd.DataFrame:
 # ==============================================================================
 
 class RateLimiter:
-    """A thread-safe token bucket rate limiter."""
-    def __init__(self, requests_per_minute: int):
+    """
+    A thread-safe limiter that hands out request slots on one shared schedule.
+    Each caller reserves the next slot under the lock and waits for it outside the lock, so waiting threads
+    don't queue on the lock. Up to `burst` unused slots may be spent back-to-back, and `jitter` randomly
+    stretches or shrinks each slot's spacing by up to that fraction of the interval (the average rate is unchanged).
+    """
+    def __init__(self, requests_per_minute: int, burst: int = 1, jitter: float = 0.0):
         self._lock = threading.Lock()
-        self.rate_per_second = requests_per_minute / 60.0
-        self.capacity = float(requests_per_minute)
-        self.tokens = self.capacity
-        self.last_refill_time = time.monotonic()
+        self.interval = 60.0 / requests_per_minute
+        self.burst = max(1, int(burst))
+        self.jitter = jitter
+        self._next_slot = time.monotonic()
 
     def consume(self):
         with self._lock:
             now = time.monotonic()
-            elapsed = now - self.last_refill_time
-            new_tokens = elapsed * self.rate_per_second
-            if new_tokens > 0:
-                self.tokens = min(self.capacity, self.tokens + new_tokens)
-                self.last_refill_time = now
-            if self.tokens < 1:
-                wait_time = (1 - self.tokens) / self.rate_per_second
-                time.sleep(wait_time)
-                self.tokens += ((time.monotonic() - self.last_refill_time) * self.rate_per_second)
-                self.last_refill_time = time.monotonic()
-            self.tokens -= 1
-
-def get_period_sort_order(header_str):
-    header_str = header_str.upper()
-    if 'Q1' in header_str: return 1
-    if 'Q2' in header_str: return 2
-    if 'Q3' in header_str: return 3
-    if 'Q4' in header_str: return 4
-    if 'FY' in header_str: return 5
-    if 'H1' in header_str or 'S1' in header_str: return 2.5
-    if 'H2' in header_str or 'S2' in header_str: return 4.5
-    return 99
-
-
-def fetch_financial_ratios_stockanalysis(symbol, company_name):
-    """
-    Fetches financial ratio data for a given stock symbol from the stockanalysis.com JSON API.
-    """
-    all_ratio_data = []
+            scheduled = max(self._next_slot, now)
+            slot = max(now, scheduled - (self.burst - 1) * self.interval)
+            spacing = self.interval
+            if self.jitter:
+                spacing *= 1 + random.uniform(-self.jitter, self.jitter)
+            self._next_slot = scheduled + spacing
+        wait_time = slot - time.monotonic()
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+# Chronological rank of each fiscal period within its year. A header's ordinal is year * 10 + rank, so
+# ordinals sort chronologically and ordinal % 10 recovers the period (e.g. for year-over-year partitions).
+PERIOD_RANKS = {'Q1': 1, 'H1': 2, 'Q2': 3, 'Q3': 4, 'H2': 5, 'Q4': 6, 'FY': 7}
+UNKNOWN_PERIOD_RANK = 9  # Unrecognized periods sort after FY of their year
+
+
+def encode_period_ordinals(headers):
+    """
+    Converts period headers into chronological integer ordinals in one vectorized pass.
+    Example: 'Q1_2023' -> 20231, 'FY_2023' -> 20237; malformed headers get 0.
+    """
+    parts = pd.Series(headers).astype(str).str.upper().str.extract(r'^([A-Z0-9]+)_(\d{4})$')
+    ranks = parts[0].map(PERIOD_RANKS).fillna(UNKNOWN_PERIOD_RANK)
+    years = pd.to_numeric(parts[1], errors='coerce')
+    return (years * 10 + ranks).fillna(0).astype('int64').set_axis(pd.Series(headers).index)
+
+
+def get_ratio_session(symbol):
+    """Returns a requests session carrying browser headers for the symbol's ratio pages."""
     session_headers = {
         "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36",
         "Accept": "application/json, text/plain, */*",
@@ -166,100 +235,203 @@ def fetch_financial_ratios_stockanalysis(symbol, company_name):
     }
     session = requests.Session()
     session.headers.update(session_headers)
+    return session
+
+
+def fetch_ratio_payload(session, symbol, period):
+    """Downloads the raw ratio __data.json payload of one period type ('quarterly' or 'annual')."""
+    url = f"https://stockanalysis.com/stocks/{symbol.lower()}/financials/ratios/__data.json?p={RATIO_PERIOD_PARAMS[period]}"
+    logging.info(f"Fetching {period} Financial Ratios for {symbol} from SA-JSON...")
+    response = session.get(url, timeout=20)
+    response.raise_for_status()
+    return response.json()
+
+
+def parse_ratio_payload(json_data, symbol, period='quarterly'):
+    """Parses a raw ratio payload into ratio rows; annual columns are labelled FY_<year>, quarterly ones by calendar quarter."""
+    ratio_rows = []
+    data_nodes_found = 0
+    for node in json_data.get('nodes', []):
+        if (node.get('type') == 'data' and
+            isinstance(node.get('data'), list) and len(node['data']) > 0 and
+            isinstance(node['data'][0], dict) and 'financialData' in node['data'][0]):
+
+            data_nodes_found += 1
+            data_section = node['data']
+            key_map = data_section[0]
+            financial_data_index = key_map.get('financialData')
+            if financial_data_index is None: continue
+            financial_data_map = data_section[financial_data_index]
+
+            date_indices_pointer = financial_data_map.get('datekey')
+            if date_indices_pointer is None: continue
+            date_indices_list = data_section[date_indices_pointer]
+            columns = [data_section[i] for i in date_indices_list]
+
+            item_titles = {}
+            for element in data_section:
+                if isinstance(element, dict) and 'id' in element and 'title' in element:
+                    item_id_index, item_title_index = element.get('id'), element.get('title')
+                    if (isinstance(item_id_index, int) and isinstance(item_title_index, int) and
+                        item_id_index < len(data_section) and item_title_index < len(data_section) and
+                        isinstance(data_section[item_id_index], str) and isinstance(data_section[item_title_index], str)):
+                        item_titles[data_section[item_id_index]] = data_section[item_title_index]
+
+            for item_id, data_pointer in financial_data_map.items():
+                if item_id not in item_titles or not item_titles[item_id]: continue
+                item_name = item_titles[item_id]
+                if item_name.lower() in ["ttm", "last 12 months"]: continue
+
+                target_obj = data_section[data_pointer]
+                is_indexed_series = isinstance(target_obj, list)
+
+                for i, period_header_date in enumerate(columns):
+                    value = None
+                    if is_indexed_series:
+                        if i < len(target_obj):
+                            value_index = target_obj[i]
+                            if value_index is not None and value_index < len(data_section):
+                                value = data_section[value_index]
+                    else:
+                        value_index = data_pointer + i
+                        if value_index < len(data_section):
+                            value = data_section[value_index]
+
+                    numeric_value = None
+                    try:
+                        if isinstance(value, list): value = value[0]
+                        numeric_value = float(value)
+                    except (ValueError, TypeError):
+                        continue
+
+                    match = re.search(r'(\d{4})-(\d{2})-(\d{2})', period_header_date)
+                    if not match: continue
+                    year, month_str, _ = match.groups()
+                    year, month = int(year), int(month_str)
+
+                    header = None
+                    if period == 'annual': header = f"FY_{year}"
+                    elif month in [1, 2, 3]: header = f"Q1_{year}"
+                    elif month in [4, 5, 6]: header = f"Q2_{year}"
+                    elif month in [7, 8, 9]: header = f"Q3_{year}"
+                    elif month in [10, 11, 12]: header = f"Q4_{year}"
+
+                    if not header: continue
+
+                    ratio_rows.append({
+                        'statement_type': 'Financial Ratios',
+                        'item': item_name,
+                        'header': header,
+                        'value': numeric_value,
+                        'period_date': datetime.strptime(period_header_date, '%Y-%m-%d').date(),
+                        'filing_type': 'Scraped-JSON'
+                    })
+
+    if data_nodes_found == 0:
+        logging.warning(f"No valid data nodes found in JSON for {symbol}")
+
+    return ratio_rows
+
+
+# ==============================================================================
+# RATIO PAYLOAD CACHE
+# ==============================================================================
 
-    url = f"https://stockanalysis.com/stocks/{symbol.lower()}/financials/ratios/__data.json?p=quarterly"
+def ratio_payload_cache_path(symbol):
+    return os.path.join(RATIO_PAYLOAD_CACHE_DIR, f"{symbol.lower().replace('.', '_')}.json.gz")
 
-    time.sleep(random.uniform(2.1, 3.7))
-    logging.info(f"Fetching Financial Ratios for {symbol} from SA-JSON...")
 
+def load_cached_ratio_payloads(symbol):
+    """Returns the cached entry for a symbol ({fetched_at, last_report_date, next_earnings_date, payloads}) or None."""
+    path = ratio_payload_cache_path(symbol)
+    if not os.path.exists(path):
+        return None
     try:
-        response = session.get(url, timeout=20)
-        response.raise_for_status()
-        json_data = response.json()
-
-        data_nodes_found = 0
-        for node in json_data.get('nodes', []):
-            if (node.get('type') == 'data' and
-                isinstance(node.get('data'), list) and len(node['data']) > 0 and
-                isinstance(node['data'][0], dict) and 'financialData' in node['data'][0]):
-
-                data_nodes_found += 1
-                data_section = node['data']
-                key_map = data_section[0]
-                financial_data_index = key_map.get('financialData')
-                if financial_data_index is None: continue
-                financial_data_map = data_section[financial_data_index]
-
-                date_indices_pointer = financial_data_map.get('datekey')
-                if date_indices_pointer is None: continue
-                date_indices_list = data_section[date_indices_pointer]
-                columns = [data_section[i] for i in date_indices_list]
-
-                item_titles = {}
-                for element in data_section:
-                    if isinstance(element, dict) and 'id' in element and 'title' in element:
-                        item_id_index, item_title_index = element.get('id'), element.get('title')
-                        if (isinstance(item_id_index, int) and isinstance(item_title_index, int) and
-                            item_id_index < len(data_section) and item_title_index < len(data_section) and
-                            isinstance(data_section[item_id_index], str) and isinstance(data_section[item_title_index], str)):
-                            item_titles[data_section[item_id_index]] = data_section[item_title_index]
-
-                for item_id, data_pointer in financial_data_map.items():
-                    if item_id not in item_titles or not item_titles[item_id]: continue
-                    item_name = item_titles[item_id]
-                    if item_name.lower() in ["ttm", "last 12 months"]: continue
-
-                    target_obj = data_section[data_pointer]
-                    is_indexed_series = isinstance(target_obj, list)
-
-                    for i, period_header_date in enumerate(columns):
-                        value = None
-                        if is_indexed_series:
-                            if i < len(target_obj):
-                                value_index = target_obj[i]
-                                if value_index is not None and value_index < len(data_section):
-                                    value = data_section[value_index]
-                        else:
-                            value_index = data_pointer + i
-                            if value_index < len(data_section):
-                                value = data_section[value_index]
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        logging.warning(f"Ignoring unreadable ratio cache for {symbol}: {e}")
+        return None
 
-                        numeric_value = None
-                        try:
-                            if isinstance(value, list): value = value[0]
-                            numeric_value = float(value)
-                        except (ValueError, TypeError):
-                            continue
-
-                        match = re.search(r'(\d{4})-(\d{2})-(\d{2})', period_header_date)
-                        if not match: continue
-                        year, month_str, _ = match.groups()
-                        year, month = int(year), int(month_str)
-
-                        header = None
-                        if month in [1, 2, 3]: header = f"Q1_{year}"
-                        elif month in [4, 5, 6]: header = f"Q2_{year}"
-                        elif month in [7, 8, 9]: header = f"Q3_{year}"
-                        elif month in [10, 11, 12]: header = f"Q4_{year}"
-
-                        if not header: continue
-
-                        all_ratio_data.append({
-                            'statement_type': 'Financial Ratios',
-                            'item': item_name,
-                            'header': header,
-                            'value': numeric_value,
-                            'period_date': datetime.strptime(period_header_date, '%Y-%m-%d').date(),
-                            'filing_type': 'Scraped-JSON'
-                        })
-
-        if data_nodes_found == 0:
-            logging.warning(f"No valid data nodes found in JSON for {symbol}")
 
-    except Exception as e:
-        logging.error(f"Critical error fetching ratios for {symbol}: {e}", exc_info=False)
+def save_ratio_payloads(symbol, entry):
+    """Writes a symbol's cache entry atomically so an interrupted run never leaves a truncated file behind."""
+    os.makedirs(RATIO_PAYLOAD_CACHE_DIR, exist_ok=True)
+    path = ratio_payload_cache_path(symbol)
+    temp_path = f"{path}.{threading.get_ident()}.tmp"
+    with gzip.open(temp_path, 'wt', encoding='utf-8') as f:
+        json.dump(entry, f)
+    os.replace(temp_path, path)
+
+
+def parse_screener_date(value):
+    """Parses a screener date field (e.g. '2024-05-02') into a date; returns None when missing or unparseable."""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    parsed = pd.to_datetime(value, errors='coerce')
+    return None if pd.isna(parsed) else parsed.date()
+
+
+def ratio_cache_is_current(entry, company_info, periods, today=None):
+    """
+    True when the cached payloads cover every requested period type and no new report has been filed since
+    they were fetched: the screener's lastReportDate is unchanged and predates the fetch, and the
+    nextEarningsDate recorded at fetch time has not passed yet. Without a lastReportDate nothing can be ruled
+    out, so the symbol is downloaded again.
+    """
+    if not entry or any(period not in entry.get('payloads', {}) for period in periods):
+        return False
+    today = today or date.today()
+    last_report = parse_screener_date(company_info.get('last_report_date'))
+    cached_report = parse_screener_date(entry.get('last_report_date'))
+    fetched_on = parse_screener_date(entry.get('fetched_at'))
+    if last_report is None or cached_report is None or fetched_on is None:
+        return False
+    if last_report > cached_report or last_report >= fetched_on:
+        return False
+    expected_report = parse_screener_date(entry.get('next_earnings_date'))
+    if expected_report is not None and fetched_on < expected_report <= today:
+        return False  # The report was due after the last fetch; the screener's lastReportDate may simply lag.
+    return True
 
-    return all_ratio_data
+
+def fetch_financial_ratios_stockanalysis(company_info, rate_limiter, periods=('quarterly',)):
+    """
+    Returns {period: ratio rows} for one company. Payloads come from the cache when no report has been filed
+    since they were fetched; otherwise every requested period type is downloaded in the same pass (one
+    limiter slot per request) and the cache entry is replaced.
+    """
+    symbol = company_info['symbol']
+    entry = load_cached_ratio_payloads(symbol) if RATIO_PAYLOAD_CACHE_DIR else None
+
+    if ratio_cache_is_current(entry, company_info, periods):
+        logging.info(f"No new report for {symbol} since {entry['fetched_at']}; using cached ratio payloads.")
+        payloads = entry['payloads']
+    else:
+        payloads = {}
+        session = get_ratio_session(symbol)
+        try:
+            for period in periods:
+                rate_limiter.consume()
+                payloads[period] = fetch_ratio_payload(session, symbol, period)
+        except Exception as e:
+            logging.error(f"Critical error fetching ratios for {symbol}: {e}", exc_info=False)
+            return {}
+        ratio_rows = {period: parse_ratio_payload(payloads[period], symbol, period) for period in periods}
+        # Payloads without any ratio rows are not cached, so they are downloaded again on the next run.
+        usable = {period: payloads[period] for period in periods if ratio_rows[period]}
+        if RATIO_PAYLOAD_CACHE_DIR and usable:
+            # Payloads of period types not requested this run are kept so a later annual run can still use them.
+            kept = {p: v for p, v in (entry or {}).get('payloads', {}).items() if p not in payloads}
+            save_ratio_payloads(symbol, {
+                'fetched_at': datetime.now().isoformat(timespec='seconds'),
+                'last_report_date': company_info.get('last_report_date'),
+                'next_earnings_date': company_info.get('next_earnings_date'),
+                'payloads': {**kept, **usable},
+            })
+        return ratio_rows
+
+    return {period: parse_ratio_payload(payloads[period], symbol, period) for period in periods}
 
 
 def relabel_semi_annual_periods(df):
@@ -294,124 +466,315 @@ def relabel_semi_annual_periods(df):
     return df
 
 
+def build_ratio_frame(ratio_data_list, company_info, period='quarterly'):
+    """Turns parsed ratio rows into the sorted per-company frame that is loaded into the ratio tables."""
+    symbol = company_info['symbol']
+    financial_df = pd.DataFrame(ratio_data_list)
+    financial_df['symbol'] = symbol.lower()
+    
+    for key, value in company_info.items():
+        if key != 'symbol' and key not in RATIO_SCHEDULE_COLUMNS: # Avoid overwriting the lowercased symbol
+            financial_df[key] = value
+
+    if period == 'quarterly':
+        financial_df = relabel_semi_annual_periods(financial_df)
+
+    financial_df['period_ordinal'] = encode_period_ordinals(financial_df['header'])
+    financial_df = financial_df.sort_values(by=['symbol', 'item', 'period_ordinal'])
+
+    financial_df = financial_df.reset_index(drop=True)
+    financial_df['sort_key'] = financial_df.index
+    financial_df['extracted_order'] = financial_df.groupby(['symbol', 'item']).cumcount() + 1
+    return financial_df
+
+
 def process_company_worker(company_info, rate_limiter):
     """
     Worker function: fetches, processes, and returns ratio data for one company.
+    Returns (symbol, quarterly frame or None, annual frame or None); the annual frame is only built
+    when FETCH_ANNUAL_RATIOS is set.
     """
     symbol = company_info['symbol']
-    company_name = company_info['company_name']
+    periods = ('quarterly', 'annual') if FETCH_ANNUAL_RATIOS else ('quarterly',)
 
     try:
-        logging.debug(f"Requesting token for {symbol}...")
-        rate_limiter.consume()
-        logging.info(f"Token acquired. Starting ratio processing for {symbol}.")
-
-        ratio_data_list = fetch_financial_ratios_stockanalysis(symbol, company_name)
-
-        if not ratio_data_list:
-            logging.warning(f"No ratio data returned for {symbol}. Worker finishing.")
-            return symbol, None
+        ratio_rows_by_period = fetch_financial_ratios_stockanalysis(company_info, rate_limiter, periods)
 
-        financial_df = pd.DataFrame(ratio_data_list)
-        financial_df['symbol'] = symbol.lower()
-        
-        for key, value in company_info.items():
-            if key != 'symbol': # Avoid overwriting the lowercased symbol
-                financial_df[key] = value
-
-        financial_df = relabel_semi_annual_periods(financial_df)
+        frames = {}
+        for period in periods:
+            ratio_data_list = ratio_rows_by_period.get(period)
+            if not ratio_data_list:
+                logging.warning(f"No {period} ratio data returned for {symbol}.")
+                frames[period] = None
+                continue
+            frames[period] = build_ratio_frame(ratio_data_list, company_info, period)
+            logging.info(f"Successfully processed {len(frames[period])} {period} ratio records for {symbol}.")
 
-        financial_df['year'] = financial_df['header'].apply(lambda x: int(x.split('_')[-1]) if '_' in x else None)
-        financial_df['period_sort_value'] = financial_df['header'].apply(get_period_sort_order)
-        sort_by_cols = ['symbol', 'item', 'year', 'period_sort_value']
-        financial_df = financial_df.sort_values(by=sort_by_cols).drop(columns=['year', 'period_sort_value'])
-
-        financial_df = financial_df.reset_index(drop=True)
-        financial_df['sort_key'] = financial_df.index
-        financial_df['extracted_order'] = financial_df.groupby(['symbol', 'item']).cumcount() + 1
-
-        logging.info(f"Successfully processed {len(financial_df)} ratio records for {symbol}.")
-        return symbol, financial_df
+        return symbol, frames['quarterly'], frames.get('annual')
 
     except Exception as e:
         logging.error(f"WORKER ERROR for {symbol}: Unhandled exception -> {e}", exc_info=True)
-        return symbol, None
+        return symbol, None, None
 
 
 # ==============================================================================
 # STAGE 3: DATABASE INTEGRATION & POST-PROCESSING
 # ==============================================================================
 
-def create_and_insert_ratio_data(df_to_insert, symbol):
+def build_column_definitions(table_columns):
+    """Builds the column definition list of a CREATE TABLE statement from a table schema."""
+    return sql.SQL(", ").join(
+        sql.SQL("{col} {pg_type}").format(col=sql.Identifier(col), pg_type=sql.SQL(pg_type))
+        for col, pg_type in table_columns
+    )
+
+
+def serialize_for_copy(df, table_columns):
     """
-    Inserts processed ratio data into the database. Now drops the table first
-    to ensure the schema is always up-to-date.
+    Converts a DataFrame into a tab-delimited COPY buffer one column at a time.
+    Each column is formatted and NULL-masked as a whole array in table-schema order; rows are
+    only touched once at the end, when the pre-formatted fields are joined into lines.
+    """
+    buffer = io.StringIO()
+    if df.empty:
+        return buffer
+
+    encoded_columns = []
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'INTEGER', 'BIGINT', 'SMALLINT', 'DOUBLE PRECISION'):
+            numeric = pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            null_mask = ~np.isfinite(numeric)
+            if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+                values = np.where(null_mask, 0.0, numeric).tolist()
+            else:
+                values = np.where(null_mask, 0, np.round(numeric)).astype('int64').tolist()
+            text = np.array(list(map(str, values)), dtype=object)
+        elif pg_type == 'DATE':
+            dates = pd.to_datetime(series, errors='coerce')
+            null_mask = dates.isna().to_numpy()
+            text = dates.dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+        else:
+            null_mask = series.isna().to_numpy()
+            text = (series.astype(str)
+                    .str.replace('\\', '\\\\', regex=False)
+                    .str.replace('\t', '\\t', regex=False)
+                    .str.replace('\n', '\\n', regex=False)
+                    .str.replace('\r', '\\r', regex=False)
+                    .to_numpy(dtype=object))
+        text[null_mask] = '\\N'
+        encoded_columns.append(text)
+
+    buffer.write('\n'.join(map('\t'.join, zip(*encoded_columns))))
+    buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_dataframe(cur, df, full_table_name, table_columns):
+    """Bulk-loads a DataFrame into a table with COPY, using the table schema for column order."""
+    copy_query = sql.SQL("COPY {table_name} ({columns}) FROM STDIN;").format(
+        table_name=full_table_name,
+        columns=sql.SQL(", ").join(sql.Identifier(col) for col, _ in table_columns)
+    )
+    cur.copy_expert(copy_query, serialize_for_copy(df, table_columns))
+
+
+def table_has_primary_key(cur, schema_name, table_name_str):
+    """Returns True if the table exists and already carries a primary key (required for ON CONFLICT)."""
+    cur.execute("""
+        SELECT 1 FROM pg_index i
+        JOIN pg_class c ON c.oid = i.indrelid
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s AND i.indisprimary;
+    """, (schema_name, table_name_str))
+    return cur.fetchone() is not None
+
+
+def get_table_columns(cur, schema_name, table_name_str):
+    """Returns the set of column names of the table (empty if it does not exist)."""
+    cur.execute("""
+        SELECT column_name FROM information_schema.columns
+        WHERE table_schema = %s AND table_name = %s;
+    """, (schema_name, table_name_str))
+    return {row[0] for row in cur.fetchall()}
+
+
+def drop_table_or_view(cur, schema_name, relation_name):
+    """Drops a relation that may be a table (before the company dimension) or a view (after it)."""
+    cur.execute("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s;
+    """, (schema_name, relation_name))
+    existing = cur.fetchone()
+    if existing:
+        kind = "VIEW" if existing[0] == 'v' else "TABLE"
+        cur.execute(sql.SQL("DROP {kind} {relation} CASCADE;").format(
+            kind=sql.SQL(kind), relation=sql.Identifier(schema_name, relation_name)
+        ))
+
+
+def index_aggregate_fact_table(cur, full_table_id, key_columns):
+    """
+    Indexes a freshly built aggregate fact table and refreshes its statistics: a btree on the fact key serves
+    the per-company lookups of the wide-view workers, a BRIN on period_date serves period range scans.
+    """
+    cur.execute(sql.SQL("CREATE INDEX ON {table} ({columns});").format(
+        table=full_table_id, columns=sql.SQL(", ").join(map(sql.Identifier, key_columns))
+    ))
+    cur.execute(sql.SQL("CREATE INDEX ON {table} USING brin (period_date);").format(table=full_table_id))
+    cur.execute(sql.SQL("ANALYZE {table};").format(table=full_table_id))
+
+
+def ensure_dim_company_table(cur):
+    cur.execute(sql.SQL("""
+        CREATE TABLE IF NOT EXISTS {dim_table} (
+            symbol_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            symbol TEXT NOT NULL UNIQUE CHECK (symbol = lower(symbol)),
+            {attributes},
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """).format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE),
+        attributes=build_column_definitions([(col, "TEXT") for col in RATIO_COMPANY_COLUMNS[1:]])
+    ))
+
+
+def upsert_company(cur, company_record):
+    """
+    Registers a company in the shared company dimension and refreshes its attributes; as in the screener and
+    price writers, a new non-null value wins and a missing one keeps the stored value. Returns the symbol_id.
+    """
+    ensure_dim_company_table(cur)
+    attribute_columns = RATIO_COMPANY_COLUMNS[1:]
+    cur.execute(sql.SQL("""
+        INSERT INTO {dim_table} AS d (symbol, {columns})
+        VALUES (%s, {placeholders})
+        ON CONFLICT (symbol) DO UPDATE SET {assignments}, updated_at = now()
+        WHERE ({current_values}) IS DISTINCT FROM ({merged_values});
+    """).format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE),
+        columns=sql.SQL(", ").join(map(sql.Identifier, attribute_columns)),
+        placeholders=sql.SQL(", ").join(sql.Placeholder() * len(attribute_columns)),
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{col} = COALESCE(EXCLUDED.{col}, d.{col})").format(col=sql.Identifier(col)) for col in attribute_columns
+        ),
+        current_values=sql.SQL(", ").join(sql.SQL("d.{col}").format(col=sql.Identifier(col)) for col in attribute_columns),
+        merged_values=sql.SQL(", ").join(
+            sql.SQL("COALESCE(EXCLUDED.{col}, d.{col})").format(col=sql.Identifier(col)) for col in attribute_columns
+        )
+    ), [str(company_record['symbol']).lower()] + [
+        None if pd.isna(company_record.get(col)) else str(company_record.get(col)) for col in attribute_columns
+    ])
+    cur.execute(sql.SQL("SELECT symbol_id FROM {dim_table} WHERE symbol = %s;").format(
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE)
+    ), (str(company_record['symbol']).lower(),))
+    return cur.fetchone()[0]
+
+
+def upsert_from_staging(cur, df, full_table_name, table_columns, key_columns):
+    """
+    Loads the DataFrame into a temporary staging table with COPY and applies only the difference
+    to the target table: new keys are inserted, rows whose non-key columns changed are updated,
+    and rows that no longer exist in the source are deleted. Unchanged rows are not rewritten.
+    Returns (rows_upserted, rows_deleted).
+    """
+    staging_table = sql.Identifier("staging_company_load")
+    key_list = sql.SQL(", ").join(sql.Identifier(col) for col in key_columns)
+    value_columns = [col for col, _ in table_columns if col not in key_columns]
+    column_list = sql.SQL(", ").join(sql.Identifier(col) for col, _ in table_columns)
+
+    cur.execute(sql.SQL("CREATE TEMP TABLE {staging} (LIKE {target} INCLUDING DEFAULTS) ON COMMIT DROP;").format(
+        staging=staging_table, target=full_table_name
+    ))
+    copy_dataframe(cur, df, staging_table, table_columns)
+
+    upsert_query = sql.SQL("""
+        INSERT INTO {target} AS t ({columns})
+        SELECT {columns} FROM {staging}
+        ON CONFLICT ({keys}) DO UPDATE SET {assignments}
+        WHERE ({current_values}) IS DISTINCT FROM ({new_values});
+    """).format(
+        target=full_table_name,
+        staging=staging_table,
+        columns=column_list,
+        keys=key_list,
+        assignments=sql.SQL(", ").join(
+            sql.SQL("{col} = EXCLUDED.{col}").format(col=sql.Identifier(col)) for col in value_columns
+        ),
+        current_values=sql.SQL(", ").join(sql.SQL("t.{col}").format(col=sql.Identifier(col)) for col in value_columns),
+        new_values=sql.SQL(", ").join(sql.SQL("EXCLUDED.{col}").format(col=sql.Identifier(col)) for col in value_columns)
+    )
+    cur.execute(upsert_query)
+    rows_upserted = cur.rowcount
+
+    delete_query = sql.SQL("""
+        DELETE FROM {target} AS t
+        WHERE NOT EXISTS (SELECT 1 FROM {staging} s WHERE {key_match});
+    """).format(
+        target=full_table_name,
+        staging=staging_table,
+        key_match=sql.SQL(" AND ").join(
+            sql.SQL("s.{col} = t.{col}").format(col=sql.Identifier(col)) for col in key_columns
+        )
+    )
+    cur.execute(delete_query)
+    rows_deleted = cur.rowcount
+    return rows_upserted, rows_deleted
+
+
+def create_and_insert_ratio_data(df_to_insert, symbol, table_suffix=RATIO_TABLE_SUFFIXES['quarterly']):
+    """
+    Loads the processed ratio data for a single company. The company is registered in the company dimension
+    and its table stores the ratios under the returned symbol_id. In "upsert" mode the table is kept in place
+    and only changed rows are written; in "replace" mode the table is dropped, recreated and bulk-loaded.
+    Returns True if the company table was committed.
     """
     conn = None
     try:
         conn = psycopg2.connect(**DB_PARAMS)
-        conn.set_isolation_level(ISOLATION_LEVEL_AUTOCOMMIT)
         cur = conn.cursor()
         cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {schema};").format(schema=sql.Identifier(SCHEMA_NAME)))
 
-        table_name_str = symbol.lower().replace('.', '_') + '_ratios'
+        table_name_str = symbol.lower().replace('.', '_') + table_suffix
         full_table_name = sql.Identifier(SCHEMA_NAME, table_name_str)
 
+        df_to_insert.drop_duplicates(subset=RATIO_TABLE_KEY, keep='last', inplace=True)
+        company_record = df_to_insert.iloc[0].to_dict() if not df_to_insert.empty else {}
+        symbol_id = upsert_company(cur, {**company_record, 'symbol': symbol})
+        df_to_insert = df_to_insert.assign(symbol_id=symbol_id)
+
+        # Tables created before the upsert mode or the current fact layout existed are rebuilt once.
+        if (REFRESH_MODE == "upsert" and table_has_primary_key(cur, SCHEMA_NAME, table_name_str)
+                and {col for col, _ in RATIO_FACT_COLUMNS} <= get_table_columns(cur, SCHEMA_NAME, table_name_str)):
+            rows_upserted, rows_deleted = upsert_from_staging(cur, df_to_insert, full_table_name, RATIO_FACT_COLUMNS, RATIO_FACT_KEY)
+            conn.commit()
+            logging.info(f"Refreshed {full_table_name.as_string(conn)} in place: {rows_upserted} rows inserted/updated, "
+                         f"{rows_deleted} rows deleted, {len(df_to_insert)} rows in source.")
+            return True
+
         logging.debug(f"Dropping table {full_table_name.as_string(conn)} if it exists...")
         cur.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_table_name))
 
-        create_table_query = sql.SQL("""
-            CREATE TABLE {table_name} (
-                symbol TEXT NOT NULL,
-                company_name TEXT,
-                sector TEXT,
-                industry TEXT,
-                market_cap_group TEXT,
-                country TEXT,
-                analyst_rating TEXT,
-                ma50_vs_200d TEXT,
-                statement_type TEXT,
-                item TEXT,
-                header TEXT,
-                value NUMERIC,
-                sort_key INTEGER,
-                extracted_order INTEGER,
-                period_date DATE,
-                filing_type TEXT,
-                PRIMARY KEY (symbol, item, header)
-            );
-        """).format(table_name=full_table_name)
+        create_table_query = sql.SQL("CREATE TABLE {table_name} ({columns}, PRIMARY KEY ({keys}));").format(
+            table_name=full_table_name,
+            columns=build_column_definitions(RATIO_FACT_COLUMNS),
+            keys=sql.SQL(", ").join(sql.Identifier(col) for col in RATIO_FACT_KEY)
+        )
         cur.execute(create_table_query)
 
-        df_to_insert.drop_duplicates(subset=['symbol', 'item', 'header'], keep='last', inplace=True)
-
-        insert_data = []
-        for _, row in df_to_insert.iterrows():
-            ratio_value = pd.to_numeric(row.get('value'), errors='coerce')
-            if pd.isna(ratio_value): ratio_value = None
-
-            insert_data.append((
-                row['symbol'], row.get('company_name'), row.get('sector'), row.get('industry'),
-                row.get('market_cap_group'), row.get('country'), row.get('analyst_rating'), row.get('ma50_vs_200d'),
-                row['statement_type'], row['item'], row['header'], ratio_value,
-                row['sort_key'], row['extracted_order'], row['period_date'], row['filing_type']
-            ))
-
-        insert_query = sql.SQL("""
-            INSERT INTO {table_name} (
-                symbol, company_name, sector, industry, market_cap_group, country, analyst_rating, ma50_vs_200d,
-                statement_type, item, header, value,
-                sort_key, extracted_order, period_date, filing_type
-            ) VALUES %s;
-        """).format(table_name=full_table_name)
-
-        if insert_data:
-            execute_values(cur, insert_query, insert_data, page_size=500)
-            logging.info(f"Successfully inserted {len(insert_data)} ratio rows into {full_table_name.as_string(conn)}.")
+        if not df_to_insert.empty:
+            copy_dataframe(cur, df_to_insert, full_table_name, RATIO_FACT_COLUMNS)
+            logging.info(f"Successfully inserted {len(df_to_insert)} ratio rows into {full_table_name.as_string(conn)}.")
         else:
             logging.info(f"No ratio data to insert for {symbol}.")
+        conn.commit()
+        return True
     except Exception as e:
+        if conn: conn.rollback()
         logging.error(f"Database error for {symbol} ratios: {e}", exc_info=True)
+        return False
     finally:
         if conn:
             if 'cur' in locals() and cur: cur.close()
@@ -419,10 +782,14 @@ def create_and_insert_ratio_data(df_to_insert, symbol):
 
 
 def create_aggregate_ratio_table(conn, cursor, sector_name_param, symbols):
-    """Creates the aggregate table for the given sector, dropping dependent views first."""
+    """
+    Creates the aggregate fact table for the given sector, and the aggregate_table_<sector>_ratios view that
+    joins the company attributes back on in the original layout, dropping dependent views first.
+    """
     aggregate_table_name = f"aggregate_table_{sector_name_param}_ratios"
     full_aggregate_table_id = sql.Identifier("public", aggregate_table_name)
-    logging.info(f"\n--- Recreating aggregate table: {full_aggregate_table_id.as_string(conn)} ---")
+    full_aggregate_fact_id = sql.Identifier("public", f"aggregate_fact_{sector_name_param}_ratios")
+    logging.info(f"\n--- Recreating aggregate table: {full_aggregate_fact_id.as_string(conn)} ---")
 
     wide_mv_schema = sector_name_param
     percent_change_schema = "public"
@@ -437,22 +804,61 @@ def create_aggregate_ratio_table(conn, cursor, sector_name_param, symbols):
         cursor.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {mv} CASCADE;").format(mv=mv_name))
     conn.commit()
 
-    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_aggregate_table_id))
+    drop_table_or_view(cursor, "public", aggregate_table_name)
+    cursor.execute(sql.SQL("DROP TABLE IF EXISTS {table_name} CASCADE;").format(table_name=full_aggregate_fact_id))
 
+    # Ratio tables not reloaded since the current fact layout was introduced lack symbol_id (they still carry
+    # the company attributes) and/or period_ordinal; both are derived while aggregating.
+    legacy_period_ordinal = sql.SQL(
+        "COALESCE(substring(header FROM '_([0-9]{{4}})$')::int * 10 + CASE split_part(upper(header), '_', 1) {ranks} ELSE {unknown} END, 0)"
+    ).format(
+        ranks=sql.SQL(" ").join(sql.SQL("WHEN {} THEN {}").format(sql.Literal(p), sql.Literal(r)) for p, r in PERIOD_RANKS.items()),
+        unknown=sql.Literal(UNKNOWN_PERIOD_RANK)
+    )
     union_queries = []
     for symbol in symbols:
         table_name_str = symbol.lower().replace('.', '_') + '_ratios'
         individual_table_id = sql.Identifier(sector_name_param, table_name_str)
-        union_queries.append(sql.SQL("SELECT * FROM {individual_table}").format(individual_table=individual_table_id))
+        existing_columns = get_table_columns(cursor, sector_name_param, table_name_str)
+        if not existing_columns:
+            continue
+        column_exprs = []
+        for col, _ in RATIO_FACT_COLUMNS:
+            if col in existing_columns:
+                column_exprs.append(sql.Identifier(col))
+            elif col == "symbol_id":
+                column_exprs.append(sql.SQL("{} AS symbol_id").format(sql.Literal(upsert_company(cursor, {'symbol': symbol}))))
+            else:
+                column_exprs.append(sql.SQL("{} AS period_ordinal").format(legacy_period_ordinal))
+        union_queries.append(sql.SQL("SELECT {columns} FROM {individual_table}").format(
+            columns=sql.SQL(", ").join(column_exprs), individual_table=individual_table_id
+        ))
 
     if not union_queries: return False
 
     full_union_query = sql.SQL(" UNION ALL ").join(union_queries)
     create_table_sql = sql.SQL("CREATE TABLE {agg_table_name} AS ({union_query});").format(
-        agg_table_name=full_aggregate_table_id,
+        agg_table_name=full_aggregate_fact_id,
         union_query=full_union_query
     )
     cursor.execute(create_table_sql)
+    index_aggregate_fact_table(cursor, full_aggregate_fact_id, RATIO_FACT_KEY)
+
+    # The compatibility view keeps the original column order, taking company attributes from the dimension.
+    cursor.execute(sql.SQL("""
+        CREATE VIEW {view_name} AS
+        SELECT {columns}
+        FROM {fact_table} f
+        JOIN {dim_table} d ON d.symbol_id = f.symbol_id;
+    """).format(
+        view_name=full_aggregate_table_id,
+        columns=sql.SQL(", ").join(
+            sql.SQL("{alias}.{col}").format(alias=sql.Identifier("d" if col in RATIO_COMPANY_COLUMNS else "f"), col=sql.Identifier(col))
+            for col, _ in RATIO_TABLE_COLUMNS
+        ),
+        fact_table=full_aggregate_fact_id,
+        dim_table=sql.Identifier(*DIM_COMPANY_TABLE)
+    ))
     conn.commit()
     logging.info("Aggregate table created successfully.")
     return True
@@ -468,17 +874,25 @@ def create_views_for_ticker_worker(symbol, sector_name_param):
         cursor.execute("CREATE EXTENSION IF NOT EXISTS tablefunc;")
         conn.commit()
 
-        aggregate_table_id = sql.Identifier("public", f"aggregate_table_{sector_name_param}_ratios")
+        aggregate_table_id = sql.Identifier("public", f"aggregate_fact_{sector_name_param}_ratios")
+        dim_company_id = sql.Identifier(*DIM_COMPANY_TABLE)
         wide_mv_schema = sector_name_param
         mv_name_str = f"{symbol.lower().replace('.', '_')}_ratios_wide"
         full_mv_name = sql.Identifier(wide_mv_schema, mv_name_str)
 
-        # FIXED: Use SQL composition instead of .format() to avoid errors with regex characters.
-        query_part1 = sql.SQL("SELECT header FROM ( SELECT DISTINCT header, SUBSTRING(header FROM '_(\d{4})$')::int AS year_val, CASE WHEN header LIKE 'Q1%%' THEN 1 WHEN header LIKE 'Q2%%' THEN 2 WHEN header LIKE 'H1%%' THEN 2 WHEN header LIKE 'Q3%%' THEN 3 WHEN header LIKE 'Q4%%' THEN 4 WHEN header LIKE 'H2%%' THEN 4 WHEN header LIKE 'FY%%' THEN 5 ELSE 99 END AS period_val FROM ")
-        query_part2 = sql.SQL(" WHERE lower(symbol) = %s ) AS sorted_headers ORDER BY year_val DESC, period_val DESC;")
-        header_query = query_part1 + aggregate_table_id + query_part2
-        
-        cursor.execute(header_query, (symbol.lower(),))
+        # Headers most recent first, ordered by the stored chronological period ordinal.
+        header_query = sql.SQL(
+            "SELECT header FROM {agg_table} WHERE symbol_id = %s GROUP BY header ORDER BY max(period_ordinal) DESC;"
+        ).format(agg_table=aggregate_table_id)
+
+        cursor.execute(sql.SQL("SELECT symbol_id FROM {dim_table} WHERE symbol = %s;").format(dim_table=dim_company_id), (symbol.lower(),))
+        symbol_id_row = cursor.fetchone()
+        if symbol_id_row is None:
+            logging.warning(f"WORKER: {symbol} is not in the company dimension, skipping MV creation.")
+            return
+        symbol_id = symbol_id_row[0]
+
+        cursor.execute(header_query, (symbol_id,))
         ordered_headers = [row[0] for row in cursor.fetchall()]
         if not ordered_headers: 
             logging.warning(f"WORKER: No headers found for {symbol}, skipping MV creation.")
@@ -487,24 +901,24 @@ def create_views_for_ticker_worker(symbol, sector_name_param):
         crosstab_output_defs_list = ["item TEXT"] + [sql.SQL("{c} NUMERIC").format(c=sql.Identifier(h)).as_string(conn) for h in ordered_headers]
         crosstab_output_defs_sql = sql.SQL(", ").join(map(sql.SQL, crosstab_output_defs_list))
 
-        source_sql = cursor.mogrify(sql.SQL("SELECT item, header, value FROM {agg_table} WHERE lower(symbol) = %s ORDER BY 1;").format(agg_table=aggregate_table_id), (symbol.lower(),)).decode('utf-8')
+        source_sql = cursor.mogrify(sql.SQL("SELECT item, header, value FROM {agg_table} WHERE symbol_id = %s ORDER BY 1;").format(agg_table=aggregate_table_id), (symbol_id,)).decode('utf-8')
         category_sql = cursor.mogrify("SELECT unnest(%s::text[])", (ordered_headers,)).decode('utf-8')
 
         final_query = sql.SQL("""
             CREATE MATERIALIZED VIEW {mv_name} AS
             SELECT T1.symbol, T1.company_name, T1.sector, T1.industry, T1.market_cap_group, T1.country, T1.analyst_rating, T1.ma50_vs_200d, T2.*
-            FROM (SELECT DISTINCT symbol, company_name, sector, industry, market_cap_group, country, analyst_rating, ma50_vs_200d FROM {agg_table} WHERE lower(symbol) = %s) AS T1,
+            FROM (SELECT symbol, company_name, sector, industry, market_cap_group, country, analyst_rating, ma50_vs_200d FROM {dim_table} WHERE symbol_id = %s) AS T1,
                  (SELECT * FROM crosstab({source_sql}, {category_sql}) AS ct({crosstab_output_defs})) AS T2;
         """).format(
             mv_name=full_mv_name, 
-            agg_table=aggregate_table_id, 
+            dim_table=dim_company_id, 
             source_sql=sql.Literal(source_sql), 
             category_sql=sql.Literal(category_sql), 
             crosstab_output_defs=crosstab_output_defs_sql
         )
 
         cursor.execute(sql.SQL("DROP MATERIALIZED VIEW IF EXISTS {mv_name};").format(mv_name=full_mv_name))
-        cursor.execute(final_query, (symbol.lower(),))
+        cursor.execute(final_query, (symbol_id,))
         conn.commit()
         logging.info(f"WORKER: Successfully created MV for '{symbol}'.")
 
@@ -525,7 +939,8 @@ def create_materialized_views(conn, cursor, sector_name_param, symbols):
     logging.info("--- Finished parallel creation of company-specific wide MVs ---")
 
     # The rest of the MVs are created sequentially in the main process
-    aggregate_table_id = sql.Identifier("public", f"aggregate_table_{sector_name_param}_ratios")
+    aggregate_fact_id = sql.Identifier("public", f"aggregate_fact_{sector_name_param}_ratios")
+    dim_company_id = sql.Identifier(*DIM_COMPANY_TABLE)
 
     logging.info(f"\n--- Creating Sequential Percent Change MV for {sector_name_param} ratios ---")
     pop_mv_name = sql.Identifier("public", f"{sector_name_param}_ratios_changes")
@@ -533,12 +948,12 @@ def create_materialized_views(conn, cursor, sector_name_param, symbols):
         cursor.execute(sql.SQL('DROP MATERIALIZED VIEW IF EXISTS {mv_name};').format(mv_name=pop_mv_name))
         create_pop_sql = sql.SQL("""
             CREATE MATERIALIZED VIEW {mv_name} AS
-            WITH p AS (SELECT t.*, SUBSTRING(t.header FROM '^[A-Z]+') AS pt FROM {agg_table} t WHERE t.value IS NOT NULL AND t.value <> 0),
-            l AS (SELECT p.*, lag(p.value, 1) OVER (PARTITION BY p.symbol, p.item, p.pt ORDER BY p.period_date) AS pv FROM p)
-            SELECT symbol, company_name, sector, industry, market_cap_group, country, analyst_rating, ma50_vs_200d, item AS financial_ratio, header AS period, period_date, value AS current_value, pv AS previous_period_value,
-                   round(((value - pv) / abs(NULLIF(pv, 0))) * 100, 4) AS sequential_percent_change
-            FROM l WHERE pv IS NOT NULL ORDER BY symbol, item, period_date;
-        """).format(mv_name=pop_mv_name, agg_table=aggregate_table_id)
+            WITH p AS (SELECT t.*, CASE mod(t.period_ordinal, 10) WHEN 7 THEN 'FY' WHEN 2 THEN 'H' WHEN 5 THEN 'H' ELSE 'Q' END AS pt FROM {agg_table} t WHERE t.value IS NOT NULL AND t.value <> 0),
+            l AS (SELECT p.*, lag(p.value, 1) OVER (PARTITION BY p.symbol_id, p.item, p.pt ORDER BY p.period_ordinal) AS pv FROM p)
+            SELECT d.symbol, d.company_name, d.sector, d.industry, d.market_cap_group, d.country, d.analyst_rating, d.ma50_vs_200d, l.item AS financial_ratio, l.header AS period, l.period_date, l.value AS current_value, l.pv AS previous_period_value,
+                   round(((l.value - l.pv) / abs(NULLIF(l.pv, 0))) * 100, 4) AS sequential_percent_change
+            FROM l JOIN {dim_table} d ON d.symbol_id = l.symbol_id WHERE l.pv IS NOT NULL ORDER BY d.symbol, l.item, l.period_ordinal;
+        """).format(mv_name=pop_mv_name, agg_table=aggregate_fact_id, dim_table=dim_company_id)
         cursor.execute(create_pop_sql)
         logging.info(f"Sequential MV '{pop_mv_name.as_string(conn)}' created.")
     except Exception as e:
@@ -550,12 +965,12 @@ def create_materialized_views(conn, cursor, sector_name_param, symbols):
         cursor.execute(sql.SQL('DROP MATERIALIZED VIEW IF EXISTS {mv_name};').format(mv_name=yoy_mv_name))
         create_yoy_sql = sql.SQL("""
             CREATE MATERIALIZED VIEW {mv_name} AS
-            WITH p AS (SELECT t.*, CASE WHEN t.header LIKE 'Q1%%' THEN 'Q1' WHEN t.header LIKE 'Q2%%' THEN 'Q2' WHEN t.header LIKE 'Q3%%' THEN 'Q3' WHEN t.header LIKE 'Q4%%' THEN 'Q4' WHEN t.header LIKE 'H1%%' THEN 'H1' WHEN t.header LIKE 'H2%%' THEN 'H2' WHEN t.header LIKE 'FY%%' THEN 'FY' END AS sp FROM {agg_table} t WHERE t.value IS NOT NULL AND t.value <> 0),
-            l AS (SELECT p.*, lag(p.value, 1) OVER (PARTITION BY p.symbol, p.item, p.sp ORDER BY p.period_date) as pvy FROM p)
-            SELECT symbol, company_name, sector, industry, market_cap_group, country, analyst_rating, ma50_vs_200d, item AS financial_ratio, header AS period, period_date, value AS current_value, pvy AS previous_year_value,
-                   round(((value - pvy) / abs(NULLIF(pvy, 0))) * 100, 4) AS yoy_percent_change
-            FROM l WHERE pvy IS NOT NULL ORDER BY symbol, item, period_date;
-        """).format(mv_name=yoy_mv_name, agg_table=aggregate_table_id)
+            WITH p AS (SELECT t.*, mod(t.period_ordinal, 10) AS sp FROM {agg_table} t WHERE t.value IS NOT NULL AND t.value <> 0),
+            l AS (SELECT p.*, lag(p.value, 1) OVER (PARTITION BY p.symbol_id, p.item, p.sp ORDER BY p.period_ordinal) as pvy FROM p)
+            SELECT d.symbol, d.company_name, d.sector, d.industry, d.market_cap_group, d.country, d.analyst_rating, d.ma50_vs_200d, l.item AS financial_ratio, l.header AS period, l.period_date, l.value AS current_value, l.pvy AS previous_year_value,
+                   round(((l.value - l.pvy) / abs(NULLIF(l.pvy, 0))) * 100, 4) AS yoy_percent_change
+            FROM l JOIN {dim_table} d ON d.symbol_id = l.symbol_id WHERE l.pvy IS NOT NULL ORDER BY d.symbol, l.item, l.period_ordinal;
+        """).format(mv_name=yoy_mv_name, agg_table=aggregate_fact_id, dim_table=dim_company_id)
         cursor.execute(create_yoy_sql)
         logging.info(f"YoY MV '{yoy_mv_name.as_string(conn)}' created.")
     except Exception as e:
@@ -563,12 +978,192 @@ def create_materialized_views(conn, cursor, sector_name_param, symbols):
     conn.commit()
 
 
+# ==============================================================================
+# EARNINGS-CALENDAR REFRESH SCHEDULING
+# ==============================================================================
+
+def ensure_refresh_log_table(cur):
+    cur.execute(sql.SQL("CREATE SCHEMA IF NOT EXISTS {schema};").format(schema=sql.Identifier(SCHEMA_NAME)))
+    cur.execute(sql.SQL("CREATE TABLE IF NOT EXISTS {table} (symbol TEXT PRIMARY KEY, loaded_at TIMESTAMP NOT NULL);").format(
+        table=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)))
+
+
+def select_companies_due_for_refresh(schedule_df, today=None):
+    """
+    Given one row per company with the screener's filing/earnings dates and the time of its last load
+    (loaded_at), returns the lowercased symbols whose ratios could have changed since that load:
+    never loaded, a filing or earnings release dated on or after the load day, or a nextEarningsDate that
+    has passed since the load (the screener's filing dates can lag the release by a day or two).
+    """
+    today = pd.Timestamp(today or date.today())
+    loaded_on = pd.to_datetime(schedule_df['loaded_at'], errors='coerce').dt.normalize()
+    due = loaded_on.isna()
+    for col in SCREENER_FILING_DATE_COLUMNS:
+        filed_on = pd.to_datetime(schedule_df[col], errors='coerce')
+        due |= filed_on >= loaded_on
+    expected_on = pd.to_datetime(schedule_df['next_earnings_date'], errors='coerce')
+    due |= (expected_on > loaded_on) & (expected_on <= today)
+    return set(schedule_df.loc[due, 'symbol'])
+
+
+def fetch_refresh_schedule(symbols):
+    """
+    Returns the subset of the given symbols (lowercased) that need a refresh, or None when the screener table
+    cannot be read, in which case every company should be refreshed. Symbols missing from the screener table
+    are always due.
+    """
+    schema_name, table_name = SCREENER_TABLE
+    date_columns = SCREENER_FILING_DATE_COLUMNS + ['next_earnings_date']
+    lowered = sorted({symbol.lower() for symbol in symbols})
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        cur = conn.cursor()
+        ensure_refresh_log_table(cur)
+        conn.commit()
+        cur.execute(sql.SQL("""
+            SELECT u.symbol, {date_columns}, l.loaded_at
+            FROM unnest(%s::text[]) AS u(symbol)
+            LEFT JOIN {screener} s ON s.symbol = u.symbol
+            LEFT JOIN {log} l ON l.symbol = u.symbol;
+        """).format(
+            date_columns=sql.SQL(", ").join(sql.SQL("s.{}::text").format(sql.Identifier(col)) for col in date_columns),
+            screener=sql.Identifier(schema_name, table_name),
+            log=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)
+        ), (lowered,))
+        schedule_df = pd.DataFrame(cur.fetchall(), columns=['symbol'] + date_columns + ['loaded_at'])
+    except psycopg2.Error as e:
+        logging.warning(f"Could not read the refresh schedule from {schema_name}.{table_name}; refreshing every company: {e}")
+        return None
+    finally:
+        if conn:
+            conn.close()
+
+    due_symbols = select_companies_due_for_refresh(schedule_df)
+    logging.info(f"Earnings calendar: {len(due_symbols)} of {len(lowered)} companies could have new filings since their last load.")
+    return due_symbols
+
+
+def record_company_loads(loaded_at_by_symbol):
+    """Stores the time of each company's successful load, which the next run's schedule is measured from."""
+    if not loaded_at_by_symbol:
+        return
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        cur = conn.cursor()
+        ensure_refresh_log_table(cur)
+        cur.executemany(sql.SQL("""
+            INSERT INTO {log} (symbol, loaded_at) VALUES (%s, %s)
+            ON CONFLICT (symbol) DO UPDATE SET loaded_at = EXCLUDED.loaded_at;
+        """).format(log=sql.Identifier(SCHEMA_NAME, REFRESH_LOG_TABLE)),
+            [(symbol.lower(), loaded_at) for symbol, loaded_at in loaded_at_by_symbol.items()])
+        conn.commit()
+    except psycopg2.Error as e:
+        if conn: conn.rollback()
+        logging.error(f"Could not record company loads in {SCHEMA_NAME}.{REFRESH_LOG_TABLE}: {e}", exc_info=True)
+    finally:
+        if conn:
+            conn.close()
+
+
+# ==============================================================================
+# STAGE 4: PARQUET STAGING
+# ==============================================================================
+
+def conform_to_table_schema(df, table_columns):
+    """Selects the table's columns in schema order and coerces each one to the type it will have in Postgres."""
+    conformed = pd.DataFrame(index=df.index)
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').astype('float64')
+        elif pg_type in ('INTEGER', 'BIGINT', 'SMALLINT'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').round().astype('Int64')
+        elif pg_type == 'DATE':
+            conformed[col] = pd.to_datetime(series, errors='coerce')
+        else:
+            conformed[col] = series.astype(object).where(series.notna(), None).map(lambda v: v if v is None else str(v))
+    return conformed.reset_index(drop=True)
+
+
+def write_parquet_dataset(df, dataset_dir, partition_cols, table_columns, dictionary_cols=()):
+    """
+    Writes rows to a hive-partitioned Parquet dataset, replacing only the partitions present in df.
+    Columns in dictionary_cols are stored dictionary-encoded and read back as pandas categoricals.
+    """
+    if pa is None:
+        logging.warning("pyarrow is not installed; skipping Parquet staging.")
+        return
+    staged_df = conform_to_table_schema(df, table_columns)
+    for col in dictionary_cols:
+        staged_df[col] = staged_df[col].astype('category')
+    ds.write_dataset(
+        pa.Table.from_pandas(staged_df, preserve_index=False), dataset_dir, format='parquet',
+        partitioning=partition_cols, partitioning_flavor='hive',
+        existing_data_behavior='delete_matching', basename_template='part-{i}.parquet'
+    )
+
+
+def read_parquet_dataset(dataset_dir, partition_cols, filter_expression=None, columns=None):
+    """Reads a hive-partitioned Parquet dataset (optionally filtered and column-pruned) into a DataFrame."""
+    partitioning = ds.partitioning(pa.schema([(col, pa.string()) for col in partition_cols]), flavor='hive')
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=partitioning)
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+
+def reload_ratio_tables_from_parquet(dataset_dir):
+    """Rebuilds every ratio table of the configured sector from the staged dataset, without any network calls."""
+    df = read_parquet_dataset(dataset_dir, ['sector', 'symbol'], filter_expression=ds.field('sector') == SECTOR_TO_PROCESS)
+    if df.empty:
+        logging.warning(f"No staged ratio data found for sector '{SECTOR_TO_PROCESS}' in {dataset_dir}.")
+        return []
+    df['period_ordinal'] = encode_period_ordinals(df['header'])  # Datasets staged before the ordinal existed lack it
+
+    processed_symbols = []
+    for symbol, company_df in df.groupby('symbol', sort=True):
+        create_and_insert_ratio_data(company_df.reset_index(drop=True), symbol)
+        processed_symbols.append(symbol)
+    logging.info(f"Reloaded {len(processed_symbols)} ratio tables from {dataset_dir}.")
+    return processed_symbols
+
+
 # ==============================================================================
 # MAIN EXECUTION
 # ==============================================================================
 
+def build_ratio_aggregates_and_views(processed_symbols):
+    """Rebuilds the aggregate ratio table and all materialized views for the companies that were loaded."""
+    conn = None
+    try:
+        logging.info("\n--- STAGE 3: All fetching complete. Starting final aggregation and view creation. ---")
+        conn = psycopg2.connect(**DB_PARAMS)
+        conn.autocommit = True
+        cursor = conn.cursor()
+
+        if create_aggregate_ratio_table(conn, cursor, SCHEMA_NAME, processed_symbols):
+            create_materialized_views(conn, cursor, SCHEMA_NAME, processed_symbols)
+        else:
+            logging.error("Halting MV creation due to aggregation failure.")
+
+    except Exception as e:
+        logging.error(f"An error occurred during final database operations: {e}", exc_info=True)
+    finally:
+        if conn:
+            if 'cursor' in locals() and cursor: cursor.close()
+            conn.close()
+
+
 def main():
     """Main end-to-end execution function."""
+    if RELOAD_FROM_PARQUET and not (PARQUET_STAGING_DIR and ds is not None):
+        logging.error("RELOAD_FROM_PARQUET needs PARQUET_STAGING_DIR to be set and pyarrow to be installed.")
+        return
+    if RELOAD_FROM_PARQUET:
+        processed_symbols = reload_ratio_tables_from_parquet(os.path.join(PARQUET_STAGING_DIR, "ratios"))
+        if processed_symbols:
+            build_ratio_aggregates_and_views(processed_symbols)
+        return
 
     companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
     if companies_df.empty:
@@ -578,45 +1173,47 @@ def main():
     companies_to_process = companies_df.to_dict('records')
     logging.info(f"Discovered {len(companies_to_process)} companies to process for ratio data.")
 
+    # Companies that cannot have filed since their last load keep their tables and only rejoin the aggregate.
+    unchanged_symbols = []
+    if SCHEDULE_FROM_EARNINGS_CALENDAR:
+        due_symbols = fetch_refresh_schedule([c['symbol'] for c in companies_to_process])
+        if due_symbols is not None:
+            unchanged_symbols = [c['symbol'] for c in companies_to_process if c['symbol'].lower() not in due_symbols]
+            companies_to_process = [c for c in companies_to_process if c['symbol'].lower() in due_symbols]
+            if not companies_to_process:
+                logging.info("No company has filed since its last load; ratio tables and views are current.")
+                return
 
     logging.info(f"\n--- STAGE 2: Submitting {len(companies_to_process)} companies to a thread pool for ratio fetching ---")
     processed_symbols = []
-    rate_limiter = RateLimiter(API_REQUESTS_PER_MINUTE)
+    loaded_at_by_symbol = {}
+    rate_limiter = RateLimiter(API_REQUESTS_PER_MINUTE, burst=API_REQUEST_BURST, jitter=API_REQUEST_JITTER)
 
     with concurrent.futures.ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='RatioWorker') as executor:
         futures = {executor.submit(process_company_worker, c, rate_limiter): c for c in companies_to_process}
 
         for i, future in enumerate(concurrent.futures.as_completed(futures)):
-            symbol, df_result = future.result()
+            symbol, df_result, annual_df = future.result()
             logging.info(f"--- RESULT RECEIVED ({i+1}/{len(companies_to_process)}) for {symbol} ---")
+            if annual_df is not None and not annual_df.empty:
+                create_and_insert_ratio_data(annual_df, symbol, RATIO_TABLE_SUFFIXES['annual'])
             if df_result is not None and not df_result.empty:
-                create_and_insert_ratio_data(df_result, symbol)
+                if PARQUET_STAGING_DIR:
+                    write_parquet_dataset(df_result, os.path.join(PARQUET_STAGING_DIR, "ratios"), ['sector', 'symbol'],
+                                          RATIO_TABLE_COLUMNS, RATIO_DICTIONARY_COLUMNS)
+                if create_and_insert_ratio_data(df_result, symbol):
+                    loaded_at_by_symbol[symbol] = datetime.now()
                 processed_symbols.append(symbol)
             else:
                 logging.warning(f"Skipping DB insert for {symbol} due to missing/empty data.")
 
+    record_company_loads(loaded_at_by_symbol)
+
     if not processed_symbols:
         logging.warning("No companies were successfully processed. Halting before final aggregation.")
         return
 
-    conn = None
-    try:
-        logging.info("\n--- STAGE 3: All fetching complete. Starting final aggregation and view creation. ---")
-        conn = psycopg2.connect(**DB_PARAMS)
-        conn.autocommit = True
-        cursor = conn.cursor()
-
-        if create_aggregate_ratio_table(conn, cursor, SCHEMA_NAME, processed_symbols):
-            create_materialized_views(conn, cursor, SCHEMA_NAME, processed_symbols)
-        else:
-            logging.error("Halting MV creation due to aggregation failure.")
-
-    except Exception as e:
-        logging.error(f"An error occurred during final database operations: {e}", exc_info=True)
-    finally:
-        if conn:
-            if 'cursor' in locals() and cursor: cursor.close()
-            conn.close()
+    build_ratio_aggregates_and_views(processed_symbols + unchanged_symbols)
 
     logging.info("\nScript finished. All resources closed.")
 
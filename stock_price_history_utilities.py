@@ -1,14 +1,24 @@
+import io
 import requests
 import pandas as pd
 from datetime import datetime, timedelta
 import psycopg2
-import psycopg2.extras # Needed for execute_batch
 import logging
 import time
 import numpy as np
 import threading
 import concurrent.futures
+import queue
+import os
 import re
+import shutil
+from psycopg2 import pool
+
+try:  # Parquet staging is optional; everything else works without pyarrow.
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
 
 # --- Core Configuration ---
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -32,6 +42,54 @@ SCHEMA_NAME = "stock_price"
 POLYGON_MAX_WORKERS = 55 
 POLYGON_API_REQUESTS_PER_SECOND = 80
 
+# --- Database Writer Pipeline Configuration ---
+# Fetchers hand finished frames to a bounded queue; when it is full they block, so memory stays flat
+# no matter how far fetching runs ahead of writing. Writers batch frames across symbols into one COPY.
+WRITER_THREADS = 3
+WRITE_QUEUE_MAX_FRAMES = 20
+WRITE_BATCH_MAX_ROWS = 100000
+WRITE_BATCH_FLUSH_SECONDS = 5
+
+# --- Technical Indicator Configuration ---
+TRADING_DAYS_PER_YEAR = 252
+VOLATILITY_WINDOWS = [21, 63, 252]  # Realized volatility windows, in trading days (252 feeds volatility_past_year)
+MOVING_AVERAGE_WINDOWS = [50, 200]  # SMA and EMA windows
+ATR_WINDOW = 14
+INDICATOR_STATE_PATH = "stock_price_indicator_state.npz"
+# "full" reloads the whole history for every symbol and re-seeds the indicator state;
+# "daily" appends every trading day since the saved state (through yesterday) for all symbols.
+RUN_MODE = "full"
+
+# --- Parquet Staging Configuration ---
+# When set, every fetched symbol is also written to a Parquet dataset partitioned by symbol/year (requires pyarrow).
+PARQUET_STAGING_DIR = None  # e.g. "parquet_staging"
+# When True, no Polygon calls are made: the aggregate table is rebuilt from PARQUET_STAGING_DIR instead.
+RELOAD_FROM_PARQUET = False
+
+# --- Company Dimension ---
+# Company attributes are stored once per symbol in the shared dimension table; fact tables carry its symbol_id.
+DIM_COMPANY_TABLE = 'public."dim_company"'
+METADATA_COLUMNS = ['company_name', 'sector', 'industry', 'market_cap_group', 'country', 'analyst_rating', 'ma50_vs_200d']
+COMPANY_COLUMNS = [("symbol", "TEXT")] + [(col, "TEXT") for col in METADATA_COLUMNS]
+
+# --- Price Table Schema ---
+# Single source of truth for the column order of the price tables; used for both CREATE TABLE and COPY.
+PRICE_VALUE_COLUMNS = [
+    ("date", "DATE"), ("open", "NUMERIC"), ("high", "NUMERIC"), ("low", "NUMERIC"), ("close", "NUMERIC"),
+    ("adjusted_close", "NUMERIC"), ("change", "NUMERIC"), ("volume", "NUMERIC"), ("dollar_volume", "NUMERIC"),
+    ("volatility_past_year", "NUMERIC")
+]
+INDICATOR_TABLE_COLUMNS = (
+    [(f"volatility_{w}d", "NUMERIC") for w in VOLATILITY_WINDOWS if w != TRADING_DAYS_PER_YEAR]
+    + [(f"{kind}_{w}", "NUMERIC") for w in MOVING_AVERAGE_WINDOWS for kind in ("sma", "ema")]
+    + [(f"atr_{ATR_WINDOW}", "NUMERIC"), ("max_drawdown", "NUMERIC")]
+)
+PRICE_VALUE_COLUMNS += INDICATOR_TABLE_COLUMNS
+PRICE_FACT_COLUMNS = [("symbol_id", "INTEGER")] + PRICE_VALUE_COLUMNS  # The stored fact table
+PRICE_TABLE_COLUMNS = COMPANY_COLUMNS + PRICE_VALUE_COLUMNS  # The frames and the compatibility view
+PRICE_COLUMN_RENAME_MAP = {'Date': 'date', 'Open': 'open', 'High': 'high', 'Low': 'low', 'Close': 'close', 'Volume': 'volume'}
+PRICE_PARQUET_COLUMNS = PRICE_TABLE_COLUMNS + [("year", "TEXT")]  # Partition key only; not loaded into Postgres
+
 
 # ==============================================================================
 # STAGE 1: DYNAMIC COMPANY DISCOVERY
@@ -151,17 +209,39 @@ def fetch_historical_data_polygon(symbol, api_key, years_back=5):
     numeric_cols = ['Open', 'High', 'Low', 'Close', 'Volume']
     for col in numeric_cols: df[col] = pd.to_numeric(df[col], errors='coerce')
     df['adjusted_close'] = df['Close']
-    df.sort_values(by='Date', inplace=True)
-    df['change'] = round(((df['Close'] - df['Close'].shift(1)) / df['Close'].shift(1)) * 100, 3)
+    df = df.dropna(subset=['Close']).drop_duplicates(subset=['Date'], keep='last').sort_values(by='Date').reset_index(drop=True)
     df['dollar_volume'] = round(df['adjusted_close'] * df['Volume'],-1)
-    df['log_return'] = np.log(df['adjusted_close'] / df['adjusted_close'].shift(1))
-    df['volatility_past_year'] = round(df['log_return'].rolling(window=252).std() * np.sqrt(252),4)
-    
+
+    # The single-symbol history goes through the same engine used for multi-symbol panels.
+    panel = build_price_panel(pd.DataFrame({
+        'symbol': symbol.lower(), 'date': df['Date'], 'high': df['High'], 'low': df['Low'], 'close': df['adjusted_close']
+    }))
+    df = pd.concat([df, format_indicator_columns(compute_price_indicators(panel))], axis=1)
+
     final_cols = ['Date', 'Open', 'High', 'Low', 'Close', 'adjusted_close', 'change', 'Volume', 'dollar_volume', 'volatility_past_year']
-    return df[final_cols]
+    return df[final_cols + [col for col, _ in INDICATOR_TABLE_COLUMNS]]
 
-def process_stock_worker(stock_info: dict, rate_limiter: RateLimiter):
-    """Worker function to fetch data for a single stock."""
+def fetch_grouped_daily_polygon(trade_date, api_key) -> pd.DataFrame:
+    """Fetches one day of bars for every US ticker in a single Polygon call (used by the daily update)."""
+    url = f"https://api.polygon.io/v2/aggs/grouped/locale/us/market/stocks/{trade_date}"
+    try:
+        response = requests.get(url, params={"adjusted": "true", "apiKey": api_key})
+        response.raise_for_status()
+        results = response.json().get('results')
+    except requests.exceptions.RequestException as e:
+        logging.error(f"Network error fetching grouped daily bars for {trade_date}: {e}")
+        return None
+    if not results: return pd.DataFrame()
+    df = pd.DataFrame(results).rename(columns={'T': 'symbol', 'o': 'open', 'h': 'high', 'l': 'low', 'c': 'close', 'v': 'volume'})
+    df['symbol'] = df['symbol'].str.lower()
+    df['date'] = pd.to_datetime(df['t'], unit='ms').dt.date
+    return df[['symbol', 'date', 'open', 'high', 'low', 'close', 'volume']]
+
+def process_stock_worker(stock_info: dict, rate_limiter: RateLimiter, write_queue: queue.Queue):
+    """
+    Worker function to fetch data for a single stock and hand it to the writers.
+    Blocks on the write queue when the writers are behind, which throttles fetching.
+    """
     symbol = stock_info['symbol']
     logging.info(f"WORKER: Starting processing for {symbol}")
     try:
@@ -169,27 +249,533 @@ def process_stock_worker(stock_info: dict, rate_limiter: RateLimiter):
         df = fetch_historical_data_polygon(symbol.upper(), POLYGON_API_KEY)
         if df is not None and not df.empty:
             logging.info(f"WORKER: Successfully fetched {len(df)} records for {symbol}")
-            return stock_info, df
+            price_df = build_price_frame(stock_info, df).drop_duplicates(subset=['date'], keep='last')
+            if PARQUET_STAGING_DIR:
+                # Drop the symbol's whole partition first so years that slid out of the fetch window go too.
+                dataset_dir = os.path.join(PARQUET_STAGING_DIR, "stock_price")
+                shutil.rmtree(os.path.join(dataset_dir, f"symbol={price_df['symbol'].iloc[0]}"), ignore_errors=True)
+                write_parquet_dataset(price_df.assign(year=pd.to_datetime(price_df['date']).dt.year),
+                                      dataset_dir, ['symbol', 'year'],
+                                      PRICE_PARQUET_COLUMNS, METADATA_COLUMNS)
+            write_queue.put((symbol, price_df))
+            return symbol, len(price_df)
         else:
             logging.warning(f"WORKER: No data returned for {symbol}")
-            return stock_info, None
+            return symbol, 0
     except Exception as e:
         logging.error(f"WORKER: Unhandled exception for {symbol}: {e}")
-        return stock_info, None
+        return symbol, 0
+
+# ==============================================================================
+# STAGE 2B: VECTORIZED TECHNICAL INDICATOR ENGINE
+# ==============================================================================
+
+def build_price_panel(price_df: pd.DataFrame) -> pd.DataFrame:
+    """
+    Normalizes long price rows (symbol, date, high, low, close) for any number of symbols into the
+    stacked panel the indicator engine works on: sorted by (symbol, date), one row per observation.
+    """
+    panel = price_df[['symbol', 'date', 'high', 'low', 'close']].copy()
+    panel['date'] = pd.to_datetime(panel['date'])
+    for col in ['high', 'low', 'close']:
+        panel[col] = pd.to_numeric(panel[col], errors='coerce').astype('float64')
+    panel = panel.dropna(subset=['close']).drop_duplicates(subset=['symbol', 'date'], keep='last')
+    return panel.sort_values(['symbol', 'date'], kind='mergesort').reset_index(drop=True)
+
+def compute_price_indicators(panel: pd.DataFrame) -> pd.DataFrame:
+    """
+    Computes every indicator for every symbol of a stacked panel with grouped, vectorized operations
+    (no per-symbol Python loop). Windows count a symbol's own observations, which is exactly what
+    IndicatorState reproduces incrementally.
+    """
+    symbols = panel['symbol']
+    close, high, low = panel['close'], panel['high'], panel['low']
+    by_symbol = close.groupby(symbols, sort=False)
+
+    def grouped_rolling(series, window, func):
+        rolled = getattr(series.groupby(symbols, sort=False).rolling(window, min_periods=window), func)()
+        return rolled.reset_index(level=0, drop=True).sort_index()
+
+    def grouped_ewm(series, **kwargs):
+        smoothed = series.groupby(symbols, sort=False).ewm(adjust=False, ignore_na=True, **kwargs).mean()
+        return smoothed.reset_index(level=0, drop=True).sort_index()
+
+    prev_close = by_symbol.shift(1)
+    indicators = pd.DataFrame({'symbol': symbols, 'date': panel['date']})
+    indicators['return'] = close / prev_close - 1
+    indicators['log_return'] = np.log(close / prev_close)
+
+    for window in VOLATILITY_WINDOWS:
+        indicators[f'volatility_{window}d'] = grouped_rolling(indicators['log_return'], window, 'std') * np.sqrt(TRADING_DAYS_PER_YEAR)
+    for window in MOVING_AVERAGE_WINDOWS:
+        indicators[f'sma_{window}'] = grouped_rolling(close, window, 'mean')
+        indicators[f'ema_{window}'] = grouped_ewm(close, span=window, min_periods=window)
+
+    true_range = np.fmax(high - low, np.fmax((high - prev_close).abs(), (low - prev_close).abs()))
+    indicators[f'atr_{ATR_WINDOW}'] = grouped_ewm(true_range, alpha=1 / ATR_WINDOW, min_periods=ATR_WINDOW)
+
+    indicators['drawdown'] = close / by_symbol.cummax() - 1
+    indicators['max_drawdown'] = indicators['drawdown'].groupby(symbols, sort=False).cummin()
+    return indicators
+
+def format_indicator_columns(indicators: pd.DataFrame) -> pd.DataFrame:
+    """Maps engine output onto the price table's indicator columns, with the table's rounding."""
+    formatted = pd.DataFrame(index=indicators.index)
+    formatted['change'] = round(indicators['return'] * 100, 3)
+    formatted['volatility_past_year'] = round(indicators[f'volatility_{TRADING_DAYS_PER_YEAR}d'], 4)
+    for col, _ in INDICATOR_TABLE_COLUMNS:
+        formatted[col] = round(indicators[col], 4)
+    return formatted.reset_index(drop=True)
+
+class IndicatorState:
+    """
+    Rolling indicator state for a fixed set of symbols, so appending one trading day costs O(symbols).
+    Windowed metrics keep a ring buffer with running sums; EMAs, ATR and drawdowns keep their last value.
+    """
+    def __init__(self, symbols):
+        self.symbols = np.asarray(symbols, dtype=object)
+        self.index = {symbol: i for i, symbol in enumerate(self.symbols)}
+        n = len(self.symbols)
+        self.last_date = np.full(n, np.datetime64('NaT'), dtype='datetime64[D]')
+        self.last_close = np.full(n, np.nan)
+        self.peak = np.full(n, np.nan)
+        self.max_drawdown = np.full(n, np.nan)
+        self.windows = {f'volatility_{w}d': self._new_window(n, w) for w in VOLATILITY_WINDOWS}
+        self.windows.update({f'sma_{w}': self._new_window(n, w) for w in MOVING_AVERAGE_WINDOWS})
+        self.smoothers = {f'ema_{w}': self._new_smoother(n, 2 / (w + 1), w) for w in MOVING_AVERAGE_WINDOWS}
+        self.smoothers[f'atr_{ATR_WINDOW}'] = self._new_smoother(n, 1 / ATR_WINDOW, ATR_WINDOW)
+
+    @staticmethod
+    def _new_window(n, window):
+        return {'buffer': np.zeros((n, window)), 'pos': np.zeros(n, dtype=np.int64),
+                'count': np.zeros(n, dtype=np.int64), 'sum': np.zeros(n), 'sumsq': np.zeros(n)}
+
+    @staticmethod
+    def _new_smoother(n, alpha, min_periods):
+        return {'value': np.full(n, np.nan), 'count': np.zeros(n, dtype=np.int64),
+                'alpha': alpha, 'min_periods': min_periods}
+
+    @staticmethod
+    def _push_window(state, rows, values):
+        """Pushes one value per selected symbol into its ring buffer and updates the running sums."""
+        window = state['buffer'].shape[1]
+        pos = state['pos'][rows]
+        evicted = np.where(state['count'][rows] >= window, state['buffer'][rows, pos], 0.0)
+        state['buffer'][rows, pos] = values
+        state['sum'][rows] += values - evicted
+        state['sumsq'][rows] += values ** 2 - evicted ** 2
+        state['pos'][rows] = (pos + 1) % window
+        state['count'][rows] = np.minimum(state['count'][rows] + 1, window)
+
+    @staticmethod
+    def _push_smoother(state, rows, values):
+        current = state['value'][rows]
+        state['value'][rows] = np.where(np.isnan(current), values, current + state['alpha'] * (values - current))
+        state['count'][rows] += 1
+
+    def _advance(self, rows, dates, close, high, low):
+        """Applies one observation per selected symbol and returns the resulting indicator columns."""
+        prev_close = self.last_close[rows]
+        result = {'return': close / prev_close - 1}
+        with np.errstate(divide='ignore', invalid='ignore'):
+            log_return = np.log(close / prev_close)
+        result['log_return'] = log_return
+
+        for window in VOLATILITY_WINDOWS:
+            state = self.windows[f'volatility_{window}d']
+            valid = np.isfinite(log_return)
+            self._push_window(state, rows[valid], log_return[valid])
+            count, total, total_sq = state['count'][rows], state['sum'][rows], state['sumsq'][rows]
+            variance = np.maximum((total_sq - total ** 2 / window) / (window - 1), 0.0)
+            result[f'volatility_{window}d'] = np.where(count >= window, np.sqrt(variance * TRADING_DAYS_PER_YEAR), np.nan)
+
+        true_range = np.fmax(high - low, np.fmax(np.abs(high - prev_close), np.abs(low - prev_close)))
+        for name, state in self.smoothers.items():
+            values = true_range if name.startswith('atr') else close
+            valid = np.isfinite(values)
+            self._push_smoother(state, rows[valid], values[valid])
+            result[name] = np.where(state['count'][rows] >= state['min_periods'], state['value'][rows], np.nan)
+
+        for window in MOVING_AVERAGE_WINDOWS:
+            state = self.windows[f'sma_{window}']
+            self._push_window(state, rows, close)
+            result[f'sma_{window}'] = np.where(state['count'][rows] >= window, state['sum'][rows] / window, np.nan)
+
+        self.peak[rows] = np.fmax(self.peak[rows], close)
+        result['drawdown'] = close / self.peak[rows] - 1
+        self.max_drawdown[rows] = np.fmin(self.max_drawdown[rows], result['drawdown'])
+        result['max_drawdown'] = self.max_drawdown[rows]
+
+        self.last_close[rows] = close
+        self.last_date[rows] = dates
+        return result
+
+    @classmethod
+    def from_panel(cls, panel: pd.DataFrame):
+        """Seeds the state by replaying a full-history panel one trading day at a time."""
+        state = cls(panel['symbol'].unique())
+        rows = panel['symbol'].map(state.index).to_numpy()
+        dates = panel['date'].to_numpy().astype('datetime64[D]')
+        close, high, low = (panel[col].to_numpy(dtype='float64') for col in ['close', 'high', 'low'])
+        order = np.lexsort((rows, dates))
+        boundaries = np.flatnonzero(np.diff(dates[order])) + 1
+        for day in np.split(order, boundaries):
+            state._advance(rows[day], dates[day], close[day], high[day], low[day])
+        return state
+
+    def update(self, day_bars: pd.DataFrame) -> pd.DataFrame:
+        """
+        Appends one trading day of bars (symbol, date, high, low, close) and returns the indicator rows
+        for those symbols. Symbols without seeded history, or already at or past that date, are skipped.
+        """
+        bars = build_price_panel(day_bars)
+        rows = bars['symbol'].map(self.index)
+        known = rows.notna().to_numpy()
+        if not known.all():
+            logging.warning(f"Skipping {int((~known).sum())} symbols with no seeded indicator history.")
+        bars, rows = bars[known], rows[known].to_numpy(dtype=np.int64)
+        dates = bars['date'].to_numpy().astype('datetime64[D]')
+        fresh = np.isnat(self.last_date[rows]) | (dates > self.last_date[rows])
+        bars, rows, dates = bars[fresh], rows[fresh], dates[fresh]
+
+        result = self._advance(rows, dates, *(bars[col].to_numpy(dtype='float64') for col in ['close', 'high', 'low']))
+        indicators = pd.DataFrame({'symbol': bars['symbol'].to_numpy(), 'date': bars['date'].to_numpy()})
+        for name, values in result.items():
+            indicators[name] = values
+        return indicators
+
+    def save(self, path):
+        """Persists the state as a single .npz file. Running sums are re-derived from the buffers to shed drift."""
+        arrays = {'symbols': self.symbols.astype(str), 'last_date': self.last_date, 'last_close': self.last_close,
+                  'peak': self.peak, 'max_drawdown': self.max_drawdown}
+        for name, state in self.windows.items():
+            state['sum'] = state['buffer'].sum(axis=1)
+            state['sumsq'] = (state['buffer'] ** 2).sum(axis=1)
+            for key in ['buffer', 'pos', 'count']:
+                arrays[f'{name}__{key}'] = state[key]
+        for name, state in self.smoothers.items():
+            arrays[f'{name}__value'] = state['value']
+            arrays[f'{name}__count'] = state['count']
+        np.savez_compressed(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        """Loads a state saved by save(); raises ValueError if the configured windows have changed since."""
+        with np.load(path, allow_pickle=False) as data:
+            state = cls(data['symbols'].tolist())
+            for key in ['last_date', 'last_close', 'peak', 'max_drawdown']:
+                setattr(state, key, data[key])
+            for name, window_state in state.windows.items():
+                if f'{name}__buffer' not in data or data[f'{name}__buffer'].shape != window_state['buffer'].shape:
+                    raise ValueError(f"Indicator state at {path} does not match the configured window for {name}.")
+                for key in ['buffer', 'pos', 'count']:
+                    window_state[key] = data[f'{name}__{key}']
+                window_state['sum'] = window_state['buffer'].sum(axis=1)
+                window_state['sumsq'] = (window_state['buffer'] ** 2).sum(axis=1)
+            for name, smoother in state.smoothers.items():
+                if f'{name}__value' not in data:
+                    raise ValueError(f"Indicator state at {path} has no saved value for {name}.")
+                smoother['value'] = data[f'{name}__value']
+                smoother['count'] = data[f'{name}__count']
+        return state
+
+# ==============================================================================
+# STAGE 3: DATABASE LOADING HELPERS
+# ==============================================================================
+
+def serialize_for_copy(df, table_columns):
+    """
+    Converts a DataFrame into a tab-delimited COPY buffer one column at a time.
+    Each column is formatted and NULL-masked as a whole array in table-schema order; rows are
+    only touched once at the end, when the pre-formatted fields are joined into lines.
+    """
+    buffer = io.StringIO()
+    if df.empty:
+        return buffer
+
+    encoded_columns = []
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'INTEGER', 'BIGINT', 'SMALLINT', 'DOUBLE PRECISION'):
+            numeric = pd.to_numeric(series, errors='coerce').to_numpy(dtype='float64', na_value=np.nan)
+            null_mask = ~np.isfinite(numeric)
+            if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+                values = np.where(null_mask, 0.0, numeric).tolist()
+            else:
+                values = np.where(null_mask, 0, np.round(numeric)).astype('int64').tolist()
+            text = np.array(list(map(str, values)), dtype=object)
+        elif pg_type == 'DATE':
+            dates = pd.to_datetime(series, errors='coerce')
+            null_mask = dates.isna().to_numpy()
+            text = dates.dt.strftime('%Y-%m-%d').to_numpy(dtype=object)
+        else:
+            null_mask = series.isna().to_numpy()
+            text = (series.astype(str)
+                    .str.replace('\\', '\\\\', regex=False)
+                    .str.replace('\t', '\\t', regex=False)
+                    .str.replace('\n', '\\n', regex=False)
+                    .str.replace('\r', '\\r', regex=False)
+                    .to_numpy(dtype=object))
+        text[null_mask] = '\\N'
+        encoded_columns.append(text)
+
+    buffer.write('\n'.join(map('\t'.join, zip(*encoded_columns))))
+    buffer.write('\n')
+    buffer.seek(0)
+    return buffer
+
+
+def copy_dataframe(cursor, df, table_name):
+    """Bulk-loads a DataFrame into the price fact table with COPY, using the fact schema for column order."""
+    column_list = ", ".join(col for col, _ in PRICE_FACT_COLUMNS)
+    cursor.copy_expert(f"COPY {table_name} ({column_list}) FROM STDIN;", serialize_for_copy(df, PRICE_FACT_COLUMNS))
+
+def ensure_dim_company_table(cursor):
+    cursor.execute(f"""
+        CREATE TABLE IF NOT EXISTS {DIM_COMPANY_TABLE} (
+            symbol_id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+            symbol TEXT NOT NULL UNIQUE CHECK (symbol = lower(symbol)),
+            {", ".join(f"{col} TEXT" for col in METADATA_COLUMNS)},
+            updated_at TIMESTAMP NOT NULL DEFAULT now()
+        );
+    """)
+
+def upsert_companies(cursor, companies_df: pd.DataFrame) -> dict:
+    """
+    Adds new symbols to the company dimension and refreshes the attributes of known ones (a missing
+    attribute never overwrites a known one). Returns {symbol: symbol_id} for every symbol in companies_df.
+    """
+    ensure_dim_company_table(cursor)
+    companies = companies_df.assign(symbol=companies_df['symbol'].str.lower()).drop_duplicates(subset=['symbol']).sort_values('symbol')
+    columns = [col for col, _ in COMPANY_COLUMNS]
+    arrays = [
+        [None if pd.isna(value) else str(value) for value in companies[col]] if col in companies.columns else [None] * len(companies)
+        for col in columns
+    ]
+    cursor.execute(f"""
+        INSERT INTO {DIM_COMPANY_TABLE} AS d ({", ".join(columns)})
+        SELECT * FROM unnest({", ".join(["%s::text[]"] * len(columns))})
+        ON CONFLICT (symbol) DO UPDATE SET
+            {", ".join(f"{col} = COALESCE(EXCLUDED.{col}, d.{col})" for col in METADATA_COLUMNS)},
+            updated_at = now()
+        WHERE ({", ".join(f"d.{col}" for col in METADATA_COLUMNS)})
+              IS DISTINCT FROM ({", ".join(f"COALESCE(EXCLUDED.{col}, d.{col})" for col in METADATA_COLUMNS)});
+    """, arrays)
+    cursor.execute(f"SELECT symbol, symbol_id FROM {DIM_COMPANY_TABLE} WHERE symbol = ANY(%s);", (arrays[0],))
+    return dict(cursor.fetchall())
+
+def attach_symbol_ids(cursor, df: pd.DataFrame) -> pd.DataFrame:
+    """Resolves the symbol_id of every row through the company dimension, registering new companies first."""
+    symbol_ids = upsert_companies(cursor, df[[col for col in df.columns if col in dict(COMPANY_COLUMNS)]])
+    return df.assign(symbol_id=df['symbol'].str.lower().map(symbol_ids))
+
+def create_price_compatibility_view(cursor, view_name, fact_table_name):
+    """Recreates the original wide price layout (company attributes on every row) as a view over the fact table."""
+    select_list = ", ".join(f"d.{col}" if col in dict(COMPANY_COLUMNS) else f"f.{col}" for col, _ in PRICE_TABLE_COLUMNS)
+    cursor.execute(f"""
+        CREATE VIEW {view_name} AS
+        SELECT {select_list}
+        FROM {fact_table_name} f
+        JOIN {DIM_COMPANY_TABLE} d ON d.symbol_id = f.symbol_id;
+    """)
+
+def drop_table_or_view(cursor, relation_name):
+    """Drops a relation that may be a table (before the company dimension) or a view (after it)."""
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s);", (relation_name,))
+    existing = cursor.fetchone()
+    if existing:
+        kind = 'VIEW' if existing[0] == 'v' else 'TABLE'
+        cursor.execute(f"DROP {kind} {relation_name} CASCADE;")
+
+def create_monthly_summary_view(cursor, mv_name, fact_table_name):
+    """Monthly per-symbol summary, grouped on the integer symbol_id before the company attributes are joined on."""
+    cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {mv_name};")
+    cursor.execute(f"""
+        CREATE MATERIALIZED VIEW {mv_name} AS
+        SELECT
+            d.symbol, d.company_name, d.sector, d.industry, d.market_cap_group, d.country,
+            m.month_start_date, m.average_adjusted_close, m.average_volume, m.average_dollar_volume,
+            m.monthly_high_low_range_volatility
+        FROM (
+            SELECT
+                symbol_id,
+                DATE_TRUNC('month', date) AS month_start_date,
+                AVG(adjusted_close) AS average_adjusted_close,
+                AVG(volume) AS average_volume,
+                AVG(dollar_volume) AS average_dollar_volume,
+                (MAX(high) - MIN(low)) AS monthly_high_low_range_volatility
+            FROM {fact_table_name}
+            GROUP BY symbol_id, DATE_TRUNC('month', date)
+        ) m
+        JOIN {DIM_COMPANY_TABLE} d ON d.symbol_id = m.symbol_id
+        ORDER BY d.symbol ASC, m.month_start_date DESC;
+    """)
+
+def build_price_frame(stock_info: dict, df_historical: pd.DataFrame) -> pd.DataFrame:
+    """Attaches the company metadata to a symbol's price history, using the table's column names."""
+    df = df_historical.rename(columns=PRICE_COLUMN_RENAME_MAP)
+    df['symbol'] = stock_info['symbol'].lower()
+    for col in METADATA_COLUMNS:
+        df[col] = stock_info.get(col)
+    return df
+
+def create_symbol_view(cursor, symbol, agg_table_name):
+    """
+    Exposes a symbol's rows as a view over the aggregate table, so each price row is stored once.
+    Per-symbol tables left behind by earlier runs are dropped first.
+    """
+    view_name = symbol.lower()
+    cursor.execute("""
+        SELECT c.relkind FROM pg_class c
+        JOIN pg_namespace n ON n.oid = c.relnamespace
+        WHERE n.nspname = %s AND c.relname = %s;
+    """, (SCHEMA_NAME, view_name))
+    existing = cursor.fetchone()
+    if existing and existing[0] == 'r':
+        cursor.execute(f'DROP TABLE "{SCHEMA_NAME}"."{view_name}";')
+    cursor.execute(
+        f'CREATE OR REPLACE VIEW "{SCHEMA_NAME}"."{view_name}" AS SELECT * FROM {agg_table_name} WHERE symbol = %s;',
+        (view_name,)
+    )
+
+def flush_price_batch(conn, frames, fact_table_name, agg_table_name):
+    """
+    Writes a batch of per-symbol frames to the fact table with a single COPY, after resolving their
+    symbol_ids through the company dimension. Returns rows written.
+    """
+    symbols = [symbol for symbol, _ in frames]
+    try:
+        batch_df = pd.concat([df for _, df in frames], ignore_index=True)
+        with conn.cursor() as cursor:
+            batch_df = attach_symbol_ids(cursor, batch_df)
+            copy_dataframe(cursor, batch_df, fact_table_name)
+            for symbol in symbols:
+                create_symbol_view(cursor, symbol, agg_table_name)
+        conn.commit()
+        logging.info(f"WRITER: Copied {len(batch_df)} records for {len(symbols)} symbols into {fact_table_name}.")
+        return len(batch_df)
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"WRITER: Database error while writing batch {symbols}: {e}", exc_info=True)
+        return 0
+
+def price_writer(conn, write_queue: queue.Queue, fact_table_name, agg_table_name):
+    """
+    Consumer loop for one writer thread and its dedicated connection. Drains the queue into batches of
+    up to WRITE_BATCH_MAX_ROWS, flushing early if the queue goes quiet, and stops on the None sentinel.
+    A failed batch is logged and dropped; the loop keeps draining the queue so fetchers never block on put.
+    """
+    frames, pending_rows, rows_written = [], 0, 0
+
+    def flush():
+        nonlocal frames, pending_rows, rows_written
+        try:
+            rows_written += flush_price_batch(conn, frames, fact_table_name, agg_table_name)
+        except Exception as e:
+            logging.error(f"WRITER: Dropped a batch of {len(frames)} symbols after an unexpected error: {e}", exc_info=True)
+        frames, pending_rows = [], 0
+
+    while True:
+        try:
+            item = write_queue.get(timeout=WRITE_BATCH_FLUSH_SECONDS)
+        except queue.Empty:
+            if frames:
+                flush()
+            continue
+
+        if item is None:
+            break
+        frames.append(item)
+        pending_rows += len(item[1])
+        if pending_rows >= WRITE_BATCH_MAX_ROWS:
+            flush()
+
+    if frames:
+        flush()
+    return rows_written
+
+# ==============================================================================
+# STAGE 3B: PARQUET STAGING
+# ==============================================================================
+
+def conform_to_table_schema(df, table_columns):
+    """Selects the table's columns in schema order and coerces each one to the type it will have in Postgres."""
+    conformed = pd.DataFrame(index=df.index)
+    for col, pg_type in table_columns:
+        series = df[col] if col in df.columns else pd.Series(None, index=df.index, dtype=object)
+        if pg_type in ('NUMERIC', 'DOUBLE PRECISION'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').astype('float64')
+        elif pg_type in ('INTEGER', 'BIGINT', 'SMALLINT'):
+            conformed[col] = pd.to_numeric(series, errors='coerce').round().astype('Int64')
+        elif pg_type == 'DATE':
+            conformed[col] = pd.to_datetime(series, errors='coerce')
+        else:
+            conformed[col] = series.astype(object).where(series.notna(), None).map(lambda v: v if v is None else str(v))
+    return conformed.reset_index(drop=True)
+
+def write_parquet_dataset(df, dataset_dir, partition_cols, table_columns, dictionary_cols=()):
+    """
+    Writes rows to a hive-partitioned Parquet dataset, replacing only the partitions present in df.
+    Columns in dictionary_cols are stored dictionary-encoded and read back as pandas categoricals.
+    """
+    if pa is None:
+        logging.warning("pyarrow is not installed; skipping Parquet staging.")
+        return
+    staged_df = conform_to_table_schema(df, table_columns)
+    for col in dictionary_cols:
+        staged_df[col] = staged_df[col].astype('category')
+    ds.write_dataset(
+        pa.Table.from_pandas(staged_df, preserve_index=False), dataset_dir, format='parquet',
+        partitioning=partition_cols, partitioning_flavor='hive',
+        existing_data_behavior='delete_matching', basename_template='part-{i}.parquet'
+    )
+
+def read_parquet_dataset(dataset_dir, partition_cols, filter_expression=None, columns=None):
+    """Reads a hive-partitioned Parquet dataset (optionally filtered and column-pruned) into a DataFrame."""
+    partitioning = ds.partitioning(pa.schema([(col, pa.string()) for col in partition_cols]), flavor='hive')
+    dataset = ds.dataset(dataset_dir, format='parquet', partitioning=partitioning)
+    return dataset.to_table(columns=columns, filter=filter_expression).to_pandas()
+
+def enqueue_staged_prices(dataset_dir, write_queue: queue.Queue):
+    """Producer used instead of the Polygon fetchers: feeds each staged symbol's history to the writers."""
+    df = read_parquet_dataset(dataset_dir, ['symbol', 'year'], filter_expression=ds.field('sector') == SECTOR_TO_PROCESS)
+    if df.empty:
+        logging.warning(f"No staged prices found for sector '{SECTOR_TO_PROCESS}' in {dataset_dir}.")
+        return
+    df = df.drop(columns=['year'])
+    for symbol, price_df in df.groupby('symbol', sort=True):
+        write_queue.put((symbol, price_df.reset_index(drop=True)))
+    logging.info(f"Queued {df['symbol'].nunique()} staged symbols from {dataset_dir}.")
+
+def seed_indicator_state(cursor, agg_table_name):
+    """Rebuilds the incremental indicator state from the full history in the aggregate table and saves it."""
+    cursor.execute(f"SELECT symbol, date, high, low, close FROM {agg_table_name};")
+    history = pd.DataFrame(cursor.fetchall(), columns=['symbol', 'date', 'high', 'low', 'close'])
+    if history.empty:
+        logging.warning("No price history available; indicator state not saved.")
+        return
+    state = IndicatorState.from_panel(build_price_panel(history))
+    state.save(INDICATOR_STATE_PATH)
+    logging.info(f"Indicator state for {len(state.symbols)} symbols saved to {INDICATOR_STATE_PATH}.")
 
 # ==============================================================================
-# STAGE 3: MAIN EXECUTION AND DATABASE INTEGRATION
+# STAGE 4: MAIN EXECUTION AND DATABASE INTEGRATION
 # ==============================================================================
 
 
 def main():
     """Main execution block."""
-    companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
-    if companies_df.empty:
-        logging.error(f"No companies found for sector '{SECTOR_TO_PROCESS}'. Exiting.")
+    if RELOAD_FROM_PARQUET and not (PARQUET_STAGING_DIR and ds is not None):
+        logging.error("RELOAD_FROM_PARQUET needs PARQUET_STAGING_DIR to be set and pyarrow to be installed.")
         return
-    companies_to_process = companies_df.to_dict('records')
-    logging.info(f"Found {len(companies_to_process)} companies to process.")
+    companies_to_process = []
+    if not RELOAD_FROM_PARQUET:
+        companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
+        if companies_df.empty:
+            logging.error(f"No companies found for sector '{SECTOR_TO_PROCESS}'. Exiting.")
+            return
+        companies_to_process = companies_df.to_dict('records')
+        logging.info(f"Found {len(companies_to_process)} companies to process.")
 
     conn = None
     cursor = None
@@ -199,103 +785,54 @@ def main():
 
         cursor.execute(f"CREATE SCHEMA IF NOT EXISTS {SCHEMA_NAME};")
         
+        # The fact table holds symbol_id and the price columns; the original table name is now a view adding
+        # the company attributes back, so readers and the per-symbol views see the same columns as before.
         agg_table_name = f'public."aggregate_table_{SCHEMA_NAME}"'
-        cursor.execute(f"DROP TABLE IF EXISTS {agg_table_name} CASCADE;")
-        
-        cursor.execute(f"""
-            CREATE TABLE {agg_table_name} (
-                symbol TEXT NOT NULL, company_name TEXT, sector TEXT, industry TEXT, market_cap_group TEXT,
-                country TEXT, analyst_rating TEXT, ma50_vs_200d TEXT, date DATE NOT NULL,
-                open NUMERIC, high NUMERIC, low NUMERIC, close NUMERIC, change NUMERIC, 
-                volume NUMERIC, adjusted_close NUMERIC, dollar_volume NUMERIC, volatility_past_year NUMERIC,
-                PRIMARY KEY (symbol, date)
-            );
-        """)
+        fact_table_name = f'public."aggregate_fact_{SCHEMA_NAME}"'
+        drop_table_or_view(cursor, agg_table_name)
+        cursor.execute(f"DROP TABLE IF EXISTS {fact_table_name} CASCADE;")
+
+        column_defs = ", ".join(f"{col} {pg_type}" for col, pg_type in PRICE_FACT_COLUMNS)
+        cursor.execute(f"CREATE TABLE {fact_table_name} ({column_defs}, PRIMARY KEY (symbol_id, date));")
+        ensure_dim_company_table(cursor)
+        create_price_compatibility_view(cursor, agg_table_name, fact_table_name)
         conn.commit()
-        logging.info(f"Database schema '{SCHEMA_NAME}' and table '{agg_table_name}' are ready.")
+        logging.info(f"Database schema '{SCHEMA_NAME}', table '{fact_table_name}' and view '{agg_table_name}' are ready.")
 
         rate_limiter = RateLimiter(POLYGON_API_REQUESTS_PER_SECOND)
-        with concurrent.futures.ThreadPoolExecutor(max_workers=POLYGON_MAX_WORKERS) as executor:
-            futures = [executor.submit(process_stock_worker, company, rate_limiter) for company in companies_to_process]
-            
-            for i, future in enumerate(concurrent.futures.as_completed(futures)):
-                stock_info, df_historical = future.result()
-                symbol = stock_info['symbol']
-                logging.info(f"Processing result for {symbol} ({i+1}/{len(companies_to_process)})")
-
-                if df_historical is not None and not df_historical.empty:
-                    ind_table_name = f'"{SCHEMA_NAME}"."{symbol.lower()}"'
-                    cursor.execute(f"DROP TABLE IF EXISTS {ind_table_name};")
-                    cursor.execute(f"""
-                        CREATE TABLE {ind_table_name} (
-                            symbol TEXT, company_name TEXT, sector TEXT, industry TEXT, market_cap_group TEXT,
-                            country TEXT, analyst_rating TEXT, ma50_vs_200d TEXT, date DATE,
-                            open NUMERIC, high NUMERIC, low NUMERIC, close NUMERIC, adjusted_close NUMERIC,
-                            change NUMERIC, volume NUMERIC, dollar_volume NUMERIC, volatility_past_year NUMERIC,
-                            PRIMARY KEY (symbol, date)
-                        );
-                    """)
-
-                    # --- THE DEFINITIVE FIX IS HERE ---
-                    # Explicitly convert all potential NaN values to None before insertion.
-                    records = [(
-                        None if pd.isna(stock_info.get('symbol')) else stock_info.get('symbol').lower(),
-                        None if pd.isna(stock_info.get('company_name')) else stock_info.get('company_name'),
-                        None if pd.isna(stock_info.get('sector')) else stock_info.get('sector'),
-                        None if pd.isna(stock_info.get('industry')) else stock_info.get('industry'),
-                        None if pd.isna(stock_info.get('market_cap_group')) else stock_info.get('market_cap_group'),
-                        None if pd.isna(stock_info.get('country')) else stock_info.get('country'),
-                        None if pd.isna(stock_info.get('analyst_rating')) else stock_info.get('analyst_rating'),
-                        None if pd.isna(stock_info.get('ma50_vs_200d')) else stock_info.get('ma50_vs_200d'),
-                        row['Date'],
-                        None if pd.isna(row.get('Open')) else row.get('Open'),
-                        None if pd.isna(row.get('High')) else row.get('High'),
-                        None if pd.isna(row.get('Low')) else row.get('Low'),
-                        None if pd.isna(row.get('Close')) else row.get('Close'),
-                        None if pd.isna(row.get('adjusted_close')) else row.get('adjusted_close'),
-                        None if pd.isna(row.get('change')) else row.get('change'),
-                        None if pd.isna(row.get('Volume')) else row.get('Volume'),
-                        None if pd.isna(row.get('dollar_volume')) else row.get('dollar_volume'),
-                        None if pd.isna(row.get('volatility_past_year')) else row.get('volatility_past_year')
-                    ) for _, row in df_historical.iterrows()]
-
-                    try:
-                        cols = [
-                            'symbol', 'company_name', 'sector', 'industry', 'market_cap_group', 'country', 
-                            'analyst_rating', 'ma50_vs_200d', 'date', 'open', 'high', 'low', 'close', 
-                            'adjusted_close', 'change', 'volume', 'dollar_volume', 'volatility_past_year'
-                        ]
-                        insert_cols_str = ", ".join(cols)
-                        update_cols_str = ", ".join([f"{col} = EXCLUDED.{col}" for col in cols if col not in ['symbol', 'date']])
-                        
-                        insert_query = f"INSERT INTO {ind_table_name} ({insert_cols_str}) VALUES %s ON CONFLICT (symbol, date) DO UPDATE SET {update_cols_str};"
-                        psycopg2.extras.execute_values(cursor, insert_query, records, page_size=250)
-
-                        agg_insert_query = f"INSERT INTO {agg_table_name} ({insert_cols_str}) VALUES %s ON CONFLICT (symbol, date) DO UPDATE SET {update_cols_str};"
-                        psycopg2.extras.execute_values(cursor, agg_insert_query, records, page_size=250)
-                        
-                        conn.commit()
-                        logging.info(f"Successfully upserted {len(records)} records for {symbol}.")
-                    except Exception as e:
-                        logging.error(f"Database error during upsert for {symbol}: {e}", exc_info=True)
-                        conn.rollback()
-        
+        write_queue = queue.Queue(maxsize=WRITE_QUEUE_MAX_FRAMES)
+        connection_pool = pool.ThreadedConnectionPool(WRITER_THREADS, WRITER_THREADS, **DB_PARAMS)
+        # Writer connections are checked out up front so a connection failure surfaces before any fetching starts.
+        writer_conns = [connection_pool.getconn() for _ in range(WRITER_THREADS)]
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=WRITER_THREADS, thread_name_prefix="writer") as writer_executor:
+                writer_futures = [
+                    writer_executor.submit(price_writer, writer_conn, write_queue, fact_table_name, agg_table_name)
+                    for writer_conn in writer_conns
+                ]
+                if RELOAD_FROM_PARQUET:
+                    enqueue_staged_prices(os.path.join(PARQUET_STAGING_DIR, "stock_price"), write_queue)
+                else:
+                    with concurrent.futures.ThreadPoolExecutor(max_workers=POLYGON_MAX_WORKERS) as executor:
+                        futures = [executor.submit(process_stock_worker, company, rate_limiter, write_queue) for company in companies_to_process]
+                        for i, future in enumerate(concurrent.futures.as_completed(futures)):
+                            symbol, record_count = future.result()
+                            logging.info(f"Fetched {symbol} ({i+1}/{len(companies_to_process)}): {record_count} records queued for writing.")
+
+                # All fetchers are done; one sentinel per writer lets each flush its last batch and exit.
+                for _ in range(WRITER_THREADS):
+                    write_queue.put(None)
+                total_rows_written = sum(future.result() for future in writer_futures)
+        finally:
+            for writer_conn in writer_conns:
+                connection_pool.putconn(writer_conn)
+            connection_pool.closeall()
+        logging.info(f"Writers finished: {total_rows_written} records written to {fact_table_name}.")
+        seed_indicator_state(cursor, agg_table_name)
+
         mv_name = f'public.monthly_{SCHEMA_NAME}_summary'
         logging.info(f"Refreshing Materialized View: {mv_name}...")
-        cursor.execute(f"DROP MATERIALIZED VIEW IF EXISTS {mv_name};")
-        cursor.execute(f"""
-            CREATE MATERIALIZED VIEW {mv_name} AS
-            SELECT
-                symbol, company_name, sector, industry, market_cap_group, country,
-                DATE_TRUNC('month', date) AS month_start_date,
-                AVG(adjusted_close) AS average_adjusted_close,
-                AVG(volume) AS average_volume,
-                AVG(dollar_volume) AS average_dollar_volume,
-                (MAX(high) - MIN(low)) AS monthly_high_low_range_volatility
-            FROM {agg_table_name}
-            GROUP BY symbol, company_name, sector, industry, market_cap_group, country, DATE_TRUNC('month', date)
-            ORDER BY symbol ASC, month_start_date DESC;
-        """)
+        create_monthly_summary_view(cursor, mv_name, fact_table_name)
         conn.commit()
         logging.info("Materialized view refreshed successfully.")
 
@@ -306,5 +843,108 @@ def main():
         if conn:
             conn.close()
             logging.info("Script finished. Database connection closed.")
+
+def pending_trade_dates(state: IndicatorState, symbols, until) -> list[str]:
+    """
+    Returns every calendar date from the day after the oldest last_date among the given seeded symbols
+    through `until`, so a missed run (or a weekend) is caught up instead of leaving a hole.
+    """
+    rows = [state.index[symbol] for symbol in symbols if symbol in state.index]
+    last_dates = state.last_date[rows]
+    last_dates = last_dates[~np.isnat(last_dates)]
+    if not len(last_dates):
+        return []
+    first = last_dates.min().astype(object) + timedelta(days=1)
+    return [(first + timedelta(days=offset)).strftime('%Y-%m-%d') for offset in range((until - first).days + 1)]
+
+def append_trading_day(conn, state: IndicatorState, trade_date, companies_df, fact_table_name) -> bool:
+    """
+    Loads one date's grouped bars, advances the indicator state and writes the rows, committing them before
+    the state is saved. Returns False if the catch-up has to stop (no response or a database error).
+    """
+    bars = fetch_grouped_daily_polygon(trade_date, POLYGON_API_KEY)
+    if bars is None:
+        return False
+    if bars.empty:
+        logging.info(f"No bars returned for {trade_date} (not a trading day); skipping.")
+        return True
+    bars = bars[bars['symbol'].isin(companies_df['symbol'])].reset_index(drop=True)
+
+    indicators = state.update(bars)
+    if indicators.empty:
+        logging.info(f"All symbols are already up to date for {trade_date}.")
+        return True
+    day_df = indicators[['symbol', 'date']].reset_index(drop=True)
+    day_df = pd.concat([day_df, format_indicator_columns(indicators)], axis=1)
+    day_df['date'] = day_df['date'].dt.date
+    day_df = day_df.merge(bars, on=['symbol', 'date'], how='left').merge(companies_df, on='symbol', how='left')
+    day_df['adjusted_close'] = day_df['close']
+    day_df['dollar_volume'] = round(day_df['adjusted_close'] * day_df['volume'], -1)
+
+    try:
+        with conn.cursor() as cursor:
+            day_df = attach_symbol_ids(cursor, day_df)
+            cursor.execute(f"DELETE FROM {fact_table_name} WHERE date = %s AND symbol_id = ANY(%s);",
+                           (trade_date, day_df['symbol_id'].astype(int).tolist()))
+            copy_dataframe(cursor, day_df, fact_table_name)
+        conn.commit()
+    except Exception as e:
+        conn.rollback()
+        logging.error(f"Database error during the daily update for {trade_date}: {e}", exc_info=True)
+        return False
+    # The state only moves forward once the rows it describes are committed.
+    state.save(INDICATOR_STATE_PATH)
+    logging.info(f"Daily update for {trade_date}: {len(day_df)} symbols appended to {fact_table_name}.")
+    return True
+
+def run_daily_update(trade_date=None):
+    """
+    Appends trading days for every symbol in the sector from the saved indicator state: one grouped Polygon
+    call, one O(symbols) indicator update and one COPY per date. Without a trade_date, every date since the
+    oldest date in the state through yesterday is loaded in order, skipping dates without bars.
+    """
+    try:
+        state = IndicatorState.load(INDICATOR_STATE_PATH)
+    except (FileNotFoundError, ValueError) as e:
+        logging.error(f"Cannot run the daily update without a valid indicator state ({e}). Run with RUN_MODE = 'full' first.")
+        return
+
+    companies_df = fetch_companies_by_sector(SECTOR_TO_PROCESS)
+    if companies_df.empty:
+        logging.error(f"No companies found for sector '{SECTOR_TO_PROCESS}'. Exiting.")
+        return
+    companies_df['symbol'] = companies_df['symbol'].str.lower()
+    unseeded = sorted(set(companies_df['symbol']) - set(state.index))
+    if unseeded:
+        logging.warning(f"{len(unseeded)} sector symbols have no seeded indicator state and are left out until the "
+                        f"next full run: {unseeded}")
+        companies_df = companies_df[~companies_df['symbol'].isin(unseeded)]
+
+    trade_dates = [trade_date] if trade_date else pending_trade_dates(
+        state, companies_df['symbol'], datetime.now().date() - timedelta(days=1))
+    if not trade_dates:
+        logging.info("All symbols are already up to date.")
+        return
+
+    fact_table_name = f'public."aggregate_fact_{SCHEMA_NAME}"'
+    conn = None
+    try:
+        conn = psycopg2.connect(**DB_PARAMS)
+        for date_to_load in trade_dates:
+            if not append_trading_day(conn, state, date_to_load, companies_df, fact_table_name):
+                logging.warning(f"Stopping the catch-up at {date_to_load}; it resumes from there on the next run.")
+                break
+        with conn.cursor() as cursor:
+            cursor.execute(f"REFRESH MATERIALIZED VIEW public.monthly_{SCHEMA_NAME}_summary;")
+        conn.commit()
+    except Exception as e:
+        if conn: conn.rollback()
+        logging.error(f"Database error during the daily update: {e}", exc_info=True)
+    finally:
+        if conn: conn.close()
+
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    if RUN_MODE == "daily":
+        run_daily_update()
+    else:
+        main()
\ No newline at end of file